@@ -2,7 +2,24 @@ import operator
 
 
 def country_and_languages(language_rtree, latitude, longitude):
-    props = language_rtree.point_in_poly(latitude, longitude, return_all=True)
+    '''
+    If the index was saved with a raster (see geodata.polygons.raster), the
+    result for points away from any boundary is computed once per raster
+    region and shared, so callers must not modify it.
+    '''
+    region = language_rtree.point_region(latitude, longitude)
+    if region is None:
+        return resolve_country_and_languages(language_rtree.point_in_poly(latitude, longitude, return_all=True))
+
+    results = language_rtree.raster.results
+    result = results.get(region)
+    if result is None:
+        props = [language_rtree.get_properties(i) for i in language_rtree.raster.polygons(region)]
+        result = results[region] = resolve_country_and_languages(props)
+    return result
+
+
+def resolve_country_and_languages(props):
     if not props:
         return None, None, None
 
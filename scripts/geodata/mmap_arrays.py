@@ -0,0 +1,121 @@
+'''
+geodata.mmap_arrays
+-------------------
+
+Minimal binary container for named, typed arrays. The file is a short
+JSON header describing each section followed by the raw array data,
+aligned so that every section can be memory-mapped and used in place
+as a NumPy array without parsing or copying.
+
+Since the arrays are backed by the OS page cache, several processes
+reading the same file share one copy of the data.
+
+Usage:
+    >>> write_arrays('polygons.bin', 'PLYS', [('coords', coords), ('indptr', indptr)])
+    >>> arrays = MappedArrays('polygons.bin', 'PLYS')
+    >>> arrays['coords']
+'''
+
+import array
+import mmap
+import numpy
+import struct
+import ujson as json
+
+ALIGNMENT = 8
+
+HEADER_FORMAT = '<4sI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def aligned(n, alignment=ALIGNMENT):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def as_numpy_array(a):
+    if isinstance(a, numpy.ndarray):
+        return a
+    elif isinstance(a, array.array):
+        return numpy.frombuffer(a, dtype=numpy.dtype(a.typecode))
+    elif isinstance(a, str):
+        return numpy.frombuffer(a, dtype=numpy.uint8)
+    return numpy.asarray(a)
+
+
+def write_arrays(filename, magic, arrays, metadata=None):
+    '''
+    Write a list of (name, array) pairs to filename. Arrays may be NumPy
+    arrays, array.array buffers or byte strings. metadata is an optional
+    JSON-serializable dict stored in the header.
+    '''
+    arrays = [(name, as_numpy_array(a)) for name, a in arrays]
+
+    sections = []
+    offset = 0
+    for name, a in arrays:
+        sections.append({
+            'name': name,
+            'dtype': a.dtype.str,
+            'shape': a.shape,
+            'offset': offset,
+        })
+        offset = aligned(offset + a.nbytes)
+
+    header = json.dumps({'sections': sections, 'metadata': metadata or {}})
+    data_start = aligned(HEADER_SIZE + len(header))
+
+    f = open(filename, 'wb')
+    f.write(struct.pack(HEADER_FORMAT, magic, len(header)))
+    f.write(header)
+
+    for section, (name, a) in zip(sections, arrays):
+        f.write('\0' * (data_start + section['offset'] - f.tell()))
+        f.write(numpy.ascontiguousarray(a).tostring())
+    f.close()
+
+
+class MappedArrays(object):
+    '''
+    Read-only, memory-mapped view of a file created with write_arrays.
+    Sections are exposed as NumPy arrays by name.
+    '''
+
+    def __init__(self, filename, magic):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_magic, header_size = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if file_magic != magic:
+            raise ValueError('{} is not a valid file, expected magic number {}'.format(filename, magic))
+
+        header = json.loads(self.mm[HEADER_SIZE:HEADER_SIZE + header_size])
+        self.metadata = header['metadata']
+
+        data_start = aligned(HEADER_SIZE + header_size)
+
+        self.arrays = {}
+        for section in header['sections']:
+            dtype = numpy.dtype(str(section['dtype']))
+            shape = tuple(section['shape'])
+            size = int(numpy.prod(shape))
+            if size > 0:
+                a = numpy.frombuffer(self.mm, dtype=dtype, count=size,
+                                     offset=data_start + section['offset'])
+            else:
+                a = numpy.empty(0, dtype=dtype)
+            self.arrays[section['name']] = a.reshape(shape)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def get(self, name, default=None):
+        return self.arrays.get(name, default)
+
+    def close(self):
+        self.arrays = {}
+        self.mm.close()
+        self.f.close()
@@ -0,0 +1,195 @@
+'''
+geodata.osm.cache
+-----------------
+
+Parse-once cache of OSM files, so pipeline stages which read the same
+multi-GB extract several times only pay for parsing it once.
+
+The first parse_osm(..., cache_dir=...) call for a file parses all of
+it (every element type, with dependencies and all tags) and writes a
+binary cache file to cache_dir. That call and every later one read the
+cache instead, applying allowed_types, dependencies and the tag and
+attribute filters as the records are read.
+
+A cache file is a header followed by blocks of up to 8000 elements, each
+a marshalled list of (type code, id, attributes, tags, deps) prefixed by
+its length. Attributes are stored as the strings and in the order they
+were parsed in, so cached records are the same as parsed ones. Keys and
+values other than coordinates are interned, so marshal writes each
+distinct string once per block. The file is read through mmap, one block
+at a time.
+
+Cache files are named after the source file and a hash of its absolute
+path, so files with the same name in different directories can share a
+cache_dir. The header records the size and modification time of the
+source file, and the cache is rebuilt when they change. Caches are
+written to a temporary file and renamed, so an interrupted pass leaves no
+cache.
+
+Usage:
+    >>> for key, attrs, deps in parse_osm('planet-addresses.osm', cache_dir='/tmp/osm_cache'):
+    ...     pass
+'''
+
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+
+from geodata.file_utils import ensure_dir
+from geodata.osm.extract import (ALL_OSM_TAGS, LAT_LON_ATTRIBUTES, OSM_TYPE_CODES, OSM_TYPE_NAMES,
+                                  osm_file_elements, osm_tag_filter)
+
+OSM_CACHE_EXTENSION = '.cache'
+OSM_CACHE_MAGIC = 'OSMCACHE'
+OSM_CACHE_VERSION = 2
+
+OSM_CACHE_BLOCK_SIZE = 8000
+
+# Big-endian uint32 length before the header and each block
+LENGTH_FORMAT = '!I'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+
+
+def osm_cache_path(filename, cache_dir):
+    path = os.path.abspath(filename)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    path_hash = hashlib.md5(path).hexdigest()[:16]
+    return os.path.join(cache_dir, os.path.basename(filename) + '.' + path_hash + OSM_CACHE_EXTENSION)
+
+
+def source_info(filename):
+    stat = os.stat(filename)
+    return {'version': OSM_CACHE_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_header(f):
+    if f.read(len(OSM_CACHE_MAGIC)) != OSM_CACHE_MAGIC:
+        return None
+    size = f.read(LENGTH_SIZE)
+    if len(size) < LENGTH_SIZE:
+        return None
+    return marshal.loads(f.read(struct.unpack(LENGTH_FORMAT, size)[0]))
+
+
+def is_valid_osm_cache(path, filename):
+    '''Whether the cache at path exists and was built from filename as it is now'''
+    if not os.path.exists(path):
+        return False
+    f = open(path, 'rb')
+    try:
+        return read_header(f) == source_info(filename)
+    except (EOFError, ValueError, TypeError):
+        return False
+    finally:
+        f.close()
+
+
+def intern_string(s):
+    '''Only str can be interned, unicode strings are written as is'''
+    return intern(s) if type(s) is str else s
+
+
+def cache_element(element):
+    item_type, elem_id, attrs, tags, deps = element
+    # Coordinates are nearly all distinct, interning them would only grow the table
+    attrs = [(intern_string(k), v if k in LAT_LON_ATTRIBUTES else intern_string(v)) for k, v in attrs]
+    tags = [(intern_string(k), intern_string(v)) for k, v in tags]
+    if item_type == 'relation':
+        deps = [(member_id, intern_string(role)) for member_id, role in deps]
+
+    return (OSM_TYPE_CODES[item_type], elem_id, attrs, tags, deps)
+
+
+def write_block(f, block):
+    data = marshal.dumps(block)
+    f.write(struct.pack(LENGTH_FORMAT, len(data)))
+    f.write(data)
+
+
+def write_osm_cache(elements, path, filename, block_size=OSM_CACHE_BLOCK_SIZE):
+    '''
+    Write a cache of filename to path from the elements of the whole file,
+    with dependencies and unfiltered, as produced by osm_file_elements
+    '''
+    cache_dir = os.path.dirname(path)
+    ensure_dir(cache_dir)
+    info = source_info(filename)
+
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=OSM_CACHE_EXTENSION)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(OSM_CACHE_MAGIC)
+        write_block(f, info)
+
+        block = []
+        for element in elements:
+            block.append(cache_element(element))
+            if len(block) == block_size:
+                write_block(f, block)
+                block = []
+        if block:
+            write_block(f, block)
+        f.close()
+        os.rename(temp_path, path)
+    except:
+        f.close()
+        os.unlink(temp_path)
+        raise
+
+
+def read_osm_cache(path):
+    '''Yields the cached elements as (type code, id, attributes, tags, deps)'''
+    f = open(path, 'rb')
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = len(OSM_CACHE_MAGIC)
+        end = len(data)
+        first = True
+        while pos < end:
+            size = struct.unpack_from(LENGTH_FORMAT, data, pos)[0]
+            pos += LENGTH_SIZE
+            block = marshal.loads(data[pos:pos + size])
+            pos += size
+            # The first block is the header
+            if first:
+                first = False
+                continue
+            for element in block:
+                yield element
+    finally:
+        data.close()
+        f.close()
+
+
+def cached_osm_elements(filename, cache_dir, allowed_types=ALL_OSM_TAGS, dependencies=False,
+                        tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None,
+                        source_elements=None):
+    '''
+    Same elements as osm_file_elements, read from the cache of filename in
+    cache_dir, which is built first if needed. source_elements are the
+    elements to build it from, by default the file is parsed serially.
+    '''
+    path = osm_cache_path(filename, cache_dir)
+    if not is_valid_osm_cache(path, filename):
+        if source_elements is None:
+            source_elements = osm_file_elements(filename, dependencies=True)
+        write_osm_cache(source_elements, path, filename)
+
+    type_codes = set([OSM_TYPE_CODES[t] for t in allowed_types])
+    keep_tag = osm_tag_filter(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex)
+
+    for type_code, elem_id, attrs, tags, deps in read_osm_cache(path):
+        if type_code not in type_codes:
+            continue
+
+        if attributes is not None:
+            attrs = [(k, v) for k, v in attrs if k in attributes]
+
+        if keep_tag is not None:
+            tags = [(k, v) for k, v in tags if keep_tag(k)]
+
+        yield OSM_TYPE_NAMES[type_code], elem_id, attrs, tags, deps if dependencies else None
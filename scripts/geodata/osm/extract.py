@@ -3,9 +3,11 @@ geodata.osm.extract
 -------------------
 
 Extracts nodes/ways/relations, their metadata and dependencies
-from .osm XML files.
+from .osm XML or .osm.pbf files.
 '''
 
+import array
+import marshal
 import os
 import re
 import sys
@@ -14,6 +16,7 @@ import ujson as json
 import HTMLParser
 
 from collections import OrderedDict
+from cStringIO import StringIO
 from lxml import etree
 
 this_dir = os.path.realpath(os.path.dirname(__file__))
@@ -27,6 +30,7 @@ OSM_BOUNDARIES_DIR = os.path.join(this_dir, os.pardir, os.pardir, os.pardir,
                                   'resources', 'boundaries', 'osm')
 
 from geodata.encoding import safe_decode
+from geodata.parallel import ordered_map, unordered_map
 
 WAY_OFFSET = 10 ** 15
 RELATION_OFFSET = 2 * 10 ** 15
@@ -34,6 +38,28 @@ RELATION_OFFSET = 2 * 10 ** 15
 ALL_OSM_TAGS = set(['node', 'way', 'relation'])
 WAYS_RELATIONS = set(['way', 'relation'])
 
+# Type codes of OSMElement
+OSM_NODE = 0
+OSM_WAY = 1
+OSM_RELATION = 2
+
+OSM_TYPE_NAMES = ('node', 'way', 'relation')
+OSM_TYPE_CODES = {name: code for code, name in enumerate(OSM_TYPE_NAMES)}
+
+LAT_LON_ATTRIBUTES = ('lat', 'lon')
+
+PBF_EXTENSION = '.pbf'
+
+# Size of the pieces .osm files are split into for parse_osm_parallel
+OSM_CHUNK_SIZE = 8 * 1024 * 1024
+# Chunks in flight per worker process
+OSM_CHUNKS_PER_WORKER = 2
+
+# Top-level elements can't be nested and < is escaped in attribute values,
+# so every match starts a node/way/relation
+osm_element_start_regex = re.compile('<(?:node|way|relation)[\s/>]')
+OSM_END_TAG = '</osm>'
+
 OSM_NAME_TAGS = (
     'name',
     'alt_name',
@@ -49,7 +75,114 @@ OSM_NAME_TAGS = (
 )
 
 
-def parse_osm(filename, allowed_types=ALL_OSM_TAGS, dependencies=False):
+def osm_tag_filter(tag_keys=None, tag_prefixes=None, tag_regex=None):
+    '''
+    Predicate for the tag keys to keep: keys in tag_keys, starting with
+    one of tag_prefixes or matching tag_regex (a compiled pattern).
+    None if every tag is kept.
+    '''
+    if tag_keys is None and tag_prefixes is None and tag_regex is None:
+        return None
+
+    tag_keys = frozenset(tag_keys or ())
+    tag_prefixes = tuple(tag_prefixes or ())
+
+    def keep_tag(key):
+        return key in tag_keys or key.startswith(tag_prefixes) or \
+            (tag_regex is not None and tag_regex.match(key) is not None)
+    return keep_tag
+
+
+class OSMElement(object):
+    '''
+    Compact record yielded by parse_osm(compact=True).
+
+    type is one of OSM_NODE, OSM_WAY, OSM_RELATION and id is the numeric
+    id. tags is a tuple of (key, value) pairs for the element's attributes
+    (lat, lon, ...) followed by its tags, and can be read through get,
+    [] and in like the OrderedDict of the regular records, where a tag
+    wins over an attribute with the same key. deps is an
+    array of node ids for ways or member ids for relations, with the
+    corresponding roles in roles, or None without dependencies.
+    '''
+    __slots__ = ('type', 'id', 'tags', 'deps', 'roles')
+
+    def __init__(self, type, id, tags, deps=None, roles=None):
+        self.type = type
+        self.id = id
+        self.tags = tags
+        self.deps = deps
+        self.roles = roles
+
+    @property
+    def key(self):
+        return '{}:{}'.format(OSM_TYPE_NAMES[self.type], self.id)
+
+    def get(self, key, default=None):
+        for k, v in reversed(self.tags):
+            if k == key:
+                return v
+        return default
+
+    def __getitem__(self, key):
+        for k, v in reversed(self.tags):
+            if k == key:
+                return v
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for k, v in self.tags:
+            if k == key:
+                return True
+        return False
+
+    def iteritems(self):
+        return iter(self.tags)
+
+    def __repr__(self):
+        return 'OSMElement({}, {!r}, {!r}, {!r})'.format(self.key, self.tags, self.deps, self.roles)
+
+
+def osm_records(elements, allowed_types=ALL_OSM_TAGS, compact=False):
+    '''
+    Records as yielded by parse_osm from (type name, id, attribute pairs,
+    tag pairs, deps) tuples as produced by the readers
+    '''
+    if compact:
+        for item_type, elem_id, attrs, tags, deps in elements:
+            roles = None
+            if deps is not None and item_type == 'relation':
+                roles = tuple([role for member_id, role in deps])
+                deps = array.array('l', [member_id for member_id, role in deps])
+            elif deps is not None:
+                deps = array.array('l', deps)
+            yield OSMElement(OSM_TYPE_CODES[item_type], elem_id, tuple(attrs + tags), deps, roles)
+        return
+
+    single_type = len(allowed_types) == 1
+    for item_type, elem_id, attrs, tags, deps in elements:
+        key = elem_id if single_type else '{}:{}'.format(item_type, elem_id)
+        yield key, OrderedDict(attrs + tags), deps
+
+
+def osm_file_elements(filename, allowed_types=ALL_OSM_TAGS, dependencies=False,
+                      tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None):
+    '''Elements of an .osm or .osm.pbf file for osm_records'''
+    if filename.endswith(PBF_EXTENSION):
+        # geodata.osm.pbf uses the constants above, so it's imported here
+        from geodata.osm.pbf import pbf_elements
+        keep_tag = osm_tag_filter(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex)
+        return pbf_elements(filename, allowed_types=allowed_types, dependencies=dependencies,
+                            keep_tag=keep_tag, attributes=attributes)
+
+    return iterparse_osm(open(filename), allowed_types=allowed_types, dependencies=dependencies,
+                         tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex,
+                         attributes=attributes)
+
+
+def parse_osm(filename, allowed_types=ALL_OSM_TAGS, dependencies=False,
+              tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None,
+              compact=False, cache_dir=None):
     '''
     Parse a file in .osm format iteratively, generating tuples like:
     ('node:1', OrderedDict([('lat', '12.34'), ('lon', '23.45')])),
@@ -57,11 +190,41 @@ def parse_osm(filename, allowed_types=ALL_OSM_TAGS, dependencies=False):
     ('node:3', OrderedDict([('lat', '12.34'), ('lon', '23.45')])),
     ('node:4', OrderedDict([('lat', '12.34'), ('lon', '23.45')])),
     ('way:4444', OrderedDict([('name', 'Main Street')]), [1,2,3,4])
+
+    If any of tag_keys, tag_prefixes or tag_regex are given, only the
+    matching tags are kept (see osm_tag_filter), and if attributes is given
+    only those element attributes (e.g. ('lat', 'lon')) are. Everything
+    else is skipped without being added to the OrderedDict.
+
+    With compact=True, OSMElement records are generated instead, with no
+    string keys to format and split or OrderedDicts to build.
+
+    With a cache_dir, the file is parsed once into a binary cache there,
+    which later calls read instead (see geodata.osm.cache).
+
+    Files ending in .pbf are read with geodata.osm.pbf.
     '''
-    f = open(filename)
-    parser = etree.iterparse(f)
+    filters = dict(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex, attributes=attributes)
+    if cache_dir is not None:
+        # geodata.osm.cache uses this module, so it's imported here
+        from geodata.osm.cache import cached_osm_elements
+        elements = cached_osm_elements(filename, cache_dir, allowed_types=allowed_types,
+                                       dependencies=dependencies, **filters)
+    else:
+        elements = osm_file_elements(filename, allowed_types=allowed_types, dependencies=dependencies, **filters)
+    return osm_records(elements, allowed_types=allowed_types, compact=compact)
+
+
+def iterparse_osm(f, allowed_types=ALL_OSM_TAGS, dependencies=False,
+                  tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None):
+    '''
+    Yields (type name, id, attribute pairs, tag pairs, deps) for each
+    element of an open .osm file or file-like object, see osm_records
+    '''
+    # Children (tags, nds, members) are read from their elements, lxml doesn't need to return them
+    parser = etree.iterparse(f, tag=tuple(ALL_OSM_TAGS))
 
-    single_type = len(allowed_types) == 1
+    keep_tag = osm_tag_filter(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex)
 
     for (_, elem) in parser:
         elem_id = long(elem.attrib.pop('id', 0))
@@ -74,12 +237,18 @@ def parse_osm(filename, allowed_types=ALL_OSM_TAGS, dependencies=False):
             item_type = 'relation'
 
         if item_type in allowed_types:
-            attrs = OrderedDict(elem.attrib)
+            # In document order either way, as in the PBF reader and the cache
+            attrs = elem.attrib.items()
+            if attributes is not None:
+                attrs = [(k, v) for k, v in attrs if k in attributes]
+            tags = []
             deps = [] if dependencies else None
 
-            for e in elem.getchildren():
+            for e in elem.iterchildren():
                 if e.tag == 'tag':
-                    attrs[e.attrib['k']] = e.attrib['v']
+                    k = e.get('k')
+                    if keep_tag is None or keep_tag(k):
+                        tags.append((k, e.get('v')))
                 elif dependencies and item_type == 'way' and e.tag == 'nd':
                     deps.append(long(e.attrib['ref']))
                 elif dependencies and item_type == 'relation' and e.tag == 'member' and \
@@ -87,14 +256,127 @@ def parse_osm(filename, allowed_types=ALL_OSM_TAGS, dependencies=False):
                         e.attrib.get('role') in ('inner', 'outer'):
                     deps.append((long(e.attrib['ref']), e.attrib.get('role')))
 
-            key = elem_id if single_type else '{}:{}'.format(item_type, elem_id)
-            yield key, attrs, deps
+            yield item_type, elem_id, attrs, tags, deps
 
         if elem.tag in ALL_OSM_TAGS:
             elem.clear()
             while elem.getprevious() is not None:
                 del elem.getparent()[0]
 
+
+def find_osm_element_start(f, offset, block_size=64 * 1024):
+    '''Offset of the first node/way/relation at or after offset, or None'''
+    f.seek(offset)
+    tail = ''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return None
+        data = tail + block
+        match = osm_element_start_regex.search(data)
+        if match:
+            return offset - len(tail) + match.start()
+        offset += len(block)
+        # Keep enough of the block to match a tag split across blocks
+        tail = data[-len('<relation '):]
+
+
+def find_osm_end(f, block_size=64 * 1024):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    start = max(size - block_size, 0)
+    f.seek(start)
+    end = f.read().rfind(OSM_END_TAG)
+    return start + end if end >= 0 else size
+
+
+def osm_chunks(filename, chunk_size=OSM_CHUNK_SIZE):
+    '''
+    Splits an .osm file into (start, end) byte ranges of about chunk_size,
+    each made of whole top-level elements
+    '''
+    f = open(filename)
+    try:
+        start = find_osm_element_start(f, 0)
+        if start is None:
+            return
+        end = find_osm_end(f)
+
+        while start < end:
+            next_start = None
+            if start + chunk_size < end:
+                next_start = find_osm_element_start(f, start + chunk_size)
+            if next_start is None or next_start >= end:
+                yield start, end
+                break
+            yield start, next_start
+            start = next_start
+    finally:
+        f.close()
+
+
+def parse_osm_chunk(args):
+    '''
+    Elements of one of the chunks from osm_chunks as a marshalled list, which
+    is several times faster to send back from a worker than pickled OrderedDicts
+    '''
+    filename, start, end, allowed_types, dependencies, filters = args
+    f = open(filename)
+    f.seek(start)
+    data = f.read(end - start)
+    f.close()
+    elements = list(iterparse_osm(StringIO(''.join(('<osm>', data, '</osm>'))),
+                                  allowed_types=allowed_types, dependencies=dependencies, **filters))
+    return marshal.dumps(elements)
+
+
+def osm_chunk_elements(filename, allowed_types, dependencies, filters, num_workers,
+                       ordered=True, chunk_size=OSM_CHUNK_SIZE):
+    chunks = ((filename, start, end, allowed_types, dependencies, filters)
+              for start, end in osm_chunks(filename, chunk_size=chunk_size))
+
+    parallel_map = ordered_map if ordered else unordered_map
+    for elements in parallel_map(parse_osm_chunk, chunks, num_workers=num_workers,
+                                 batch_size=num_workers * OSM_CHUNKS_PER_WORKER):
+        for element in marshal.loads(elements):
+            yield element
+
+
+def parse_osm_parallel(filename, allowed_types=ALL_OSM_TAGS, dependencies=False,
+                       num_workers=1, ordered=True, chunk_size=OSM_CHUNK_SIZE,
+                       tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None,
+                       compact=False, cache_dir=None):
+    '''
+    Same records as parse_osm, with the file split into chunks at element
+    boundaries and parsed by a pool of num_workers processes. Chunks are
+    read a few per worker at a time, so memory stays bounded. With
+    ordered=False, records come back in no particular order, but each
+    chunk's records stay together.
+
+    With a cache_dir, the file is only parsed (in parallel) if it isn't
+    cached yet, the records are read from the cache as in parse_osm.
+
+    With one worker (the default), or for .pbf files, this is just parse_osm.
+    '''
+    filters = dict(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex, attributes=attributes)
+
+    if num_workers <= 1 or filename.endswith(PBF_EXTENSION):
+        return parse_osm(filename, allowed_types=allowed_types, dependencies=dependencies,
+                         compact=compact, cache_dir=cache_dir, **filters)
+
+    if cache_dir is not None:
+        # geodata.osm.cache uses this module, so it's imported here
+        from geodata.osm.cache import cached_osm_elements
+        source_elements = osm_chunk_elements(filename, ALL_OSM_TAGS, True, {}, num_workers,
+                                             chunk_size=chunk_size)
+        elements = cached_osm_elements(filename, cache_dir, allowed_types=allowed_types,
+                                       dependencies=dependencies, source_elements=source_elements,
+                                       **filters)
+    else:
+        elements = osm_chunk_elements(filename, allowed_types, dependencies, filters, num_workers,
+                                      ordered=ordered, chunk_size=chunk_size)
+    return osm_records(elements, allowed_types=allowed_types, compact=compact)
+
 apposition_regex = re.compile('(.*[^\s])[\s]*\([\s]*(.*[^\s])[\s]*\)$', re.I)
 
 html_parser = HTMLParser.HTMLParser()
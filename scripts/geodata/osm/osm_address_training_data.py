@@ -44,7 +44,7 @@ import HTMLParser
 
 from collections import defaultdict, OrderedDict
 from lxml import etree
-from itertools import ifilter, chain, combinations
+from itertools import ifilter, chain, combinations, islice
 
 this_dir = os.path.realpath(os.path.dirname(__file__))
 sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
@@ -58,12 +58,16 @@ from geodata.geonames.db import GeoNamesDB
 from geodata.language_id.disambiguation import *
 from geodata.language_id.sample import sample_random_language
 from geodata.states.state_abbreviations import STATE_ABBREVIATIONS, STATE_EXPANSIONS
-from geodata.language_id.polygon_lookup import country_and_languages
+from geodata.language_id.polygon_lookup import country_and_languages, resolve_country_and_languages
 from geodata.i18n.languages import *
 from geodata.address_formatting.formatter import AddressFormatter
 from geodata.names.normalization import replace_name_prefixes, replace_name_suffixes
 from geodata.osm.extract import *
 from geodata.polygons.language_polys import *
+from geodata.polygons.index import PrefetchedPolygonIndex
+from geodata.polygons.layers import MultiLayerPolygonIndex, SeparatePointLayers
+from geodata.polygons.pool import PolygonIndexPool, PooledPolygonIndex
+from geodata.polygons.stats import dump_stats
 from geodata.polygons.reverse_geocode import *
 from geodata.i18n.unicode_paths import DATA_DIR
 
@@ -86,6 +90,15 @@ ADDRESS_FORMAT_DATA_FILENAME = 'formatted_addresses.tsv'
 ADDRESS_FORMAT_DATA_LANGUAGE_FILENAME = 'formatted_addresses_by_language.tsv'
 TOPONYM_LANGUAGE_DATA_FILENAME = 'toponyms_by_language.tsv'
 
+# Records per batch of polygon lookups when using a polygon index pool
+POLYGON_LOOKUP_BATCH_SIZE = 1000
+
+# Polygon layers looked up for each address, see OSMAddressFormatter.point_layers
+LANGUAGE_LAYER = 'language'
+ADMIN_LAYER = 'admin'
+NEIGHBORHOODS_LAYER = 'neighborhoods'
+QUATTROSHAPES_LAYER = 'quattroshapes'
+
 
 class AddressComponent(object):
     '''
@@ -477,7 +490,33 @@ def osm_abbreviate(gazetteer, s, language, abbreviate_prob=0.3, separate_prob=0.
     return u''.join(abbreviated).strip()
 
 
-def build_ways_training_data(language_rtree, infile, out_dir):
+def check_way_coordinates(records, filename):
+    '''
+    Passes through records from parse_osm (compact or with type:id keys),
+    raising ValueError if the first way or relation has no lat/lon. Ways
+    and relations are placed by the coordinates osmconvert --all-to-nodes
+    gives them (see fetch_osm_address_data.sh), without it every one of
+    them would be skipped and the output silently left without them.
+    '''
+    checked = False
+    for record in records:
+        if not checked:
+            if isinstance(record, OSMElement):
+                is_node = record.type == OSM_NODE
+                value = record
+            else:
+                key, value, deps = record
+                is_node = key.startswith('node:')
+
+            if not is_node:
+                if 'lat' not in value or 'lon' not in value:
+                    raise ValueError('{} has ways/relations without coordinates, convert it with '
+                                     'osmconvert --all-to-nodes first'.format(filename))
+                checked = True
+        yield record
+
+
+def build_ways_training_data(language_rtree, infile, out_dir, parse_workers=1, cache_dir=None):
     '''
     Creates a training set for language classification using most OSM ways
     (streets) under a fairly lengthy osmfilter definition which attempts to
@@ -492,8 +531,12 @@ def build_ways_training_data(language_rtree, infile, out_dir):
     f = open(os.path.join(out_dir, WAYS_LANGUAGE_DATA_FILENAME), 'w')
     writer = csv.writer(f, 'tsv_no_quote')
 
-    for key, value, deps in parse_osm(infile, allowed_types=WAYS_RELATIONS):
-        country, name_language = get_language_names(language_rtree, key, value, tag_prefix='name')
+    records = parse_osm_parallel(infile, allowed_types=WAYS_RELATIONS,
+                                 num_workers=parse_workers, ordered=False, compact=True,
+                                 tag_prefixes=('name',), attributes=LAT_LON_ATTRIBUTES,
+                                 cache_dir=cache_dir)
+    for value in check_way_coordinates(records, infile):
+        country, name_language = get_language_names(language_rtree, value.id, value, tag_prefix='name')
         if not name_language:
             continue
 
@@ -520,9 +563,9 @@ def strip_keys(value, ignore_keys):
         value.pop(key, None)
 
 
-def osm_reverse_geocoded_components(admin_rtree, country, latitude, longitude):
+def osm_reverse_geocoded_components(country, admin_polygons):
     ret = defaultdict(list)
-    for props in admin_rtree.point_in_poly(latitude, longitude, return_all=True):
+    for props in admin_polygons:
         name = props.get('name')
         if not name:
             continue
@@ -549,15 +592,87 @@ class OSMAddressFormatter(object):
         'CA',
     }
 
-    def __init__(self, admin_rtree, language_rtree, neighborhoods_rtree, quattroshapes_rtree, geonames, splitter=None):
+    def __init__(self, admin_rtree, language_rtree, neighborhoods_rtree, quattroshapes_rtree, geonames, splitter=None,
+                 multi_layer=False):
+        '''
+        With multi_layer, the four indexes are combined into one
+        MultiLayerPolygonIndex (see geodata.polygons.layers) so each
+        address is looked up with a single traversal
+        '''
         self.admin_rtree = admin_rtree
         self.language_rtree = language_rtree
         self.neighborhoods_rtree = neighborhoods_rtree
         self.quattroshapes_rtree = quattroshapes_rtree
+        self.layer_index = None
+        if multi_layer:
+            self.layer_index = MultiLayerPolygonIndex(self.layer_indexes().items())
         self.geonames = geonames
         self.formatter = AddressFormatter(splitter=splitter)
         osm_address_components.configure()
 
+    def layer_indexes(self):
+        return OrderedDict([
+            (LANGUAGE_LAYER, self.language_rtree),
+            (ADMIN_LAYER, self.admin_rtree),
+            (NEIGHBORHOODS_LAYER, self.neighborhoods_rtree),
+            (QUATTROSHAPES_LAYER, self.quattroshapes_rtree),
+        ])
+
+    def point_layers(self, latitude, longitude):
+        '''
+        Polygons containing the point in each layer, looked up as needed,
+        in one query of the multi-layer index if there is one
+        '''
+        if self.layer_index is not None:
+            return self.layer_index.point_in_layers(latitude, longitude)
+        return SeparatePointLayers(self.layer_indexes(), latitude, longitude)
+
+    def country_and_languages(self, layers):
+        if self.layer_index is None:
+            # Shares results per region if the language index has a raster
+            return country_and_languages(self.language_rtree, layers.lat, layers.lon)
+        return resolve_country_and_languages(layers[LANGUAGE_LAYER])
+
+    def prefetched_indexes(self):
+        return [index for index in (self.admin_rtree, self.language_rtree,
+                                    self.neighborhoods_rtree, self.quattroshapes_rtree)
+                if isinstance(index, PrefetchedPolygonIndex)]
+
+    def prefetch_polygons(self, records, batch_size=POLYGON_LOOKUP_BATCH_SIZE):
+        '''
+        Passes through (key, value, deps) records from parse_osm. For
+        indexes wrapped in PrefetchedPolygonIndex (or served by a
+        PolygonIndexPool), the polygons for each batch of records are
+        looked up beforehand, in locality order or in the pool's workers.
+        '''
+        indexes = self.prefetched_indexes()
+        if not indexes:
+            return records
+        return self.prefetched_batches(records, indexes, batch_size)
+
+    def prefetched_batches(self, records, indexes, batch_size):
+        records = iter(records)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+
+            lats = []
+            lons = []
+            for key, value, deps in batch:
+                try:
+                    latitude, longitude = latlon_to_decimal(value['lat'], value['lon'])
+                except Exception:
+                    continue
+                lats.append(latitude)
+                lons.append(longitude)
+
+            for index in indexes:
+                index.prefetch(lats, lons)
+
+            for record in batch:
+                yield record
+
     def pick_language(self, value, candidate_languages, pick_namespaced_language_prob=0.6):
         language = None
 
@@ -759,7 +874,7 @@ class OSMAddressFormatter(object):
 
     def add_osm_boundaries(self, address_components,
                            country, language,
-                           latitude, longitude,
+                           layers,
                            osm_suffix='',
                            non_local_language=None,
                            random_key=True,
@@ -786,7 +901,7 @@ class OSMAddressFormatter(object):
         include these qualifiers in the training data.
         '''
 
-        osm_components = osm_reverse_geocoded_components(self.admin_rtree, country, latitude, longitude)
+        osm_components = osm_reverse_geocoded_components(country, layers[ADMIN_LAYER])
 
         name_key = ''.join(('name', osm_suffix))
         raw_name_key = 'name'
@@ -853,7 +968,7 @@ class OSMAddressFormatter(object):
                     address_components[component] = val
 
     def quattroshapes_city(self, address_components,
-                           latitude, longitude,
+                           layers,
                            language, non_local_language=None,
                            qs_add_city_prob=0.2,
                            abbreviated_name_prob=0.1):
@@ -871,8 +986,7 @@ class OSMAddressFormatter(object):
 
         if non_local_language or (AddressFormatter.CITY not in address_components and random.random() < qs_add_city_prob):
             lang = non_local_language or language
-            quattroshapes_cities = self.quattroshapes_rtree.point_in_poly(latitude, longitude, return_all=True)
-            for result in quattroshapes_cities:
+            for result in layers[QUATTROSHAPES_LAYER]:
                 if result.get(self.quattroshapes_rtree.LEVEL) == self.quattroshapes_rtree.LOCALITY and self.quattroshapes_rtree.GEONAMES_ID in result:
                     geonames_id = int(result[self.quattroshapes_rtree.GEONAMES_ID].split(',')[0])
                     names = self.geonames.get_alternate_names(geonames_id)
@@ -901,7 +1015,7 @@ class OSMAddressFormatter(object):
         return city
 
     def add_neighborhoods(self, address_components,
-                          latitude, longitude,
+                          layers,
                           osm_suffix='',
                           add_prefix_prob=0.5,
                           add_neighborhood_prob=0.5):
@@ -917,7 +1031,7 @@ class OSMAddressFormatter(object):
         on the whole of better quality).
         '''
 
-        neighborhoods = self.neighborhoods_rtree.point_in_poly(latitude, longitude, return_all=True)
+        neighborhoods = layers[NEIGHBORHOODS_LAYER]
         neighborhood_levels = defaultdict(list)
 
         name_key = ''.join(('name', osm_suffix))
@@ -1041,7 +1155,9 @@ class OSMAddressFormatter(object):
         except Exception:
             return None, None, None
 
-        country, candidate_languages, language_props = country_and_languages(self.language_rtree, latitude, longitude)
+        layers = self.point_layers(latitude, longitude)
+
+        country, candidate_languages, language_props = self.country_and_languages(layers)
         if not (country and candidate_languages):
             return None, None, None
 
@@ -1066,15 +1182,15 @@ class OSMAddressFormatter(object):
 
         osm_suffix = self.tag_suffix(language, non_local_language, more_than_one_official_language)
 
-        self.add_osm_boundaries(address_components, country, language, latitude, longitude,
+        self.add_osm_boundaries(address_components, country, language, layers,
                                 non_local_language=non_local_language,
                                 osm_suffix=osm_suffix)
 
-        city = self.quattroshapes_city(address_components, latitude, longitude, language, non_local_language=non_local_language)
+        city = self.quattroshapes_city(address_components, layers, language, non_local_language=non_local_language)
         if city:
             address_components[AddressFormatter.CITY] = city
 
-        self.add_neighborhoods(address_components, latitude, longitude,
+        self.add_neighborhoods(address_components, layers,
                                osm_suffix=osm_suffix)
 
         street = address_components.get(AddressFormatter.ROAD)
@@ -1097,7 +1213,9 @@ class OSMAddressFormatter(object):
         except Exception:
             return None, None, None
 
-        country, candidate_languages, language_props = country_and_languages(self.language_rtree, latitude, longitude)
+        layers = self.point_layers(latitude, longitude)
+
+        country, candidate_languages, language_props = self.country_and_languages(layers)
         if not (country and candidate_languages):
             return None, None, None
 
@@ -1132,7 +1250,7 @@ class OSMAddressFormatter(object):
 
         osm_suffix = self.tag_suffix(language, non_local_language, more_than_one_official_language)
 
-        self.add_osm_boundaries(address_components, country, language, latitude, longitude,
+        self.add_osm_boundaries(address_components, country, language, layers,
                                 osm_suffix=osm_suffix,
                                 non_local_language=non_local_language,
                                 random_key=False,
@@ -1141,12 +1259,12 @@ class OSMAddressFormatter(object):
                                 replace_with_non_local_prob=0.0,
                                 expand_state_prob=1.0)
 
-        city = self.quattroshapes_city(address_components, latitude, longitude, language, non_local_language=non_local_language)
+        city = self.quattroshapes_city(address_components, layers, language, non_local_language=non_local_language)
 
         if city:
             address_components[AddressFormatter.CITY] = city
 
-        self.add_neighborhoods(address_components, latitude, longitude,
+        self.add_neighborhoods(address_components, layers,
                                osm_suffix=osm_suffix)
 
         self.normalize_names(address_components)
@@ -1280,7 +1398,7 @@ class OSMAddressFormatter(object):
 
         return formatted_address, country, language
 
-    def build_training_data(self, infile, out_dir, tag_components=True):
+    def build_training_data(self, infile, out_dir, tag_components=True, parse_workers=1, cache_dir=None):
         '''
         Creates formatted address training data for supervised sequence labeling (or potentially 
         for unsupervised learning e.g. for word vectors) using addr:* tags in OSM.
@@ -1318,7 +1436,9 @@ class OSMAddressFormatter(object):
             formatted_file = open(os.path.join(out_dir, ADDRESS_FORMAT_DATA_FILENAME), 'w')
             writer = csv.writer(formatted_file, 'tsv_no_quote')
 
-        for node_id, value, deps in parse_osm(infile):
+        records = check_way_coordinates(parse_osm_parallel(infile, num_workers=parse_workers, cache_dir=cache_dir),
+                                        infile)
+        for node_id, value, deps in self.prefetch_polygons(records):
             formatted_addresses, country, language = self.formatted_addresses(value, tag_components=tag_components)
             if not formatted_addresses:
                 continue
@@ -1340,7 +1460,7 @@ class OSMAddressFormatter(object):
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted addresses'.format(i))
 
-    def build_limited_training_data(self, infile, out_dir):
+    def build_limited_training_data(self, infile, out_dir, parse_workers=1, cache_dir=None):
         '''
         Creates a special kind of formatted address training data from OSM's addr:* tags
         but are designed for use in language classification. These records are similar 
@@ -1358,7 +1478,9 @@ class OSMAddressFormatter(object):
         f = open(os.path.join(out_dir, ADDRESS_FORMAT_DATA_LANGUAGE_FILENAME), 'w')
         writer = csv.writer(f, 'tsv_no_quote')
 
-        for node_id, value, deps in parse_osm(infile):
+        records = check_way_coordinates(parse_osm_parallel(infile, num_workers=parse_workers, cache_dir=cache_dir),
+                                        infile)
+        for node_id, value, deps in self.prefetch_polygons(records):
             formatted_address, country, language = self.formatted_address_limited(value)
             if not formatted_address:
                 continue
@@ -1405,7 +1527,7 @@ POSTAL_KEYS = (
 )
 
 
-def build_toponym_training_data(language_rtree, infile, out_dir):
+def build_toponym_training_data(language_rtree, infile, out_dir, parse_workers=1, cache_dir=None):
     '''
     Data set of toponyms by language and country which should assist
     in language classification. OSM tends to use the native language
@@ -1422,7 +1544,10 @@ def build_toponym_training_data(language_rtree, infile, out_dir):
     f = open(os.path.join(out_dir, TOPONYM_LANGUAGE_DATA_FILENAME), 'w')
     writer = csv.writer(f, 'tsv_no_quote')
 
-    for key, value, deps in parse_osm(infile):
+    records = parse_osm_parallel(infile, num_workers=parse_workers, ordered=False, compact=True,
+                                 tag_prefixes=('name',), attributes=LAT_LON_ATTRIBUTES,
+                                 cache_dir=cache_dir)
+    for value in check_way_coordinates(records, infile):
         if not any((k.startswith('name') for k, v in value.iteritems())):
             continue
 
@@ -1503,7 +1628,7 @@ def build_toponym_training_data(language_rtree, infile, out_dir):
     f.close()
 
 
-def build_address_training_data(langauge_rtree, infile, out_dir, format=False):
+def build_address_training_data(langauge_rtree, infile, out_dir, format=False, cache_dir=None):
     '''
     Creates training set similar to the ways data but using addr:street tags instead.
     These may be slightly closer to what we'd see in real live addresses, containing
@@ -1516,8 +1641,11 @@ def build_address_training_data(langauge_rtree, infile, out_dir, format=False):
     f = open(os.path.join(out_dir, ADDRESS_LANGUAGE_DATA_FILENAME), 'w')
     writer = csv.writer(f, 'tsv_no_quote')
 
-    for key, value, deps in parse_osm(infile):
-        country, street_language = get_language_names(language_rtree, key, value, tag_prefix='addr:street')
+    # get_language_names only looks at keys starting with the first component of the tag prefix
+    records = parse_osm(infile, tag_prefixes=('addr',), attributes=LAT_LON_ATTRIBUTES, compact=True,
+                        cache_dir=cache_dir)
+    for value in check_way_coordinates(records, infile):
+        country, street_language = get_language_names(language_rtree, value.id, value, tag_prefix='addr:street')
         if not street_language:
             continue
 
@@ -1536,20 +1664,25 @@ def build_address_training_data(langauge_rtree, infile, out_dir, format=False):
 
 VENUE_LANGUAGE_DATA_FILENAME = 'names_by_language.tsv'
 
+VENUE_TYPE_KEYS = (u'amenity', u'building')
+
 
-def build_venue_training_data(language_rtree, infile, out_dir):
+def build_venue_training_data(language_rtree, infile, out_dir, parse_workers=1, cache_dir=None):
     i = 0
 
     f = open(os.path.join(out_dir, VENUE_LANGUAGE_DATA_FILENAME), 'w')
     writer = csv.writer(f, 'tsv_no_quote')
 
-    for key, value, deps in parse_osm(infile):
-        country, name_language = get_language_names(language_rtree, key, value, tag_prefix='name')
+    records = parse_osm_parallel(infile, num_workers=parse_workers, ordered=False, compact=True,
+                                 tag_prefixes=('name',), tag_keys=VENUE_TYPE_KEYS,
+                                 attributes=LAT_LON_ATTRIBUTES, cache_dir=cache_dir)
+    for value in check_way_coordinates(records, infile):
+        country, name_language = get_language_names(language_rtree, value.id, value, tag_prefix='name')
         if not name_language:
             continue
 
         venue_type = None
-        for key in (u'amenity', u'building'):
+        for key in VENUE_TYPE_KEYS:
             amenity = value.get(key, u'').strip()
             if amenity in ('yes', 'y'):
                 continue
@@ -1577,16 +1710,20 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-s', '--streets-file',
-                        help='Path to planet-ways.osm')
+                        help='Path to planet-ways.osm or planet-ways.osm.pbf, with ways and relations '
+                             'converted to nodes by osmconvert --all-to-nodes')
 
     parser.add_argument('-a', '--address-file',
-                        help='Path to planet-addresses.osm')
+                        help='Path to planet-addresses.osm or planet-addresses.osm.pbf, with ways and relations '
+                             'converted to nodes by osmconvert --all-to-nodes')
 
     parser.add_argument('-v', '--venues-file',
-                        help='Path to planet-venues.osm')
+                        help='Path to planet-venues.osm or planet-venues.osm.pbf, with ways and relations '
+                             'converted to nodes by osmconvert --all-to-nodes')
 
     parser.add_argument('-b', '--borders-file',
-                        help='Path to planet-borders.osm')
+                        help='Path to planet-borders.osm or planet-borders.osm.pbf, with ways and relations '
+                             'converted to nodes by osmconvert --all-to-nodes')
 
     parser.add_argument('-f', '--format-only',
                         action='store_true',
@@ -1631,25 +1768,89 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--lazy-polygons',
+                        action='store_true',
+                        default=False,
+                        help='Only prepare reverse geocoder polygons as they are tested (for regional jobs)')
+
+    parser.add_argument('--polygon-cache-mb',
+                        type=int,
+                        default=1024,
+                        help='Memory budget for prepared polygons per index with --lazy-polygons')
+
+    parser.add_argument('--hierarchical-lookup',
+                        action='store_true',
+                        default=False,
+                        help='Skip admin polygons whose parent doesn\'t contain the point (indexes built with --hierarchy)')
+
+    parser.add_argument('--polygon-workers',
+                        type=int,
+                        default=0,
+                        help='Worker processes for polygon lookups when formatting addresses, sharing memory-mapped indexes')
+
+    parser.add_argument('--multi-layer-lookup',
+                        action='store_true',
+                        default=False,
+                        help='Look up the four polygon indexes for each address in one combined R-tree')
+
+    parser.add_argument('--prefetch-polygons',
+                        action='store_true',
+                        default=False,
+                        help='Look up the language and admin polygons for batches of addresses in locality order')
+
+    parser.add_argument('--parse-workers',
+                        type=int,
+                        default=1,
+                        help='Worker processes for parsing .osm files, split into chunks (formatted addresses keep file order)')
+
+    parser.add_argument('--osm-cache-dir',
+                        help='Cache each parsed .osm/.osm.pbf file here, so later passes over it (e.g. -f and -l) skip parsing')
+
+    parser.add_argument('--polygon-stats',
+                        help='Write polygon lookup statistics (candidates, exact tests, latencies, slowest polygons) to this JSON file')
+
     args = parser.parse_args()
 
+    if args.polygon_stats and args.polygon_workers > 0:
+        parser.error('--polygon-stats can\'t be used with --polygon-workers, stats are recorded per process')
+    if args.polygon_stats and args.multi_layer_lookup:
+        parser.error('--polygon-stats can\'t be used with --multi-layer-lookup, which bypasses the layers\' indexes')
+    if args.multi_layer_lookup and args.polygon_workers > 0:
+        parser.error('--multi-layer-lookup can\'t be used with --polygon-workers')
+    if args.prefetch_polygons and (args.multi_layer_lookup or args.polygon_workers > 0):
+        parser.error('--prefetch-polygons can\'t be used with --multi-layer-lookup or --polygon-workers')
+
     init_country_names()
     init_languages()
     init_disambiguation()
     init_gazetteers()
 
+    polygon_cache_size = args.polygon_cache_mb * 1024 * 1024
+
     language_rtree = LanguagePolygonIndex.load(args.language_rtree_dir)
     osm_rtree = None
     if args.rtree_dir:
-        osm_rtree = OSMReverseGeocoder.load(args.rtree_dir)
+        osm_rtree = OSMReverseGeocoder.load(args.rtree_dir, lazy=args.lazy_polygons,
+                                            cache_size=polygon_cache_size,
+                                            hierarchical=args.hierarchical_lookup)
 
     neighborhoods_rtree = None
     if args.neighborhoods_rtree_dir:
-        neighborhoods_rtree = NeighborhoodReverseGeocoder.load(args.neighborhoods_rtree_dir)
+        neighborhoods_rtree = NeighborhoodReverseGeocoder.load(args.neighborhoods_rtree_dir, lazy=args.lazy_polygons,
+                                                               cache_size=polygon_cache_size)
 
     quattroshapes_rtree = None
     if args.quattroshapes_rtree_dir:
-        quattroshapes_rtree = QuattroshapesReverseGeocoder.load(args.quattroshapes_rtree_dir)
+        quattroshapes_rtree = QuattroshapesReverseGeocoder.load(args.quattroshapes_rtree_dir, lazy=args.lazy_polygons,
+                                                                cache_size=polygon_cache_size,
+                                                                hierarchical=args.hierarchical_lookup)
+
+    polygon_indexes = [('osm', osm_rtree), ('language', language_rtree),
+                       ('neighborhoods', neighborhoods_rtree), ('quattroshapes', quattroshapes_rtree)]
+    if args.polygon_stats:
+        for name, index in polygon_indexes:
+            if index is not None:
+                index.enable_stats()
 
     geonames = None
 
@@ -1658,9 +1859,11 @@ if __name__ == '__main__':
 
     # Can parallelize
     if args.streets_file:
-        build_ways_training_data(language_rtree, args.streets_file, args.out_dir)
+        build_ways_training_data(language_rtree, args.streets_file, args.out_dir, parse_workers=args.parse_workers,
+                                 cache_dir=args.osm_cache_dir)
     if args.borders_file:
-        build_toponym_training_data(language_rtree, args.borders_file, args.out_dir)
+        build_toponym_training_data(language_rtree, args.borders_file, args.out_dir, parse_workers=args.parse_workers,
+                                    cache_dir=args.osm_cache_dir)
 
     if args.address_file:
         if osm_rtree is None:
@@ -1672,11 +1875,52 @@ if __name__ == '__main__':
         elif geonames is None:
             parser.error('--geonames-db required for formatted addresses')
 
+    # Indexes used for formatting addresses, looked up in batches with --prefetch-polygons or --polygon-workers
+    formatter_osm_rtree = osm_rtree
+    formatter_language_rtree = language_rtree
+    formatter_neighborhoods_rtree = neighborhoods_rtree
+    formatter_quattroshapes_rtree = quattroshapes_rtree
+
+    polygon_pool = None
+    if args.address_file and args.polygon_workers > 0 and (args.format_only or args.limited_addresses):
+        hierarchical = {'hierarchical': args.hierarchical_lookup}
+        polygon_pool = PolygonIndexPool({
+            'language': (LanguagePolygonIndex, args.language_rtree_dir),
+            'osm': (OSMReverseGeocoder, args.rtree_dir, hierarchical),
+            'neighborhoods': (NeighborhoodReverseGeocoder, args.neighborhoods_rtree_dir),
+            'quattroshapes': (QuattroshapesReverseGeocoder, args.quattroshapes_rtree_dir, hierarchical),
+        }, num_workers=args.polygon_workers, cache_size=polygon_cache_size)
+
+        formatter_osm_rtree = PooledPolygonIndex(polygon_pool, 'osm')
+        formatter_language_rtree = PooledPolygonIndex(polygon_pool, 'language')
+        formatter_neighborhoods_rtree = PooledPolygonIndex(polygon_pool, 'neighborhoods')
+        formatter_quattroshapes_rtree = PooledPolygonIndex(polygon_pool, 'quattroshapes')
+    elif args.address_file and args.prefetch_polygons:
+        # Batches of addresses are looked up along a Hilbert curve rather than in OSM id order.
+        # Only the layers every address uses, the others are still looked up as needed
+        formatter_osm_rtree = PrefetchedPolygonIndex(osm_rtree)
+        formatter_language_rtree = PrefetchedPolygonIndex(language_rtree)
+
     if args.address_file and args.format_only:
-        osm_formatter = OSMAddressFormatter(osm_rtree, language_rtree, neighborhoods_rtree, quattroshapes_rtree, geonames)
-        osm_formatter.build_training_data(args.address_file, args.out_dir, tag_components=not args.untagged)
+        osm_formatter = OSMAddressFormatter(formatter_osm_rtree, formatter_language_rtree, formatter_neighborhoods_rtree,
+                                            formatter_quattroshapes_rtree, geonames,
+                                            multi_layer=args.multi_layer_lookup)
+        osm_formatter.build_training_data(args.address_file, args.out_dir, tag_components=not args.untagged,
+                                          parse_workers=args.parse_workers, cache_dir=args.osm_cache_dir)
     if args.address_file and args.limited_addresses:
-        osm_formatter = OSMAddressFormatter(osm_rtree, language_rtree, neighborhoods_rtree, quattroshapes_rtree, geonames, splitter=u' ')
-        osm_formatter.build_limited_training_data(args.address_file, args.out_dir)
+        osm_formatter = OSMAddressFormatter(formatter_osm_rtree, formatter_language_rtree, formatter_neighborhoods_rtree,
+                                            formatter_quattroshapes_rtree, geonames, splitter=u' ',
+                                            multi_layer=args.multi_layer_lookup)
+        osm_formatter.build_limited_training_data(args.address_file, args.out_dir, parse_workers=args.parse_workers,
+                                                  cache_dir=args.osm_cache_dir)
+
+    if polygon_pool is not None:
+        polygon_pool.close()
+
     if args.venues_file:
-        build_venue_training_data(language_rtree, args.venues_file, args.out_dir)
+        build_venue_training_data(language_rtree, args.venues_file, args.out_dir, parse_workers=args.parse_workers,
+                                  cache_dir=args.osm_cache_dir)
+
+    if args.polygon_stats:
+        dump_stats({name: index.stats_snapshot() for name, index in polygon_indexes if index is not None},
+                   args.polygon_stats)
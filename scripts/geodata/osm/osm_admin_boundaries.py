@@ -164,11 +164,12 @@ class OSMAdminPolygonReader(object):
         '''
         i = 0
 
-        for element_id, props, deps in parse_osm(self.filename, dependencies=True):
-            if element_id.startswith('node'):
-                node_id = long(element_id.split(':')[-1])
-                lat = props.get('lat')
-                lon = props.get('lon')
+        for element in parse_osm(self.filename, dependencies=True, compact=True):
+            deps = element.deps
+            if element.type == OSM_NODE:
+                node_id = element.id
+                lat = element.get('lat')
+                lon = element.get('lon')
                 if lat is None or lon is None:
                     continue
                 lat, lon = latlon_to_decimal(lat, lon)
@@ -180,8 +181,8 @@ class OSMAdminPolygonReader(object):
                 self.coords.append(lon)
                 self.coords.append(lat)
                 self.node_ids.append(node_id)
-            elif element_id.startswith('way'):
-                way_id = long(element_id.split(':')[-1])
+            elif element.type == OSM_WAY:
+                way_id = element.id
 
                 # Get node indices by binary search
                 try:
@@ -200,20 +201,22 @@ class OSMAdminPolygonReader(object):
                     self.way_coords.append(self.coords[node_index * 2 + 1])
 
                 self.way_indptr.append(len(self.way_deps))
-            elif element_id.startswith('relation'):
+            elif element.type == OSM_RELATION:
                 if self.node_ids is not None:
                     self.node_ids = None
                 if self.coords is not None:
                     self.coords = None
 
-                relation_id = long(element_id.split(':')[-1])
-                if len(deps) == 0 or not props.get('boundary') or props.get('type', '').lower() == 'multilinestring':
+                relation_id = element.id
+                if len(deps) == 0 or not element.get('boundary') or element.get('type', '').lower() == 'multilinestring':
                     continue
 
+                props = OrderedDict(element.tags)
+
                 outer_ways = []
                 inner_ways = []
 
-                for way_id, role in deps:
+                for way_id, role in izip(deps, element.roles):
                     if role == 'outer':
                         outer_ways.append(way_id)
                     elif role == 'inner':
@@ -224,5 +227,5 @@ class OSMAdminPolygonReader(object):
 
                 yield relation_id, props, outer_polys, inner_polys
             if i % 1000 == 0 and i > 0:
-                self.logger.info('doing {}s, at {}'.format(element_id.split(':')[0], i))
+                self.logger.info('doing {}s, at {}'.format(OSM_TYPE_NAMES[element.type], i))
             i += 1
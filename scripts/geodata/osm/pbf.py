@@ -0,0 +1,470 @@
+'''
+geodata.osm.pbf
+---------------
+
+Reader for OpenStreetMap .osm.pbf files, yielding the same (key, attrs,
+deps) tuples as parse_osm does for .osm XML, so every builder which reads
+OSM files through parse_osm can take PBF directly (parse_osm dispatches
+on the file extension).
+
+A PBF file is a sequence of blobs, each a zlib-compressed protocol
+buffer message holding a block of up to 8000 nodes, ways or relations
+with their own string table. The protocol buffer wire format is decoded
+here directly rather than through generated classes, so there's no
+dependency on protobuf. Blobs are decompressed and decoded one at a
+time. Dense nodes, by far the largest part of a file, are decoded with
+NumPy: the packed ids, coordinates and tags of a whole block are varint-
+and delta-decoded as arrays, and only the nodes of the requested types
+are turned into Python objects.
+
+Ids in the offset ranges used by osmconvert --all-to-nodes are mapped
+back to ways and relations as in the XML reader. Author/version metadata
+isn't read, as in the extracts made with --drop-author --drop-version.
+
+Usage:
+    >>> for key, attrs, deps in parse_pbf('planet-borders.osm.pbf', dependencies=True):
+    ...     pass
+'''
+
+import numpy
+import struct
+import zlib
+
+from geodata.osm.extract import ALL_OSM_TAGS, WAY_OFFSET, RELATION_OFFSET, osm_records, osm_tag_filter
+
+# Protocol buffer wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Field numbers from fileformat.proto and osmformat.proto
+BLOB_HEADER_TYPE = 1
+BLOB_HEADER_DATASIZE = 3
+
+BLOB_RAW = 1
+BLOB_ZLIB_DATA = 3
+
+HEADER_REQUIRED_FEATURES = 4
+
+BLOCK_STRINGTABLE = 1
+BLOCK_PRIMITIVEGROUP = 2
+BLOCK_GRANULARITY = 17
+BLOCK_LAT_OFFSET = 19
+BLOCK_LON_OFFSET = 20
+
+STRINGTABLE_S = 1
+
+GROUP_NODES = 1
+GROUP_DENSE = 2
+GROUP_WAYS = 3
+GROUP_RELATIONS = 4
+
+ELEMENT_ID = 1
+ELEMENT_KEYS = 2
+ELEMENT_VALS = 3
+
+NODE_LAT = 8
+NODE_LON = 9
+
+DENSE_ID = 1
+DENSE_LAT = 8
+DENSE_LON = 9
+DENSE_KEYS_VALS = 10
+
+WAY_REFS = 8
+
+RELATION_ROLES_SID = 8
+RELATION_MEMIDS = 9
+RELATION_TYPES = 10
+
+MEMBER_WAY = 1
+MEMBER_RELATION = 2
+
+OSM_HEADER = 'OSMHeader'
+OSM_DATA = 'OSMData'
+
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes'])
+
+DEFAULT_GRANULARITY = 100
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+
+UINT64_ONE = numpy.uint64(1)
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def signed64(value):
+    '''int64 fields are encoded as unsigned varints'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def zigzag(value):
+    '''Decode an sint32/sint64 field'''
+    return (value >> 1) ^ -(value & 1)
+
+
+def message_fields(buf, start=0, end=None):
+    '''
+    Yields (field number, value) for a message in a bytearray, value is an
+    int for varints or (start, end) offsets for length-delimited fields.
+    Fixed-size fields aren't used by the OSM formats and are skipped.
+    '''
+    if end is None:
+        end = len(buf)
+    pos = start
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == FIXED64:
+            pos += 8
+            continue
+        elif wire_type == FIXED32:
+            pos += 4
+            continue
+        else:
+            raise ValueError('Invalid PBF: unsupported wire type {}'.format(wire_type))
+        yield key >> 3, value
+
+
+def packed_varints(buf, start, end):
+    values = []
+    pos = start
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def varint_array(buf, start, end):
+    '''Packed varints in buf[start:end] as a uint64 array'''
+    data = numpy.frombuffer(buf, dtype=numpy.uint8, count=end - start, offset=start)
+    if not len(data):
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    last_bytes = numpy.flatnonzero(data < 0x80)
+    if not len(last_bytes) or last_bytes[-1] != len(data) - 1:
+        raise ValueError('Invalid PBF: truncated varint')
+    starts = numpy.empty(len(last_bytes), dtype=numpy.int64)
+    starts[0] = 0
+    starts[1:] = last_bytes[:-1] + 1
+
+    # Each byte holds 7 bits, least significant first
+    byte_starts = numpy.repeat(starts, last_bytes - starts + 1)
+    shifts = ((numpy.arange(len(data)) - byte_starts) * 7).astype(numpy.uint64)
+    return numpy.add.reduceat((data & 0x7f).astype(numpy.uint64) << shifts, starts)
+
+
+def zigzag_array(values):
+    return (values >> UINT64_ONE).astype(numpy.int64) ^ -(values & UINT64_ONE).astype(numpy.int64)
+
+
+def delta_array(buf, start, end):
+    '''Packed, delta-coded sint64 field as an int64 array'''
+    return numpy.cumsum(zigzag_array(varint_array(buf, start, end)))
+
+
+def decode_string(s):
+    '''ASCII strings stay str and others become unicode, as lxml does'''
+    try:
+        s.decode('ascii')
+        return s
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+
+
+def element_type(elem_id, default):
+    '''(type, id) undoing the id offsets of osmconvert --all-to-nodes'''
+    if elem_id >= RELATION_OFFSET:
+        return 'relation', elem_id - RELATION_OFFSET
+    elif elem_id >= WAY_OFFSET:
+        return 'way', elem_id - WAY_OFFSET
+    return default, elem_id
+
+
+def format_coordinate(degrees):
+    return '{:.7f}'.format(degrees)
+
+
+class PBFBlock(object):
+    '''
+    One decompressed OSMData block (PrimitiveBlock). keep_tag and attributes
+    filter tags and coordinates as in parse_osm. Tag keys are tested once
+    per entry in the block's string table rather than once per tag.
+    '''
+
+    def __init__(self, data, keep_tag=None, attributes=None):
+        self.data = data
+        self.strings = []
+        self.groups = []
+        self.granularity = DEFAULT_GRANULARITY
+        self.lat_offset = 0
+        self.lon_offset = 0
+
+        for field, value in message_fields(data):
+            if field == BLOCK_STRINGTABLE:
+                self.strings = [decode_string(str(data[start:end]))
+                                for f, (start, end) in message_fields(data, *value) if f == STRINGTABLE_S]
+            elif field == BLOCK_PRIMITIVEGROUP:
+                self.groups.append(value)
+            elif field == BLOCK_GRANULARITY:
+                self.granularity = value
+            elif field == BLOCK_LAT_OFFSET:
+                self.lat_offset = signed64(value)
+            elif field == BLOCK_LON_OFFSET:
+                self.lon_offset = signed64(value)
+
+        self.kept_strings = [keep_tag(s) for s in self.strings] if keep_tag is not None else None
+        self.keep_lat = attributes is None or 'lat' in attributes
+        self.keep_lon = attributes is None or 'lon' in attributes
+
+    def coordinate(self, offset, value):
+        return 1e-9 * (offset + self.granularity * value)
+
+    def coordinate_attrs(self, lat, lon):
+        attrs = []
+        if self.keep_lat:
+            attrs.append(('lat', format_coordinate(lat)))
+        if self.keep_lon:
+            attrs.append(('lon', format_coordinate(lon)))
+        return attrs
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        kept = self.kept_strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals) if kept is None or kept[k]]
+
+    def elements(self, allowed_types=ALL_OSM_TAGS, dependencies=False):
+        '''Yields (type, id, attribute pairs, tag pairs, deps) like iterparse_osm'''
+        data = self.data
+        for start, end in self.groups:
+            for field, value in message_fields(data, start, end):
+                if field == GROUP_DENSE:
+                    for element in self.dense_nodes(value, allowed_types, dependencies):
+                        yield element
+                elif field == GROUP_NODES:
+                    element = self.node(value, dependencies)
+                    if element[0] in allowed_types:
+                        yield element
+                elif field == GROUP_WAYS and 'way' in allowed_types:
+                    yield self.way(value, dependencies)
+                elif field == GROUP_RELATIONS and 'relation' in allowed_types:
+                    yield self.relation(value, dependencies)
+
+    def dense_nodes(self, span, allowed_types, dependencies):
+        start, end = span
+        data = self.data
+        ids = lats = lons = keys_vals = None
+        for field, value in message_fields(data, start, end):
+            if field == DENSE_ID:
+                ids = delta_array(data, *value)
+            elif field == DENSE_LAT:
+                lats = delta_array(data, *value)
+            elif field == DENSE_LON:
+                lons = delta_array(data, *value)
+            elif field == DENSE_KEYS_VALS:
+                keys_vals = varint_array(data, *value)
+
+        if ids is None or not len(ids):
+            return
+
+        # Only nodes whose type (after undoing --all-to-nodes offsets) is wanted
+        selected = numpy.ones(len(ids), dtype=bool)
+        if 'node' not in allowed_types:
+            selected &= ids >= WAY_OFFSET
+        if 'way' not in allowed_types:
+            selected &= (ids < WAY_OFFSET) | (ids >= RELATION_OFFSET)
+        if 'relation' not in allowed_types:
+            selected &= ids < RELATION_OFFSET
+        selected = numpy.flatnonzero(selected)
+        if not len(selected):
+            return
+
+        lats = (1e-9 * (self.lat_offset + self.granularity * lats[selected])).tolist()
+        lons = (1e-9 * (self.lon_offset + self.granularity * lons[selected])).tolist()
+
+        # keys_vals is k, v, k, v, 0 for each node, or empty if no node has tags
+        tag_starts = tag_ends = None
+        if keys_vals is not None and len(keys_vals):
+            tag_ends = numpy.flatnonzero(keys_vals == 0)
+            tag_starts = numpy.concatenate(([0], tag_ends[:-1] + 1))
+            tag_starts = tag_starts[selected].tolist()
+            tag_ends = tag_ends[selected].tolist()
+            keys_vals = keys_vals.tolist()
+
+        strings = self.strings
+        kept = self.kept_strings
+        for j, i in enumerate(ids[selected].tolist()):
+            item_type, elem_id = element_type(i, 'node')
+            tags = []
+            if tag_starts is not None:
+                for k in xrange(tag_starts[j], tag_ends[j], 2):
+                    key = keys_vals[k]
+                    if kept is None or kept[key]:
+                        tags.append((strings[key], strings[keys_vals[k + 1]]))
+            yield item_type, elem_id, self.coordinate_attrs(lats[j], lons[j]), tags, [] if dependencies else None
+
+    def node(self, span, dependencies):
+        start, end = span
+        data = self.data
+        elem_id = lat = lon = 0
+        keys = vals = ()
+        for field, value in message_fields(data, start, end):
+            if field == ELEMENT_ID:
+                elem_id = zigzag(value)
+            elif field == ELEMENT_KEYS:
+                keys = packed_varints(data, *value)
+            elif field == ELEMENT_VALS:
+                vals = packed_varints(data, *value)
+            elif field == NODE_LAT:
+                lat = zigzag(value)
+            elif field == NODE_LON:
+                lon = zigzag(value)
+
+        item_type, elem_id = element_type(elem_id, 'node')
+        attrs = self.coordinate_attrs(self.coordinate(self.lat_offset, lat),
+                                      self.coordinate(self.lon_offset, lon))
+        return item_type, elem_id, attrs, self.tags(keys, vals), [] if dependencies else None
+
+    def way(self, span, dependencies):
+        start, end = span
+        data = self.data
+        elem_id = 0
+        keys = vals = ()
+        deps = [] if dependencies else None
+        for field, value in message_fields(data, start, end):
+            if field == ELEMENT_ID:
+                elem_id = signed64(value)
+            elif field == ELEMENT_KEYS:
+                keys = packed_varints(data, *value)
+            elif field == ELEMENT_VALS:
+                vals = packed_varints(data, *value)
+            elif field == WAY_REFS and dependencies:
+                deps = map(long, delta_array(data, *value).tolist())
+
+        return 'way', elem_id, [], self.tags(keys, vals), deps
+
+    def relation(self, span, dependencies):
+        start, end = span
+        data = self.data
+        elem_id = 0
+        keys = vals = roles = memids = types = ()
+        for field, value in message_fields(data, start, end):
+            if field == ELEMENT_ID:
+                elem_id = signed64(value)
+            elif field == ELEMENT_KEYS:
+                keys = packed_varints(data, *value)
+            elif field == ELEMENT_VALS:
+                vals = packed_varints(data, *value)
+            elif dependencies and field == RELATION_ROLES_SID:
+                roles = packed_varints(data, *value)
+            elif dependencies and field == RELATION_MEMIDS:
+                memids = delta_array(data, *value).tolist()
+            elif dependencies and field == RELATION_TYPES:
+                types = packed_varints(data, *value)
+
+        deps = None
+        if dependencies:
+            strings = self.strings
+            deps = [(long(memid), strings[role]) for memid, role, member_type in zip(memids, roles, types)
+                    if member_type in (MEMBER_WAY, MEMBER_RELATION) and strings[role] in ('inner', 'outer')]
+
+        return 'relation', elem_id, [], self.tags(keys, vals), deps
+
+
+def read_blobs(f):
+    '''Yields (blob type, decompressed data as a bytearray) for each blob in a file'''
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+        elif len(size) < 4:
+            raise ValueError('Invalid PBF: truncated blob header size')
+
+        size = struct.unpack('!I', size)[0]
+        if size > MAX_BLOB_HEADER_SIZE:
+            raise ValueError('Invalid PBF: blob header of {} bytes'.format(size))
+        header = bytearray(f.read(size))
+
+        blob_type = None
+        data_size = 0
+        for field, value in message_fields(header):
+            if field == BLOB_HEADER_TYPE:
+                blob_type = str(header[value[0]:value[1]])
+            elif field == BLOB_HEADER_DATASIZE:
+                data_size = value
+
+        if data_size > MAX_BLOB_SIZE:
+            raise ValueError('Invalid PBF: blob of {} bytes'.format(data_size))
+        blob = bytearray(f.read(data_size))
+        if len(blob) < data_size:
+            raise ValueError('Invalid PBF: truncated blob')
+
+        data = None
+        for field, value in message_fields(blob):
+            if field == BLOB_RAW:
+                data = blob[value[0]:value[1]]
+            elif field == BLOB_ZLIB_DATA:
+                start, end = value
+                data = bytearray(zlib.decompress(buffer(blob, start, end - start)))
+        if data is None:
+            raise ValueError('Invalid PBF: unsupported blob compression')
+
+        yield blob_type, data
+
+
+def check_header(data):
+    for field, value in message_fields(data):
+        if field == HEADER_REQUIRED_FEATURES:
+            feature = str(data[value[0]:value[1]])
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError('PBF file requires unsupported feature: {}'.format(feature))
+
+
+def pbf_elements(filename, allowed_types=ALL_OSM_TAGS, dependencies=False, keep_tag=None, attributes=None):
+    '''Yields (type, id, attribute pairs, tag pairs, deps) for each element in a file'''
+    f = open(filename, 'rb')
+    try:
+        for blob_type, data in read_blobs(f):
+            if blob_type == OSM_HEADER:
+                check_header(data)
+                continue
+            elif blob_type != OSM_DATA:
+                continue
+
+            block = PBFBlock(data, keep_tag=keep_tag, attributes=attributes)
+            for item_type, elem_id, attrs, tags, deps in block.elements(allowed_types, dependencies):
+                # Ids are longs in the XML reader
+                yield item_type, long(elem_id), attrs, tags, deps
+    finally:
+        f.close()
+
+
+def parse_pbf(filename, allowed_types=ALL_OSM_TAGS, dependencies=False,
+              tag_keys=None, tag_prefixes=None, tag_regex=None, attributes=None,
+              compact=False):
+    '''
+    Parse an .osm.pbf file iteratively, generating the same tuples (or
+    OSMElements with compact=True) as geodata.osm.extract.parse_osm
+    '''
+    keep_tag = osm_tag_filter(tag_keys=tag_keys, tag_prefixes=tag_prefixes, tag_regex=tag_regex)
+    elements = pbf_elements(filename, allowed_types=allowed_types, dependencies=dependencies,
+                            keep_tag=keep_tag, attributes=attributes)
+    return osm_records(elements, allowed_types=allowed_types, compact=compact)
@@ -0,0 +1,80 @@
+'''
+geodata.parallel
+----------------
+
+Parallel maps for long streams of records, e.g. cleaning geometries while
+building a polygon index.
+
+Input is consumed in fixed-size batches, with at most two batches in
+flight (one being computed by the workers while the results of the
+previous one are consumed), so memory stays bounded however long the
+stream is. Results come back in input order, so anything assigned while
+consuming them, like polygon ids, is the same as in a serial run.
+unordered_map yields the results of each batch as they're computed, for
+consumers which don't care about order, so one slow item doesn't hold up
+the rest of its batch.
+
+Usage:
+    >>> for result in ordered_map(clean_geometry, records, num_workers=8):
+    ...     index.add_polygon(*result)
+'''
+
+import multiprocessing
+
+from itertools import imap, islice
+
+ITEMS_PER_WORKER = 100
+
+
+def ordered_map(func, iterable, num_workers=1, batch_size=None):
+    '''
+    Like itertools.imap(func, iterable), computed by a pool of worker processes.
+
+    func must be a module-level function, and items and results must be
+    picklable. With one worker (the default), everything runs serially in
+    this process, so callers only fork a pool when asked to.
+    '''
+    if num_workers <= 1:
+        return imap(func, iterable)
+
+    return pool_map(func, iterable, num_workers, batch_size=batch_size, ordered=True)
+
+
+def unordered_map(func, iterable, num_workers=1, batch_size=None):
+    '''
+    Like ordered_map, but results are yielded in the order they're computed.
+    '''
+    if num_workers <= 1:
+        return imap(func, iterable)
+
+    return pool_map(func, iterable, num_workers, batch_size=batch_size, ordered=False)
+
+
+def pool_map(func, iterable, num_workers, batch_size=None, ordered=True):
+    if batch_size is None:
+        batch_size = num_workers * ITEMS_PER_WORKER
+    chunk_size = max(batch_size // (num_workers * 4), 1)
+
+    iterator = iter(iterable)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pending = None
+        while True:
+            batch = list(islice(iterator, batch_size))
+            next_results = None
+            if batch and ordered:
+                next_results = pool.map_async(func, batch, chunk_size)
+            elif batch:
+                next_results = pool.imap_unordered(func, batch, chunk_size)
+
+            if pending is not None:
+                for result in (pending.get() if ordered else pending):
+                    yield result
+
+            if next_results is None:
+                break
+            pending = next_results
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
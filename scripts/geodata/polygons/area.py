@@ -1,21 +1,46 @@
+'''
+geodata.polygons.area
+---------------------
+
+Areas of lon/lat polygons in square meters.
+
+polygon_area projects the polygon onto an Albers equal-area conic fitted
+to its latitudes. Since the projection preserves area whatever its
+standard parallels, projections are cached by whole degrees and reused,
+and coordinates are projected as arrays, one call per ring.
+
+Edges are straight lines in the projection, so polygons spanning most of
+the globe's longitudes (e.g. a box from -180 to 180) come out too small.
+'''
+
+import math
 import pyproj
 
-from functools import partial
 from shapely.ops import transform
 from shapely.geometry import Polygon
 
+_albers_projections = {}
+
+
+def albers_projection(min_lat, max_lat):
+    '''Cached Albers equal-area projection for a range of latitudes'''
+    lat_1, lat_2 = int(math.floor(min_lat)), int(math.ceil(max_lat))
+    # Standard parallels can't be symmetric about the equator
+    if lat_1 + lat_2 == 0:
+        lat_2 += 1
+
+    proj = _albers_projections.get((lat_1, lat_2))
+    if proj is None:
+        proj = pyproj.Proj(proj='aea', lat_1=lat_1, lat_2=lat_2, ellps='WGS84')
+        _albers_projections[(lat_1, lat_2)] = proj
+    return proj
+
 
 def polygon_area(poly):
-    return transform(
-        partial(pyproj.transform,
-                pyproj.Proj(init='EPSG:4326'),
-                pyproj.Proj(proj='aea',
-                            lat1=poly.bounds[1],
-                            lat2=poly.bounds[2],
-                            )
-                ),
-        poly
-    ).area
+    if poly.is_empty:
+        return 0.0
+    min_lon, min_lat, max_lon, max_lat = poly.bounds
+    return transform(albers_projection(min_lat, max_lat), poly).area
 
 
 def polygon_bounding_box_area(poly):
@@ -0,0 +1,465 @@
+'''
+benchmark.py
+------------
+
+Reproducible benchmark for the polygon indexes and reverse geocoders.
+
+Generates a synthetic, nested set of polygons (countries, admin1 regions,
+localities and neighborhoods, the last two clustered around cities) and
+two point workloads, uniform over the whole extent and clustered around
+the cities like real addresses. Everything is derived from --seed, so two
+runs with the same arguments test the same polygons and points.
+
+For each index class this measures build time (adding polygons), save
+time (bulk-loading the index plus any precomputed structures), size on
+disk, load time, resident memory after loading and after the queries,
+and throughput for single lookups (point_in_poly), batched lookups
+(point_in_poly_batch) and bulk lookups (points_in_polys). Builds and
+queries run in separate processes so that memory numbers aren't skewed by
+earlier runs.
+
+Results are written as JSON with the configuration and the revision they
+were measured on. With --compare, the results are checked against an
+earlier results file and metrics which got worse by more than --threshold
+are reported.
+
+Usage:
+    python benchmark.py -o /tmp/polygon_bench.json
+    python benchmark.py -o /tmp/new.json --compare /tmp/polygon_bench.json --coverage --raster
+'''
+import argparse
+import multiprocessing
+import numpy
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import ujson as json
+
+from collections import OrderedDict
+from shapely.geometry import Polygon
+from timeit import default_timer as timer
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
+
+from geodata.polygons.index import *
+from geodata.polygons.language_polys import LanguagePolygonIndex
+from geodata.polygons.reverse_geocode import (NeighborhoodReverseGeocoder, OSMReverseGeocoder,
+                                              QuattroshapesNeighborhoodsReverseGeocoder,
+                                              QuattroshapesReverseGeocoder)
+
+BENCHMARK_VERSION = 1
+
+# min lon, min lat, max lon, max lat
+DEFAULT_EXTENT = (-20.0, -20.0, 20.0, 20.0)
+
+# (level name, number of polygons, radius in degrees, vertices, clustered around cities)
+SYNTHETIC_LEVELS = (
+    ('country', 16, 7.0, 2000, False),
+    ('admin1', 128, 2.0, 500, False),
+    ('locality', 512, 0.15, 200, True),
+    ('neighborhood', 2048, 0.02, 50, True),
+)
+
+NUM_CITIES = 64
+# Standard deviation of the distance to the city center, in degrees
+CITY_POLYGON_SPREAD = 0.3
+CITY_POINT_SPREAD = 0.1
+# Share of urban workload points which are spread over the whole extent
+RURAL_POINTS = 0.1
+
+WORKLOADS = ('uniform', 'urban')
+
+DEFAULT_NUM_POINTS = 20000
+DEFAULT_SEED = 1
+DEFAULT_THRESHOLD = 0.1
+
+
+def level_properties(index_class):
+    '''
+    Function (level, polygon number) => properties for a class, with the
+    properties its polygon_priority expects
+    '''
+    def quattroshapes_properties(level, j):
+        qs_levels = (QuattroshapesReverseGeocoder.COUNTRY, QuattroshapesReverseGeocoder.ADMIN1,
+                     QuattroshapesReverseGeocoder.LOCALITY, QuattroshapesReverseGeocoder.NEIGHBORHOOD)
+        return {'name': u'qs {} {}'.format(level, j), 'level': qs_levels[level]}
+
+    def neighborhood_properties(level, j):
+        sources = sorted(NeighborhoodReverseGeocoder.source_priorities)
+        return {'name': u'neighborhood {} {}'.format(level, j),
+                'polygon_type': 'neighborhood' if level >= 2 else 'local_admin',
+                'source': sources[j % len(sources)]}
+
+    if issubclass(index_class, LanguagePolygonIndex):
+        return lambda level, j: {'admin_level': level, 'qs_iso_cc': 'x{}'.format(j % 16),
+                                 'languages': [{'lang': 'en', 'default': 1}]}
+    elif issubclass(index_class, OSMReverseGeocoder):
+        return lambda level, j: {'id': j, 'name': u'osm {} {}'.format(level, j),
+                                 'admin_level': str(2 + 2 * level)}
+    elif issubclass(index_class, NeighborhoodReverseGeocoder):
+        return neighborhood_properties
+    elif issubclass(index_class, QuattroshapesReverseGeocoder):
+        return quattroshapes_properties
+    return lambda level, j: {'id': j, 'name': u'polygon {} {}'.format(level, j), 'level': level}
+
+
+BENCHMARK_INDEXES = OrderedDict([
+    ('rtree', RTreePolygonIndex),
+    ('geohash', GeohashPolygonIndex),
+    ('language', LanguagePolygonIndex),
+    ('osm', OSMReverseGeocoder),
+    ('neighborhoods', NeighborhoodReverseGeocoder),
+    ('quattroshapes', QuattroshapesReverseGeocoder),
+    ('quattroshapes_neighborhoods', QuattroshapesNeighborhoodsReverseGeocoder),
+])
+
+
+def city_centers(seed, extent=DEFAULT_EXTENT, num_cities=NUM_CITIES):
+    rng = numpy.random.RandomState(seed)
+    min_lon, min_lat, max_lon, max_lat = extent
+    return rng.uniform(min_lon, max_lon, num_cities), rng.uniform(min_lat, max_lat, num_cities)
+
+
+def random_polygon(rng, lon, lat, radius, num_vertices):
+    '''
+    Star-shaped polygon with a jagged boundary around (lon, lat), always
+    valid since each angle has exactly one vertex
+    '''
+    angles = numpy.sort(rng.uniform(0.0, 2 * numpy.pi, num_vertices))
+    radii = radius * rng.uniform(0.7, 1.0, num_vertices)
+    return Polygon(zip(lon + radii * numpy.cos(angles), lat + radii * numpy.sin(angles)))
+
+
+def synthetic_polygons(seed, scale=1.0, extent=DEFAULT_EXTENT):
+    '''Yields (level, polygon number, polygon), the same for a given seed and scale'''
+    rng = numpy.random.RandomState(seed)
+    city_lons, city_lats = city_centers(seed, extent=extent)
+    min_lon, min_lat, max_lon, max_lat = extent
+
+    j = 0
+    for level, (name, num_polygons, radius, num_vertices, clustered) in enumerate(SYNTHETIC_LEVELS):
+        for k in xrange(max(int(num_polygons * scale), 1)):
+            if clustered:
+                city = rng.randint(len(city_lons))
+                lon = city_lons[city] + rng.normal(0.0, CITY_POLYGON_SPREAD)
+                lat = city_lats[city] + rng.normal(0.0, CITY_POLYGON_SPREAD)
+            else:
+                lon, lat = rng.uniform(min_lon, max_lon), rng.uniform(min_lat, max_lat)
+            yield level, j, random_polygon(rng, lon, lat, radius, num_vertices)
+            j += 1
+
+
+def synthetic_points(workload, seed, num_points, extent=DEFAULT_EXTENT):
+    '''(lats, lons) for a workload, uniform over the extent or mostly around cities'''
+    rng = numpy.random.RandomState(seed + 1)
+    min_lon, min_lat, max_lon, max_lat = extent
+    lats = rng.uniform(min_lat, max_lat, num_points)
+    lons = rng.uniform(min_lon, max_lon, num_points)
+
+    if workload == 'urban':
+        city_lons, city_lats = city_centers(seed, extent=extent)
+        urban = rng.uniform(size=num_points) >= RURAL_POINTS
+        cities = rng.randint(len(city_lons), size=urban.sum())
+        lats[urban] = city_lats[cities] + rng.normal(0.0, CITY_POINT_SPREAD, len(cities))
+        lons[urban] = city_lons[cities] + rng.normal(0.0, CITY_POINT_SPREAD, len(cities))
+    elif workload != 'uniform':
+        raise ValueError('Unknown workload: {}'.format(workload))
+
+    return lats, lons
+
+
+def resident_memory():
+    '''Resident set size of this process in bytes, None if unavailable'''
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def directory_size(d):
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, dirs, filenames in os.walk(d) for filename in filenames)
+
+
+def build_index(name, d, config):
+    '''Build and save one index, run in a separate process'''
+    index_class = BENCHMARK_INDEXES[name]
+    properties = level_properties(index_class)
+    polygons = list(synthetic_polygons(config['seed'], scale=config['scale']))
+
+    start = timer()
+    index = index_class(save_dir=d)
+    for level, j, poly in polygons:
+        index.index_polygon(poly)
+        index.add_polygon(poly, properties(level, j))
+    build_time = timer() - start
+
+    start = timer()
+    # Hierarchies are only defined, and rasters only used, for indexes with polygon priorities
+    has_priority = index_class.polygon_priority is not None
+    index.save(build_coverage=config['coverage'], build_hierarchy=config['hierarchy'] and has_priority,
+               build_raster=config['raster'] and has_priority, build_resolutions=config['multi_resolution'])
+    save_time = timer() - start
+
+    return {
+        'num_polygons': len(polygons),
+        'build_time': build_time,
+        'save_time': save_time,
+        'disk_bytes': directory_size(d),
+    }
+
+
+def query_rate(num_points, elapsed):
+    return num_points / elapsed if elapsed > 0 else None
+
+
+def query_index(name, d, config):
+    '''Load one index and run the workloads against it, run in a separate process'''
+    index_class = BENCHMARK_INDEXES[name]
+    return_all = config['return_all']
+
+    base_rss = resident_memory()
+    start = timer()
+    index = index_class.load(d, lazy=config['lazy'], hierarchical=config['hierarchy'])
+    load_time = timer() - start
+    rss = resident_memory()
+
+    results = {
+        'load_time': load_time,
+        'load_rss_bytes': rss - base_rss if rss is not None else None,
+        'workloads': {},
+    }
+
+    for workload in config['workloads']:
+        lats, lons = synthetic_points(workload, config['seed'], config['points'])
+        num_points = len(lats)
+
+        start = timer()
+        matches = 0
+        for lat, lon in zip(lats.tolist(), lons.tolist()):
+            if index.point_in_poly(lat, lon, return_all=return_all):
+                matches += 1
+        single_time = timer() - start
+
+        start = timer()
+        index.point_in_poly_batch(lats, lons, return_all=return_all)
+        batch_time = timer() - start
+
+        start = timer()
+        index.points_in_polys(lats, lons, return_all=return_all)
+        bulk_time = timer() - start
+
+        rss = resident_memory()
+        results['workloads'][workload] = {
+            'points': num_points,
+            'matches': matches,
+            'single_time': single_time,
+            'single_qps': query_rate(num_points, single_time),
+            'batch_time': batch_time,
+            'batch_qps': query_rate(num_points, batch_time),
+            'bulk_time': bulk_time,
+            'bulk_qps': query_rate(num_points, bulk_time),
+            'rss_bytes': rss - base_rss if rss is not None else None,
+        }
+
+    return results
+
+
+def run_isolated(func, *args):
+    '''Run func in a fresh process so memory use doesn't carry over'''
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=this_dir,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(names, config, work_dir=None):
+    results = OrderedDict()
+    for name in names:
+        d = tempfile.mkdtemp(prefix='polygon_bench_{}_'.format(name), dir=work_dir)
+        try:
+            result = run_isolated(build_index, name, d, config)
+            result.update(run_isolated(query_index, name, d, config))
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+        results[name] = result
+
+    return {
+        'benchmark_version': BENCHMARK_VERSION,
+        'git_revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'config': config,
+        'results': results,
+    }
+
+
+# Metrics where higher is better, the others are times and sizes
+HIGHER_IS_BETTER = set(['single_qps', 'batch_qps', 'bulk_qps'])
+
+
+def flatten_metrics(results, prefix=()):
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            for metric in flatten_metrics(value, prefix + (key,)):
+                yield metric
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            yield prefix + (key,), value
+
+
+def compare_results(old, new, threshold=DEFAULT_THRESHOLD):
+    '''
+    (metric path, old value, new value, relative change) for every metric
+    which got worse by more than threshold, a relative change of 0.1
+    means 10% slower (or bigger)
+    '''
+    old_metrics = dict(flatten_metrics(old['results']))
+    regressions = []
+    for path, value in flatten_metrics(new['results']):
+        old_value = old_metrics.get(path)
+        if not old_value or path[-1] in ('points', 'num_polygons', 'matches'):
+            continue
+        if path[-1] in HIGHER_IS_BETTER:
+            change = float(old_value) / value - 1.0 if value else float('inf')
+        else:
+            change = float(value) / old_value - 1.0
+        if change > threshold:
+            regressions.append((path, old_value, value, change))
+    return regressions
+
+
+def changed_matches(old, new):
+    '''Metric paths where the number of points with a match changed, i.e. results differ'''
+    old_metrics = dict(flatten_metrics(old['results']))
+    return [path for path, value in flatten_metrics(new['results'])
+            if path[-1] == 'matches' and path in old_metrics and old_metrics[path] != value]
+
+
+if __name__ == '__main__':
+    # Handle argument parsing here
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-o', '--output',
+                        help='Write results as JSON to this file (default: stdout)')
+
+    parser.add_argument('-i', '--index',
+                        action='append',
+                        choices=BENCHMARK_INDEXES.keys(),
+                        help='Index classes to benchmark, may be repeated (default: all)')
+
+    parser.add_argument('-n', '--points',
+                        type=int,
+                        default=DEFAULT_NUM_POINTS,
+                        help='Points per workload')
+
+    parser.add_argument('-s', '--scale',
+                        type=float,
+                        default=1.0,
+                        help='Multiplier for the number of synthetic polygons at each level')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=DEFAULT_SEED,
+                        help='Random seed for polygons and points')
+
+    parser.add_argument('-w', '--workload',
+                        action='append',
+                        choices=WORKLOADS,
+                        help='Point workloads, may be repeated (default: all)')
+
+    parser.add_argument('--lazy',
+                        action='store_true',
+                        default=False,
+                        help='Load polygons lazily')
+
+    parser.add_argument('--return-all',
+                        action='store_true',
+                        default=False,
+                        help='Look up every containing polygon rather than the first one')
+
+    parser.add_argument('-c', '--coverage',
+                        action='store_true',
+                        default=False,
+                        help='Build and use precomputed inside/outside cells')
+
+    parser.add_argument('--hierarchy',
+                        action='store_true',
+                        default=False,
+                        help='Build the polygon hierarchy and use hierarchical lookups')
+
+    parser.add_argument('-r', '--raster',
+                        action='store_true',
+                        default=False,
+                        help='Build and use the region raster')
+
+    parser.add_argument('-m', '--multi-resolution',
+                        action='store_true',
+                        default=False,
+                        help='Build and use coarse polygons with error bounds')
+
+    parser.add_argument('--work-dir',
+                        help='Directory for the temporary indexes (default: system temp dir)')
+
+    parser.add_argument('--compare',
+                        help='Earlier results file to check for regressions')
+
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help='Relative change reported as a regression with --compare')
+
+    args = parser.parse_args()
+
+    config = {
+        'points': args.points,
+        'scale': args.scale,
+        'seed': args.seed,
+        'workloads': args.workload or list(WORKLOADS),
+        'lazy': args.lazy,
+        'return_all': args.return_all,
+        'coverage': args.coverage,
+        'hierarchy': args.hierarchy,
+        'raster': args.raster,
+        'multi_resolution': args.multi_resolution,
+    }
+
+    results = run_benchmark(args.index or BENCHMARK_INDEXES.keys(), config, work_dir=args.work_dir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(output)
+        f.close()
+    else:
+        print(output)
+
+    if args.compare:
+        old = json.load(open(args.compare))
+        if old.get('config') != config:
+            sys.stderr.write('Warning: configurations differ, comparing anyway\n')
+
+        for path in changed_matches(old, results):
+            sys.stderr.write('Results changed: {}\n'.format('.'.join(path)))
+
+        regressions = compare_results(old, results, threshold=args.threshold)
+        for path, old_value, value, change in regressions:
+            sys.stderr.write('Regression: {} {:.4g} => {:.4g} ({:+.1%})\n'.format('.'.join(path), old_value, value, change))
+        if regressions:
+            sys.exit(1)
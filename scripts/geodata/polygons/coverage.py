@@ -0,0 +1,207 @@
+'''
+geodata.polygons.coverage
+-------------------------
+
+Precomputed cell coverage for point-in-polygon tests.
+
+Most points fall well inside a polygon rather than near its edge. At save
+time, the bounding box of each polygon is covered by a small quadtree of
+lon/lat grid cells, each classified as fully inside the polygon, fully
+outside of it or on its boundary. Boundary cells are subdivided until a
+per-polygon cell budget is reached.
+
+At query time a point is looked up in the cells of each candidate polygon
+and the exact (shapely) test is only needed when the point lands in a
+boundary cell.
+
+Cells are stored as a single sorted array of integer keys:
+
+    polygon_index << 37 | level << 32 | x << 16 | y
+
+where x and y are the cell's column and row at that level of the grid.
+'''
+
+import math
+import numpy
+
+from shapely.geometry import box
+
+from geodata.mmap_arrays import write_arrays, MappedArrays
+from geodata.polygons.store import prepared_geometry
+
+COVERAGE_MAGIC = 'PCOV'
+
+BOUNDARY, INSIDE, OUTSIDE = range(3)
+
+MAX_LEVEL = 16
+DEFAULT_MAX_CELLS = 128
+
+POLYGON_SHIFT = 37
+LEVEL_SHIFT = 32
+X_SHIFT = 16
+
+
+def cell_coords(lon, lat, level):
+    n = 1 << level
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((lat + 90.0) / 180.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def cell_bounds(level, x, y):
+    width = 360.0 / (1 << level)
+    height = 180.0 / (1 << level)
+    return (x * width - 180.0, y * height - 90.0,
+            (x + 1) * width - 180.0, (y + 1) * height - 90.0)
+
+
+def cell_key(i, level, x, y):
+    return (i << POLYGON_SHIFT) | (level << LEVEL_SHIFT) | (x << X_SHIFT) | y
+
+
+def start_level(bounds):
+    '''
+    Finest level at which a cell is at least as large as the bounding box,
+    so the box is covered by at most 2x2 cells
+    '''
+    width = max(bounds[2] - bounds[0], 1e-9)
+    height = max(bounds[3] - bounds[1], 1e-9)
+    level = int(math.floor(math.log(min(360.0 / width, 180.0 / height), 2)))
+    return min(max(level, 0), MAX_LEVEL)
+
+
+def polygon_cells(i, poly, max_cells=DEFAULT_MAX_CELLS):
+    '''
+    Classify the cells covering a prepared polygon's bounding box.
+
+    Returns (cells, min_level, max_level) where cells is a list of
+    (key, state) for the inside/outside cells, boundary cells are
+    left out. The min and max levels bound the search at query time.
+    '''
+    bounds = poly.context.bounds
+    level = min_level = start_level(bounds)
+
+    x0, y0 = cell_coords(bounds[0], bounds[1], level)
+    x1, y1 = cell_coords(bounds[2], bounds[3], level)
+
+    frontier = [(x, y) for x in xrange(x0, x1 + 1) for y in xrange(y0, y1 + 1)]
+    cells = []
+
+    while True:
+        boundary = []
+        for x, y in frontier:
+            cell = box(*cell_bounds(level, x, y))
+            if poly.contains_properly(cell):
+                cells.append((cell_key(i, level, x, y), INSIDE))
+            elif not poly.intersects(cell):
+                cells.append((cell_key(i, level, x, y), OUTSIDE))
+            else:
+                boundary.append((x, y))
+
+        if not boundary or level == MAX_LEVEL or len(cells) + 4 * len(boundary) > max_cells:
+            break
+
+        frontier = [(2 * x + dx, 2 * y + dy) for x, y in boundary for dx in (0, 1) for dy in (0, 1)]
+        level += 1
+
+    return cells, min_level, level
+
+
+class PolygonCoverage(object):
+    def __init__(self, keys, states, min_levels, max_levels):
+        self.keys = keys
+        self.states = states
+        self.min_levels = min_levels
+        self.max_levels = max_levels
+
+    @classmethod
+    def create(cls, polygons, max_cells=DEFAULT_MAX_CELLS):
+        '''
+        Build the coverage for a sequence of (properties, prepared polygon)
+        tuples e.g. PolygonIndex.polygons
+        '''
+        keys = []
+        states = []
+        min_levels = []
+        max_levels = []
+
+        for i, (props, poly) in enumerate(polygons):
+            poly = prepared_geometry(poly)
+            if poly.context.is_empty:
+                min_levels.append(MAX_LEVEL + 1)
+                max_levels.append(-1)
+                continue
+
+            cells, min_level, max_level = polygon_cells(i, poly, max_cells=max_cells)
+            for key, state in cells:
+                keys.append(key)
+                states.append(state)
+            min_levels.append(min_level)
+            max_levels.append(max_level)
+
+        keys = numpy.array(keys, dtype=numpy.int64)
+        states = numpy.array(states, dtype=numpy.uint8)
+        order = numpy.argsort(keys)
+
+        return cls(keys[order], states[order],
+                   numpy.array(min_levels, dtype=numpy.int8),
+                   numpy.array(max_levels, dtype=numpy.int8))
+
+    def save(self, filename):
+        write_arrays(filename, COVERAGE_MAGIC, [
+            ('keys', self.keys),
+            ('states', self.states),
+            ('min_levels', self.min_levels),
+            ('max_levels', self.max_levels),
+        ], metadata={'max_level': MAX_LEVEL})
+
+    @classmethod
+    def load(cls, filename):
+        arrays = MappedArrays(filename, COVERAGE_MAGIC)
+        return cls(arrays['keys'], arrays['states'], arrays['min_levels'], arrays['max_levels'])
+
+    def lookup(self, key):
+        pos = self.keys.searchsorted(key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return self.states[pos]
+        return BOUNDARY
+
+    def point_state(self, i, lat, lon):
+        '''
+        INSIDE or OUTSIDE if the point is in a classified cell of polygon i,
+        BOUNDARY if it needs an exact test
+        '''
+        for level in xrange(int(self.min_levels[i]), int(self.max_levels[i]) + 1):
+            x, y = cell_coords(lon, lat, level)
+            state = self.lookup(cell_key(i, level, x, y))
+            if state != BOUNDARY:
+                return state
+        return BOUNDARY
+
+    def point_states(self, poly_indices, lats, lons):
+        '''
+        Vectorized point_state for parallel arrays of polygon indices and
+        point coordinates
+        '''
+        states = numpy.zeros(len(poly_indices), dtype=numpy.uint8)
+        if not len(poly_indices) or not len(self.keys):
+            return states
+
+        min_levels = self.min_levels[poly_indices]
+        max_levels = self.max_levels[poly_indices]
+
+        for level in xrange(max(int(min_levels.min()), 0), min(int(max_levels.max()), MAX_LEVEL) + 1):
+            active = numpy.flatnonzero((states == BOUNDARY) & (min_levels <= level) & (max_levels >= level))
+            if not len(active):
+                continue
+
+            n = 1 << level
+            x = numpy.clip(((lons[active] + 180.0) / 360.0 * n).astype(numpy.int64), 0, n - 1)
+            y = numpy.clip(((lats[active] + 90.0) / 180.0 * n).astype(numpy.int64), 0, n - 1)
+            keys = (poly_indices[active] << POLYGON_SHIFT) | (level << LEVEL_SHIFT) | (x << X_SHIFT) | y
+
+            pos = numpy.minimum(self.keys.searchsorted(keys), len(self.keys) - 1)
+            found = self.keys[pos] == keys
+            states[active[found]] = self.states[pos[found]]
+
+        return states
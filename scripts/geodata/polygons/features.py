@@ -0,0 +1,214 @@
+'''
+geodata.polygons.features
+-------------------------
+
+Streaming reader for GeoJSON features.
+
+json.load on a large FeatureCollection needs several times the file size
+in memory before the first feature can be used. GeoJSONFeatureReader reads
+the file in fixed-size chunks and yields one feature at a time, so memory
+use is bounded by the largest single feature rather than the file.
+
+Handles FeatureCollections (the features array is streamed, other members
+are skipped) as well as newline-delimited GeoJSON / GeoJSON text sequences,
+i.e. any number of top-level Feature objects separated by whitespace or
+record separators.
+
+Only the top level of the document is tokenized here. Each feature's text
+is found by matching braces and parsed with a single json.loads call.
+
+Usage:
+    >>> for feature in read_geojson_features('neighborhoods.geojson'):
+    ...     index.add_geojson_like_record(feature)
+'''
+
+import re
+import ujson as json
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Whitespace plus the record separator used in GeoJSON text sequences (RFC 8142)
+NON_WHITESPACE_RE = re.compile(r'[^ \t\r\n\x1e]')
+# Rest of a string after its opening quote
+STRING_END_RE = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+# Characters which matter when skipping over a nested value
+NESTED_VALUE_RE = re.compile(r'[{}\[\]"]')
+# Same for a feature, brackets can be ignored when only matching braces,
+# which skips over coordinate arrays much faster
+OBJECT_RE = re.compile(r'[{}"]')
+SCALAR_END_RE = re.compile(r'[,}\]\s]')
+
+
+class GeoJSONFeatureReader(object):
+    def __init__(self, f, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+
+        self.buf = ''
+        self.pos = 0
+        # Offset of self.buf in the file
+        self.offset = 0
+        # Offset in the file from which text needs to be kept in the buffer
+        self.mark = None
+
+    def fill(self):
+        '''
+        Append the next chunk to the buffer, dropping text before the
+        mark (or the current position). Returns False at end of file.
+        '''
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+
+        keep = self.mark - self.offset if self.mark is not None else self.pos
+        self.buf = self.buf[keep:] + chunk
+        self.offset += keep
+        self.pos -= keep
+        return True
+
+    def next_char(self):
+        '''Consume the next non-whitespace character, None at end of file'''
+        while True:
+            m = NON_WHITESPACE_RE.search(self.buf, self.pos)
+            if m:
+                self.pos = m.end()
+                return m.group()
+            self.pos = len(self.buf)
+            if not self.fill():
+                return None
+
+    def expect(self, expected):
+        c = self.next_char()
+        if c != expected:
+            raise ValueError('Invalid GeoJSON at offset {}: expected {}, got {}'.format(self.offset + self.pos, expected, c))
+
+    def skip_string(self):
+        '''Consume the rest of a string whose opening quote was consumed'''
+        while True:
+            m = STRING_END_RE.match(self.buf, self.pos)
+            if m:
+                self.pos = m.end()
+                return
+            if not self.fill():
+                raise ValueError('Invalid GeoJSON: unterminated string')
+
+    def read_string(self):
+        start = self.offset + self.pos - 1
+        mark = self.mark
+        if mark is None:
+            self.mark = start
+        self.skip_string()
+        self.mark = mark
+        return json.loads(self.buf[start - self.offset:self.pos])
+
+    def skip_nested(self, pattern=NESTED_VALUE_RE):
+        '''Consume the rest of an object or array whose opening character was consumed'''
+        depth = 1
+        while depth:
+            m = pattern.search(self.buf, self.pos)
+            if not m:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError('Invalid GeoJSON: unexpected end of file')
+                continue
+
+            self.pos = m.end()
+            c = m.group()
+            if c == '"':
+                self.skip_string()
+            elif c in '{[':
+                depth += 1
+            else:
+                depth -= 1
+
+    def skip_value(self, c):
+        '''Consume the rest of a value starting with character c'''
+        if c == '"':
+            self.skip_string()
+        elif c in '{[':
+            self.skip_nested()
+        else:
+            while True:
+                m = SCALAR_END_RE.search(self.buf, self.pos)
+                if m:
+                    self.pos = m.start()
+                    return
+                self.pos = len(self.buf)
+                if not self.fill():
+                    return
+
+    def read_object(self):
+        '''Parse an object whose opening brace was consumed'''
+        start = self.offset + self.pos - 1
+        mark = self.mark
+        if mark is None:
+            self.mark = start
+        self.skip_nested(pattern=OBJECT_RE)
+        self.mark = mark
+        return json.loads(self.buf[start - self.offset:self.pos])
+
+    def array_objects(self):
+        '''Yield the objects in an array whose opening bracket was consumed'''
+        while True:
+            c = self.next_char()
+            if c == ']':
+                return
+            elif c == ',':
+                continue
+            elif c == '{':
+                yield self.read_object()
+            elif c is None:
+                raise ValueError('Invalid GeoJSON: unexpected end of file')
+            else:
+                self.skip_value(c)
+
+    def __iter__(self):
+        while True:
+            c = self.next_char()
+            if c is None:
+                return
+            elif c != '{':
+                raise ValueError('Invalid GeoJSON at offset {}: expected an object, got {}'.format(self.offset + self.pos, c))
+
+            # Keep the object's text until it's clear it isn't a FeatureCollection
+            start = self.mark = self.offset + self.pos - 1
+            is_collection = False
+
+            while True:
+                c = self.next_char()
+                if c == '}':
+                    break
+                elif c == ',':
+                    continue
+                elif c != '"':
+                    raise ValueError('Invalid GeoJSON at offset {}: expected a key, got {}'.format(self.offset + self.pos, c))
+
+                key = self.read_string()
+                self.expect(':')
+                c = self.next_char()
+                if c is None:
+                    raise ValueError('Invalid GeoJSON: unexpected end of file')
+
+                if key == 'features' and c == '[':
+                    is_collection = True
+                    self.mark = None
+                    for feature in self.array_objects():
+                        yield feature
+                else:
+                    self.skip_value(c)
+
+            if not is_collection:
+                obj = json.loads(self.buf[start - self.offset:self.pos])
+                self.mark = None
+                if obj.get('type') == 'Feature':
+                    yield obj
+
+
+def read_geojson_features(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yield the features in a GeoJSON or newline-delimited GeoJSON file'''
+    f = open(filename)
+    try:
+        for feature in GeoJSONFeatureReader(f, chunk_size=chunk_size):
+            yield feature
+    finally:
+        f.close()
@@ -0,0 +1,277 @@
+'''
+geodata.polygons.geohash_cover
+------------------------------
+
+Geohash cells as integers and polygon coverings made of them.
+
+A geohash of length L is a sequence of 5 * L bits, alternating between
+longitude and latitude (starting with longitude), each bit halving the
+remaining interval. Here a cell is stored as the integer value of those
+bits together with its level:
+
+    key = bits << 4 | level
+
+which makes it cheap to sort, binary search and compute in bulk with
+NumPy, e.g. for a batch of points.
+
+A polygon's cover is the set of cells which intersect it, starting from
+the finest level whose cells are at least as large as the polygon's
+bounding box and subdividing cells on the polygon's boundary while the
+cover stays within a cell budget.
+'''
+
+import numpy
+
+from shapely.geometry import box
+from shapely.prepared import prep
+
+MIN_LEVEL = 1
+MAX_LEVEL = 7
+
+# Points are quantized at this level and truncated for coarser levels
+POINT_LEVEL = 8
+POINT_BITS = 5 * POINT_LEVEL
+
+DEFAULT_MAX_COVER_CELLS = 64
+
+LEVEL_BITS = 4
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def level_bits(level):
+    '''Number of longitude and latitude bits in a cell at this level'''
+    num_bits = 5 * level
+    return (num_bits + 1) // 2, num_bits // 2
+
+
+def cell_size(level):
+    lon_bits, lat_bits = level_bits(level)
+    return 360.0 / (1 << lon_bits), 180.0 / (1 << lat_bits)
+
+
+def point_bits(lat, lon):
+    '''Interleaved geohash bits for a point at POINT_LEVEL'''
+    n = 1 << (POINT_BITS // 2)
+    x = min(max(int((lon + 180.0) / 360.0 * n), 0), n - 1)
+    y = min(max(int((lat + 90.0) / 180.0 * n), 0), n - 1)
+
+    value = 0
+    for k in xrange(POINT_BITS // 2 - 1, -1, -1):
+        value = (value << 2) | (((x >> k) & 1) << 1) | ((y >> k) & 1)
+    return value
+
+
+def points_bits(lats, lons):
+    '''Vectorized point_bits for NumPy arrays'''
+    n = 1 << (POINT_BITS // 2)
+    x = numpy.clip(((lons + 180.0) / 360.0 * n).astype(numpy.int64), 0, n - 1)
+    y = numpy.clip(((lats + 90.0) / 180.0 * n).astype(numpy.int64), 0, n - 1)
+
+    value = numpy.zeros(len(x), dtype=numpy.int64)
+    for k in xrange(POINT_BITS // 2 - 1, -1, -1):
+        value = (value << 2) | (((x >> k) & 1) << 1) | ((y >> k) & 1)
+    return value
+
+
+def cell_key(bits, level):
+    return (bits << LEVEL_BITS) | level
+
+
+def geohash_key(code):
+    '''Cell key of a geohash string, e.g. u4pruy'''
+    bits = 0
+    for c in code:
+        bits = (bits << 5) | GEOHASH_BASE32.index(c)
+    return cell_key(bits, len(code))
+
+
+def point_key(bits, level):
+    '''Key of the cell at level containing a point with the given point_bits'''
+    return cell_key(bits >> (POINT_BITS - 5 * level), level)
+
+
+def cell_bounds(bits, level):
+    lon_bits, lat_bits = level_bits(level)
+    x = y = 0
+    # Bits alternate lon, lat, lon... starting from the most significant
+    for j in xrange(5 * level):
+        bit = (bits >> (5 * level - 1 - j)) & 1
+        if j % 2 == 0:
+            x = (x << 1) | bit
+        else:
+            y = (y << 1) | bit
+
+    width, height = cell_size(level)
+    return (x * width - 180.0, y * height - 90.0,
+            (x + 1) * width - 180.0, (y + 1) * height - 90.0)
+
+
+def start_level(bounds):
+    '''Finest level whose cells are at least as large as the bounding box'''
+    width = bounds[2] - bounds[0]
+    height = bounds[3] - bounds[1]
+    level = MIN_LEVEL
+    while level < MAX_LEVEL:
+        cell_width, cell_height = cell_size(level + 1)
+        if cell_width < width or cell_height < height:
+            break
+        level += 1
+    return level
+
+
+def bounds_cells(bounds, level):
+    '''Cells at level overlapping a bounding box'''
+    width, height = cell_size(level)
+    lon_bits, lat_bits = level_bits(level)
+
+    x0 = max(int((bounds[0] + 180.0) / width), 0)
+    x1 = min(int((bounds[2] + 180.0) / width), (1 << lon_bits) - 1)
+    y0 = max(int((bounds[1] + 90.0) / height), 0)
+    y1 = min(int((bounds[3] + 90.0) / height), (1 << lat_bits) - 1)
+
+    cells = []
+    for x in xrange(x0, x1 + 1):
+        for y in xrange(y0, y1 + 1):
+            bits = 0
+            for j in xrange(5 * level):
+                # Take the next most significant bit of x or y
+                if j % 2 == 0:
+                    k = lon_bits - 1 - j // 2
+                    bits = (bits << 1) | ((x >> k) & 1)
+                else:
+                    k = lat_bits - 1 - j // 2
+                    bits = (bits << 1) | ((y >> k) & 1)
+            cells.append(bits)
+    return cells
+
+
+def polygon_geohash_cover(poly, max_cells=DEFAULT_MAX_COVER_CELLS):
+    '''
+    Returns the keys of the geohash cells intersecting a shapely polygon,
+    at adaptive levels: cells fully inside the polygon are kept as is,
+    boundary cells are refined one level at a time while the total number
+    of cells stays within max_cells.
+    '''
+    if poly.is_empty:
+        return []
+
+    prepared = prep(poly)
+    level = start_level(poly.bounds)
+
+    interior = []
+    boundary = []
+    for bits in bounds_cells(poly.bounds, level):
+        cell = box(*cell_bounds(bits, level))
+        if prepared.contains(cell):
+            interior.append(cell_key(bits, level))
+        elif prepared.intersects(cell):
+            boundary.append(bits)
+
+    while boundary and level < MAX_LEVEL:
+        next_interior = []
+        next_boundary = []
+        for bits in boundary:
+            for c in xrange(32):
+                child = (bits << 5) | c
+                cell = box(*cell_bounds(child, level + 1))
+                if prepared.contains(cell):
+                    next_interior.append(cell_key(child, level + 1))
+                elif prepared.intersects(cell):
+                    next_boundary.append(child)
+
+        if len(interior) + len(next_interior) + len(next_boundary) > max_cells:
+            break
+
+        interior.extend(next_interior)
+        boundary = next_boundary
+        level += 1
+
+    return interior + [cell_key(bits, level) for bits in boundary]
+
+
+class GeohashCellTable(object):
+    '''
+    Compact, sorted mapping from cell keys to polygon ids in CSR form:
+    the ids for cells[j] are ids[indptr[j]:indptr[j + 1]]
+    '''
+
+    def __init__(self, cells, indptr, ids):
+        self.cells = cells
+        self.indptr = indptr
+        self.ids = ids
+
+        if len(cells):
+            levels = cells & ((1 << LEVEL_BITS) - 1)
+            self.min_level = int(levels.min())
+            self.max_level = int(levels.max())
+        else:
+            self.min_level = self.max_level = 0
+
+    @classmethod
+    def create(cls, keys, ids):
+        keys = numpy.asarray(keys, dtype=numpy.int64)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+
+        # Drop duplicate (cell, id) pairs, sort by cell, then id
+        order = numpy.lexsort((ids, keys))
+        keys = keys[order]
+        ids = ids[order]
+        if len(keys):
+            keep = numpy.ones(len(keys), dtype=bool)
+            keep[1:] = (keys[1:] != keys[:-1]) | (ids[1:] != ids[:-1])
+            keys = keys[keep]
+            ids = ids[keep]
+
+        cells, starts = numpy.unique(keys, return_index=True)
+        indptr = numpy.append(starts, len(keys)).astype(numpy.int64)
+        return cls(cells, indptr, ids.astype(numpy.int32))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def get(self, key):
+        pos = self.cells.searchsorted(key)
+        if pos < len(self.cells) and self.cells[pos] == key:
+            return self.ids[self.indptr[pos]:self.indptr[pos + 1]]
+        return None
+
+    def point_candidates(self, lat, lon):
+        bits = point_bits(lat, lon)
+        candidates = []
+        for level in xrange(self.min_level, self.max_level + 1):
+            ids = self.get(point_key(bits, level))
+            if ids is not None:
+                candidates.extend(ids.tolist())
+        return candidates
+
+    def points_candidates(self, lats, lons):
+        '''
+        Bulk candidate lookup, returns parallel arrays (point_indices, ids)
+        '''
+        point_indices = []
+        ids = []
+        if not len(self.cells):
+            return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+
+        bits = points_bits(lats, lons)
+        for level in xrange(self.min_level, self.max_level + 1):
+            keys = cell_key(bits >> (POINT_BITS - 5 * level), level)
+            pos = numpy.minimum(self.cells.searchsorted(keys), len(self.cells) - 1)
+            found = numpy.flatnonzero(self.cells[pos] == keys)
+            if not len(found):
+                continue
+
+            starts = self.indptr[pos[found]]
+            counts = self.indptr[pos[found] + 1] - starts
+            total = counts.sum()
+
+            # Expand each [start, start + count) range of ids
+            offsets = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            point_indices.append(numpy.repeat(found, counts))
+            ids.append(self.ids[numpy.repeat(starts, counts) + numpy.arange(total) - offsets])
+
+        if not point_indices:
+            return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+        return (numpy.concatenate(point_indices).astype(numpy.int64),
+                numpy.concatenate(ids).astype(numpy.int64))
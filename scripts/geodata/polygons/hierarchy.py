@@ -0,0 +1,194 @@
+'''
+geodata.polygons.hierarchy
+--------------------------
+
+Parent/child containment links between the polygons of an index, for
+hierarchy-aware point-in-polygon lookups.
+
+Admin polygons are nested: a point can only be in a state if it's in that
+state's country, etc. At build time each polygon is linked to the nearest
+coarser polygon (by the index's polygon_priority) that contains it. At
+query time a candidate is only tested once its parent has matched, and
+is skipped without testing if its parent isn't a candidate or didn't
+contain the point. When only the best match is wanted, candidates are
+tried in priority order and the lookup stops at the first match.
+
+Since boundaries from different sources (or simplified separately) rarely
+line up exactly, a child counts as contained in a parent if all of its
+vertices are inside the parent or within a small distance of its boundary.
+Lookups with a hierarchy can therefore differ from the exhaustive ones for
+points within that distance of a parent's boundary, which is why the mode
+is optional.
+'''
+
+import numpy
+
+from shapely import vectorized
+from shapely.geometry import Point
+
+from geodata.mmap_arrays import write_arrays, MappedArrays
+from geodata.polygons.store import prepared_geometry
+
+HIERARCHY_MAGIC = 'PHRC'
+
+# In degrees, roughly 100m at the equator
+DEFAULT_HIERARCHY_TOLERANCE = 0.001
+
+
+def polygon_vertices(poly):
+    '''Exterior ring coordinates of a Polygon or MultiPolygon as an (n, 2) array'''
+    parts = poly.geoms if poly.type == 'MultiPolygon' else [poly]
+    coords = [numpy.asarray(p.exterior.coords)[:, :2] for p in parts if not p.is_empty]
+    if not coords:
+        return numpy.empty((0, 2))
+    return numpy.concatenate(coords)
+
+
+def polygon_within(child, parent, tolerance=DEFAULT_HIERARCHY_TOLERANCE):
+    '''
+    Whether the vertices of child (a shapely geometry) are all inside
+    parent (a prepared geometry) or within tolerance of its boundary
+    '''
+    coords = polygon_vertices(child)
+    if not len(coords):
+        return False
+
+    inside = vectorized.contains(parent, coords[:, 0], coords[:, 1])
+    if inside.all():
+        return True
+
+    boundary = parent.context.boundary
+    return all(boundary.distance(Point(x, y)) <= tolerance
+               for x, y in coords[~inside])
+
+
+def hierarchy_depths(parents):
+    depths = numpy.zeros(len(parents), dtype=numpy.int32)
+    current = numpy.asarray(parents, dtype=numpy.int64).copy()
+    has_parent = current >= 0
+    while has_parent.any():
+        depths[has_parent] += 1
+        current[has_parent] = parents[current[has_parent]]
+        has_parent = current >= 0
+    return depths
+
+
+class PolygonHierarchy(object):
+    def __init__(self, parents):
+        self.parents = parents
+        self.depths = hierarchy_depths(parents)
+
+    @classmethod
+    def create(cls, index, tolerance=DEFAULT_HIERARCHY_TOLERANCE):
+        '''
+        Link each polygon in a PolygonIndex to the nearest coarser polygon
+        containing it. The index must define polygon_priority, a parent
+        has a strictly higher priority than its children.
+        '''
+        priorities = index.get_priorities()
+        if priorities is None:
+            raise ValueError('Polygon hierarchy requires an index with polygon_priority')
+
+        parents = numpy.empty(len(index.polygons), dtype=numpy.int64)
+        parents.fill(-1)
+
+        for i in xrange(len(index.polygons)):
+            props, poly = index.polygons[i]
+            geometry = poly.context
+            if geometry.is_empty:
+                continue
+
+            pt = geometry.representative_point()
+            # Candidates are ordered by priority, so the first match is the nearest ancestor
+            for j in index.get_candidate_polygons(pt.y, pt.x):
+                if priorities[j] <= priorities[i]:
+                    continue
+                parent_props, parent = index.polygons[j]
+                parent = prepared_geometry(parent)
+                if parent.contains(pt) and polygon_within(geometry, parent, tolerance=tolerance):
+                    parents[i] = j
+                    break
+
+        return cls(parents)
+
+    def save(self, filename):
+        write_arrays(filename, HIERARCHY_MAGIC, [
+            ('parents', self.parents),
+        ])
+
+    @classmethod
+    def load(cls, filename):
+        arrays = MappedArrays(filename, HIERARCHY_MAGIC)
+        return cls(arrays['parents'])
+
+    def matches(self, candidates, contains):
+        '''
+        Given a point's candidates as (polygon index, parts) in priority
+        order and a function contains(i, parts), test from the coarsest
+        candidate down, skipping candidates whose parent didn't match.
+        Returns the matching polygon indices in priority order.
+        '''
+        matched = set()
+        for i, parts in reversed(candidates):
+            parent = self.parents[i]
+            if parent >= 0 and int(parent) not in matched:
+                continue
+            if contains(i, parts):
+                matched.add(i)
+        return [i for i, parts in candidates if i in matched]
+
+    def first_match(self, candidates, contains):
+        '''
+        The first of matches (the best match) or None. Candidates are tried
+        in priority order, each after its ancestors, whose results are kept
+        for their other descendants, and testing stops at the first match.
+        '''
+        candidate_parts = dict(candidates)
+        results = {}
+
+        def matched(i):
+            result = results.get(i)
+            if result is None:
+                parent = self.parents[i]
+                if parent >= 0 and (int(parent) not in candidate_parts or not matched(int(parent))):
+                    result = False
+                else:
+                    result = contains(i, candidate_parts[i])
+                results[i] = result
+            return result
+
+        for i, parts in candidates:
+            if matched(i):
+                return i
+        return None
+
+    def contains_bulk(self, point_indices, poly_indices, contains):
+        '''
+        Bulk version of matches for parallel arrays of (point, polygon)
+        pairs. contains(pairs) is called with the indices of the pairs to
+        test, one round per depth in the hierarchy, and returns a boolean
+        mask over them. Returns a boolean mask over all the pairs.
+        '''
+        contained = numpy.zeros(len(poly_indices), dtype=bool)
+        if not len(poly_indices):
+            return contained
+
+        num_polys = len(self.parents)
+        parents = self.parents[poly_indices]
+        depths = self.depths[poly_indices]
+
+        contained_keys = numpy.array([], dtype=numpy.int64)
+        for depth in xrange(int(depths.max()) + 1):
+            pairs = numpy.flatnonzero(depths == depth)
+            if depth > 0:
+                # Only test pairs where the point is in the polygon's parent
+                parent_keys = point_indices[pairs] * num_polys + parents[pairs]
+                pairs = pairs[numpy.in1d(parent_keys, contained_keys)]
+            if not len(pairs):
+                continue
+
+            contained[pairs] = contains(pairs)
+            matched = pairs[contained[pairs]]
+            contained_keys = numpy.union1d(contained_keys, point_indices[matched] * num_polys + poly_indices[matched])
+
+        return contained
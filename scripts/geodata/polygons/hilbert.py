@@ -0,0 +1,51 @@
+'''
+geodata.polygons.hilbert
+------------------------
+
+Hilbert curve ordering for lat/lon points.
+
+Inputs like osmfilter output are ordered by OSM id, so consecutive points
+can be anywhere on the globe. Visiting points in Hilbert curve order
+instead means consecutive lookups hit the same polygons, R-tree nodes and
+memory-mapped pages, and points in the same grid cell come out next to
+each other, since the curve fills each cell before moving to the next one.
+
+The grid is the lon/lat grid used in geodata.polygons.coverage: at level
+L the world is 2^L x 2^L cells.
+'''
+
+import numpy
+
+HILBERT_LEVEL = 16
+
+
+def hilbert_keys(lats, lons, level=HILBERT_LEVEL):
+    '''
+    Position along the Hilbert curve of the grid cell at the given level
+    containing each point, for arrays of latitudes and longitudes
+    '''
+    n = 1 << level
+    x = numpy.clip(((numpy.asarray(lons, dtype=numpy.float64) + 180.0) / 360.0 * n).astype(numpy.int64), 0, n - 1)
+    y = numpy.clip(((numpy.asarray(lats, dtype=numpy.float64) + 90.0) / 180.0 * n).astype(numpy.int64), 0, n - 1)
+
+    keys = numpy.zeros(len(x), dtype=numpy.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant so the curve inside it has the right orientation
+        flip = rx & ~ry
+        x = numpy.where(flip, n - 1 - x, x)
+        y = numpy.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = numpy.where(swap, y, x), numpy.where(swap, x, y)
+        s >>= 1
+
+    return keys
+
+
+def hilbert_order(lats, lons, level=HILBERT_LEVEL):
+    '''Indices which sort the points along the Hilbert curve'''
+    return numpy.argsort(hilbert_keys(lats, lons, level=level), kind='mergesort')
@@ -1,17 +1,80 @@
+import array
 import fiona
-import geohash
+import numpy
 import os
 import rtree
 import ujson as json
 
 from collections import OrderedDict, defaultdict
+from shapely import vectorized
 from shapely.geometry import Point, Polygon, MultiPolygon
 from shapely.prepared import prep
 from shapely.geometry.geo import mapping
 
-from geodata.polygons.area import polygon_bounding_box_area
+from geodata.mmap_arrays import write_arrays, MappedArrays, as_numpy_array
+from geodata.polygons.coverage import PolygonCoverage, INSIDE, OUTSIDE, DEFAULT_MAX_CELLS, cell_coords, cell_bounds
+from geodata.polygons.features import read_geojson_features, GeoJSONFeatureReader
+from geodata.polygons.geohash_cover import polygon_geohash_cover, geohash_key, GeohashCellTable, DEFAULT_MAX_COVER_CELLS
+from geodata.polygons.hierarchy import PolygonHierarchy, DEFAULT_HIERARCHY_TOLERANCE
+from geodata.polygons.hilbert import hilbert_order
+from geodata.polygons.raster import PolygonRaster, DEFAULT_MAX_LEVEL as DEFAULT_RASTER_MAX_LEVEL
+from geodata.polygons.resolutions import MultiResolutionPolygons, DEFAULT_RESOLUTION_TOLERANCES
+from geodata.polygons.stats import PolygonIndexStats, geometry_num_coords, timer, DEFAULT_NUM_SLOWEST
+from geodata.polygons.store import (PolygonStore, PolygonStoreWriter, PreparedGeometryCache, DEFAULT_PREPARED_CACHE_SIZE,
+                                    PREPARED_BYTES_PER_COORD, prepared_geometry)
 
-DEFAULT_POLYS_FILENAME = 'polygons.geojson'
+DEFAULT_POLYS_FILENAME = 'polygons.bin'
+GEOJSON_POLYS_FILENAME = 'polygons.geojson'
+COVERAGE_FILENAME = 'coverage.bin'
+HIERARCHY_FILENAME = 'hierarchy.bin'
+RASTER_FILENAME = 'raster.bin'
+PARTS_FILENAME_SUFFIX = '_parts.bin'
+
+# Points in the same cell at this level share one candidate lookup in
+# point_in_poly_batch, cells are roughly 2.5km x 1.2km
+BATCH_LEAF_LEVEL = 14
+
+
+def simplified_polygon_record(args):
+    '''
+    Builds and simplifies a polygon from GeoJSON-like coordinates, meant to
+    be run in worker processes with geodata.parallel.ordered_map so that
+    index builds don't do all their geometry work on one core.
+
+    args is (payload, geometry type, coordinates, simplify tolerance,
+    preserve topology). Returns (payload, parts, polygon) where parts are
+    the polygons to index and polygon the simplified polygon to add, or
+    None if the geometry is not a Polygon/MultiPolygon. payload is any
+    picklable value, passed through as is.
+    '''
+    payload, poly_type, coordinates, simplify_tolerance, preserve_topology = args
+    if poly_type == 'Polygon':
+        poly = Polygon(coordinates[0])
+        parts = [poly]
+    elif poly_type == 'MultiPolygon':
+        parts = [Polygon(coords[0]) for coords in coordinates]
+        poly = MultiPolygon(parts)
+    else:
+        return None
+    return payload, parts, poly.simplify(simplify_tolerance, preserve_topology=preserve_topology)
+
+
+def unique_pairs(point_indices, poly_indices, num_polys, ranks=None):
+    '''
+    (point, polygon) pairs without repeats, in the order the first of each
+    pair occurs in the arrays, or in order of the lowest rank of each pair
+    if ranks are given. Bulk lookups use this to keep the order in which
+    the index returns candidates, as the single point lookups do.
+    '''
+    if ranks is None:
+        ranks = numpy.arange(len(poly_indices))
+    keys = point_indices * num_polys + poly_indices
+    order = numpy.lexsort((ranks, keys))
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = numpy.diff(keys[order]) != 0
+    first = order[first]
+    first = first[numpy.argsort(ranks[first], kind='mergesort')]
+    return point_indices[first], poly_indices[first]
 
 
 class PolygonIndex(object):
@@ -21,9 +84,17 @@ class PolygonIndex(object):
 
     INDEX_FILENAME = None
 
+    # Children may define polygon_priority(properties) returning a number,
+    # candidates are then tested in increasing order of priority
+    polygon_priority = None
+
     def __init__(self, index=None, polygons=None, save_dir=None,
                  index_filename=None,
-                 include_only_properties=None):
+                 include_only_properties=None,
+                 coverage=None,
+                 hierarchy=None,
+                 raster=None,
+                 resolutions=None):
         if save_dir:
             self.save_dir = save_dir
         else:
@@ -47,6 +118,14 @@ class PolygonIndex(object):
         else:
             self.polygons = polygons
 
+        self.coverage = coverage
+        self.hierarchy = hierarchy
+        self.raster = raster
+        self.resolutions = resolutions
+        self.priorities = None
+        # See enable_stats
+        self.stats = None
+
         self.i = 0
 
     def create_index(self, overwrite=False):
@@ -62,7 +141,13 @@ class PolygonIndex(object):
             preserve_topology = self.preserve_topology
         return poly.simplify(simplify_tolerance, preserve_topology=preserve_topology)
 
+    def check_writable(self):
+        '''Raises ValueError before any change to an index whose polygons were loaded from a store'''
+        if isinstance(self.polygons, PolygonStore):
+            raise ValueError('Polygons loaded from a polygon store are read-only')
+
     def add_polygon(self, poly, properties, include_only_properties=None):
+        self.check_writable()
         if include_only_properties is not None:
             properties = {k: v for k, v in properties.iteritems() if k in include_only_properties}
         self.polygons.append((properties, prep(poly)))
@@ -134,7 +219,8 @@ class PolygonIndex(object):
 
     def add_geojson_like_file(self, f, include_only_properties=None):
         '''
-        Add either GeoJSON or a shapefile record to the index
+        Add GeoJSON features or shapefile records from any iterable,
+        e.g. a fiona collection or GeoJSONFeatureReader, to the index
         '''
 
         for rec in f:
@@ -152,31 +238,101 @@ class PolygonIndex(object):
             else:
                 include_props = cls.include_only_properties
 
-            f = json.load(open(input_file))
-
-            index.add_geojson_like_file(f['features'], include_only_properties=include_props)
+            # Streamed, so FeatureCollections or newline-delimited GeoJSON of any size can be used
+            index.add_geojson_like_file(read_geojson_features(input_file), include_only_properties=include_props)
 
         return index
 
-    def save(self, polys_filename=DEFAULT_POLYS_FILENAME):
+    def save(self, polys_filename=DEFAULT_POLYS_FILENAME, build_coverage=False,
+             max_coverage_cells=DEFAULT_MAX_CELLS, build_hierarchy=False,
+             hierarchy_tolerance=DEFAULT_HIERARCHY_TOLERANCE, build_raster=False,
+             raster_max_level=DEFAULT_RASTER_MAX_LEVEL, build_resolutions=False,
+             resolution_tolerances=DEFAULT_RESOLUTION_TOLERANCES):
         self.save_polygons(os.path.join(self.save_dir, polys_filename))
+        if build_coverage:
+            self.save_coverage(os.path.join(self.save_dir, COVERAGE_FILENAME),
+                               max_cells=max_coverage_cells)
+        if build_hierarchy:
+            self.save_hierarchy(os.path.join(self.save_dir, HIERARCHY_FILENAME),
+                                tolerance=hierarchy_tolerance)
+        if build_raster:
+            self.save_raster(os.path.join(self.save_dir, RASTER_FILENAME),
+                             max_level=raster_max_level)
+        if build_resolutions:
+            self.save_resolutions(self.save_dir, tolerances=resolution_tolerances)
         self.save_index()
 
+    def save_coverage(self, out_filename, max_cells=DEFAULT_MAX_CELLS):
+        '''
+        Classify grid cells over each polygon as inside/outside/boundary
+        so that lookups only need exact tests near polygon edges.
+        See geodata.polygons.coverage
+        '''
+        self.coverage = PolygonCoverage.create(self.polygons, max_cells=max_cells)
+        self.coverage.save(out_filename)
+
+    def save_hierarchy(self, out_filename, tolerance=DEFAULT_HIERARCHY_TOLERANCE):
+        '''
+        Link each polygon to the nearest coarser polygon containing it,
+        for hierarchy-aware lookups. See geodata.polygons.hierarchy
+        '''
+        hierarchy = PolygonHierarchy.create(self, tolerance=tolerance)
+        hierarchy.save(out_filename)
+        self.hierarchy = hierarchy
+
+    def save_raster(self, out_filename, max_level=DEFAULT_RASTER_MAX_LEVEL):
+        '''
+        Resolve grid cells away from any polygon boundary to the polygons
+        containing them, so lookups there need no tests at all.
+        See geodata.polygons.raster
+        '''
+        self.raster = PolygonRaster.create(self, max_level=max_level)
+        self.raster.save(out_filename)
+
+    def save_resolutions(self, d, tolerances=DEFAULT_RESOLUTION_TOLERANCES):
+        '''
+        Store coarser versions of each polygon with error bounds so exact
+        tests only need the full geometry near polygon edges.
+        See geodata.polygons.resolutions
+        '''
+        self.resolutions = MultiResolutionPolygons.create(self.polygons, tolerances=tolerances,
+                                                          preserve_topology=self.preserve_topology)
+        self.resolutions.save(d)
+
     def save_polygons(self, out_filename):
-        out = open(out_filename, 'w')
+        '''
+        Write polygons in the binary format in geodata.polygons.store
+        '''
+        writer = PolygonStoreWriter()
         for props, poly in self.polygons:
-            feature = {
-                'type': 'Feature',
-                'geometry': mapping(poly.context),
-                'properties': props
-            }
-            out.write(json.dumps(feature) + u'\n')
+            writer.add(poly.context, props)
+        writer.save(out_filename)
+
+    def save_polygons_geojson(self, out_filename):
+        with open(out_filename, 'w') as out:
+            for props, poly in self.polygons:
+                feature = {
+                    'type': 'Feature',
+                    'geometry': mapping(poly.context),
+                    'properties': dict(props)
+                }
+                out.write(json.dumps(feature) + u'\n')
 
     def save_index(self):
         raise NotImplementedError('Children must implement')
 
     @classmethod
-    def load_polygons(cls, filename):
+    def load_polygons(cls, filename, lazy=False, cache_size=DEFAULT_PREPARED_CACHE_SIZE):
+        '''
+        Memory-map a binary polygon store, geometries are built on access.
+
+        If lazy is True, polygons are only prepared when they're tested,
+        keeping at most cache_size bytes of prepared geometries (LRU).
+        '''
+        return PolygonStore(filename, lazy=lazy, cache_size=cache_size)
+
+    @classmethod
+    def load_polygons_geojson(cls, filename):
         f = open(filename)
         polygons = []
         for line in f:
@@ -200,100 +356,891 @@ class PolygonIndex(object):
         raise NotImplementedError('Children must implement')
 
     @classmethod
-    def load(cls, d, index_name=None, polys_filename=DEFAULT_POLYS_FILENAME):
+    def load(cls, d, index_name=None, polys_filename=DEFAULT_POLYS_FILENAME,
+             lazy=False, cache_size=DEFAULT_PREPARED_CACHE_SIZE, hierarchical=False):
+        '''
+        If hierarchical is True and the index was saved with a hierarchy,
+        lookups descend from the coarsest polygons and skip the children
+        of polygons which don't contain the point.
+        '''
         index = cls.load_index(d, index_name=index_name or cls.INDEX_FILENAME)
-        polys = cls.load_polygons(os.path.join(d, polys_filename))
-        return cls(index=index, polygons=polys, save_dir=d)
+        polys_path = os.path.join(d, polys_filename)
+        geojson_path = os.path.join(d, GEOJSON_POLYS_FILENAME)
+        if not os.path.exists(polys_path) and os.path.exists(geojson_path):
+            # Indexes saved before the binary format was introduced
+            polys = cls.load_polygons_geojson(geojson_path)
+        else:
+            polys = cls.load_polygons(polys_path, lazy=lazy, cache_size=cache_size)
+
+        coverage = None
+        coverage_path = os.path.join(d, COVERAGE_FILENAME)
+        if os.path.exists(coverage_path):
+            coverage = PolygonCoverage.load(coverage_path)
+
+        hierarchy = None
+        hierarchy_path = os.path.join(d, HIERARCHY_FILENAME)
+        if hierarchical and os.path.exists(hierarchy_path):
+            hierarchy = PolygonHierarchy.load(hierarchy_path)
+
+        raster = None
+        raster_path = os.path.join(d, RASTER_FILENAME)
+        if os.path.exists(raster_path):
+            raster = PolygonRaster.load(raster_path)
+
+        resolutions = None
+        if MultiResolutionPolygons.exists(d):
+            resolutions = MultiResolutionPolygons.load(d, cache_size=cache_size)
+
+        index = cls(index=index, polygons=polys, save_dir=d, coverage=coverage,
+                    hierarchy=hierarchy, raster=raster, resolutions=resolutions)
+        index.get_priorities()
+        return index
 
     def get_candidate_polygons(self, lat, lon):
         raise NotImplementedError('Children must implement')
 
+    def get_candidates(self, lat, lon):
+        '''
+        Candidates for a point as (polygon index, parts) in the order they
+        should be tested, where parts is a list of the polygon's part ids
+        to test (see RTreePolygonIndex) or None to test the whole polygon.
+        '''
+        return [(i, None) for i in self.get_candidate_polygons(lat, lon)]
+
+    def get_properties(self, i):
+        if isinstance(self.polygons, PolygonStore):
+            # Avoids building the geometry
+            return self.polygons.properties(i)
+        props, poly = self.polygons[i]
+        return props
+
+    def get_priorities(self):
+        '''
+        Array of polygon_priority for each polygon, computed once per polygon
+        (all at once for a loaded index) rather than on every query
+        '''
+        if self.polygon_priority is None:
+            return None
+
+        if self.priorities is None:
+            self.priorities = array.array('d')
+        for i in xrange(len(self.priorities), len(self.polygons)):
+            self.priorities.append(self.polygon_priority(self.get_properties(i)))
+        return self.priorities
+
+    def sort_candidates(self, candidates):
+        '''
+        Order in which candidate polygons are tested, e.g. smallest admin
+        level first. By default keep the index order unless the index
+        defines polygon_priority.
+        '''
+        priorities = self.get_priorities()
+        if priorities is None:
+            return candidates
+        # Stable, so candidates with equal priority keep the index order
+        return sorted(candidates, key=priorities.__getitem__)
+
+    def get_candidate_polygons_bulk(self, lats, lons):
+        '''
+        Candidate lookup for arrays of points. Returns two parallel arrays
+        (point_indices, polygon_indices) grouped by point, with the
+        candidates for each point in the order they should be tested.
+
+        This generic version calls get_candidate_polygons for each point,
+        indexes which can do the lookup in bulk should override it.
+        '''
+        point_indices = array.array('l')
+        poly_indices = array.array('l')
+        for j in xrange(len(lats)):
+            for i in self.get_candidate_polygons(lats[j], lons[j]):
+                point_indices.append(j)
+                poly_indices.append(i)
+        return (numpy.array(point_indices, dtype=numpy.int64),
+                numpy.array(poly_indices, dtype=numpy.int64))
+
+    def sort_candidates_bulk(self, point_indices, poly_indices):
+        '''
+        Group (point, candidate) pairs by point and order each point's candidates
+        as sort_candidates does: by polygon_priority if the index defines it,
+        otherwise (and between equal priorities) in the order of the pairs,
+        which bulk lookups keep in the order the index returned them.
+        '''
+        if not len(poly_indices):
+            return point_indices, poly_indices
+
+        priorities = self.get_priorities()
+        if priorities is not None:
+            # lexsort is stable, like sorted in sort_candidates
+            order = numpy.lexsort((as_numpy_array(priorities)[poly_indices], point_indices))
+        else:
+            order = numpy.argsort(point_indices, kind='mergesort')
+        return point_indices[order], poly_indices[order]
+
+    def contains_bulk(self, point_indices, poly_indices, lats, lons, part_ids=None):
+        '''
+        Exact containment tests for (point, candidate) pairs. Pairs are grouped
+        by polygon so each polygon is tested against all of its points in a
+        single vectorized call. Returns a boolean mask over the pairs.
+
+        If part_ids is given, pairs with a part id >= 0 are only tested
+        against that part of the polygon (see prepared_part).
+
+        With a hierarchy, pairs are tested one level at a time and pairs
+        whose parent polygon doesn't contain the point are skipped.
+        '''
+        if self.hierarchy is None:
+            return self.test_pairs_bulk(point_indices, poly_indices, lats, lons, part_ids=part_ids)
+
+        def contains(pairs):
+            return self.test_pairs_bulk(point_indices[pairs], poly_indices[pairs], lats, lons,
+                                        part_ids=part_ids[pairs] if part_ids is not None else None)
+
+        return self.hierarchy.contains_bulk(point_indices, poly_indices, contains)
+
+    def test_pairs_bulk(self, point_indices, poly_indices, lats, lons, part_ids=None):
+        contained = numpy.zeros(len(poly_indices), dtype=bool)
+        if not len(poly_indices):
+            return contained
+
+        stats = self.stats
+
+        unresolved = numpy.arange(len(poly_indices))
+        if self.coverage is not None:
+            states = self.coverage.point_states(poly_indices, lats[point_indices], lons[point_indices])
+            contained[states == INSIDE] = True
+            unresolved = numpy.flatnonzero((states != INSIDE) & (states != OUTSIDE))
+            if stats is not None:
+                stats.add_precomputed_test(len(poly_indices) - len(unresolved))
+            if not len(unresolved):
+                return contained
+
+        if self.resolutions is not None:
+            states = self.resolutions.point_states(poly_indices[unresolved], lats[point_indices[unresolved]],
+                                                   lons[point_indices[unresolved]])
+            contained[unresolved[states == INSIDE]] = True
+            if stats is not None:
+                stats.add_precomputed_test(int(numpy.count_nonzero((states == INSIDE) | (states == OUTSIDE))))
+            unresolved = unresolved[(states != INSIDE) & (states != OUTSIDE)]
+            if not len(unresolved):
+                return contained
+
+        if part_ids is None:
+            order = unresolved[numpy.argsort(poly_indices[unresolved], kind='mergesort')]
+            splits = numpy.flatnonzero(numpy.diff(poly_indices[order])) + 1
+        else:
+            order = unresolved[numpy.lexsort((part_ids[unresolved], poly_indices[unresolved]))]
+            splits = numpy.flatnonzero(numpy.diff(poly_indices[order]) | numpy.diff(part_ids[order])) + 1
+
+        for group in numpy.split(order, splits):
+            if stats is not None:
+                start = timer()
+            if part_ids is not None and part_ids[group[0]] >= 0:
+                poly = self.prepared_part(part_ids[group[0]])
+            else:
+                props, poly = self.polygons[poly_indices[group[0]]]
+                poly = prepared_geometry(poly)
+            points = point_indices[group]
+            contained[group] = vectorized.contains(poly, lons[points], lats[points])
+            if stats is not None:
+                stats.add_exact_tests(int(poly_indices[group[0]]), timer() - start, num_points=len(group))
+        return contained
+
+    def prepared_part(self, part_id):
+        raise NotImplementedError('Children must implement')
+
+    def enable_stats(self):
+        '''
+        Start recording lookup statistics (see geodata.polygons.stats),
+        from here on each lookup pays for a few timer calls
+        '''
+        self.stats = PolygonIndexStats()
+
+    def disable_stats(self):
+        self.stats = None
+
+    def polygon_num_coords(self, i):
+        if isinstance(self.polygons, PolygonStore):
+            return self.polygons.num_coords(i)
+        props, poly = self.polygons[i]
+        return geometry_num_coords(prepared_geometry(poly).context)
+
+    def stats_snapshot(self, num_slowest=DEFAULT_NUM_SLOWEST):
+        '''
+        Dict of the statistics recorded since enable_stats, with the id,
+        name and size of the slowest polygons to test, or None if stats
+        aren't enabled
+        '''
+        if self.stats is None:
+            return None
+        snapshot = self.stats.snapshot(num_slowest=num_slowest)
+        for polygon in snapshot['slowest_polygons']:
+            i = polygon['polygon']
+            props = self.get_properties(i)
+            polygon['id'] = props.get('id')
+            polygon['name'] = props.get('name')
+            polygon['num_coords'] = self.polygon_num_coords(i)
+        return snapshot
+
+    def polygon_contains(self, i, poly, lat, lon, pt, parts=None):
+        '''
+        Test whether polygon i contains the point, using the precomputed
+        coverage and coarse resolutions (if any) before falling back to the
+        exact test, either on the given parts or on the whole polygon.
+        '''
+        stats = self.stats
+        if self.coverage is not None:
+            state = self.coverage.point_state(i, lat, lon)
+            if state == INSIDE or state == OUTSIDE:
+                if stats is not None:
+                    stats.add_precomputed_test()
+                return state == INSIDE
+        if self.resolutions is not None:
+            state = self.resolutions.point_state(i, pt)
+            if state == INSIDE or state == OUTSIDE:
+                if stats is not None:
+                    stats.add_precomputed_test()
+                return state == INSIDE
+
+        if stats is None:
+            return self.exact_contains(poly, pt, parts=parts)
+
+        start = timer()
+        contains = self.exact_contains(poly, pt, parts=parts)
+        stats.add_exact_tests(i, timer() - start)
+        return contains
+
+    def exact_contains(self, poly, pt, parts=None):
+        if parts is not None:
+            return any(self.prepared_part(part_id).contains(pt) for part_id in parts)
+        return poly.contains(pt)
+
+    def point_region(self, lat, lon):
+        '''
+        Raster region of the point (see geodata.polygons.raster) or None if
+        the index has no raster or the point is near a boundary.
+
+        Without polygon_priority a region's polygons are in index order,
+        not the order of the candidate lookup, so such indexes don't use it.
+        '''
+        if self.raster is None or self.polygon_priority is None:
+            return None
+        return self.raster.region(lat, lon)
+
+    def region_properties(self, region, return_all=False):
+        matches = self.raster.polygons(region)
+        if not return_all:
+            return self.get_properties(matches[0]) if matches else None
+        return [self.get_properties(i) for i in matches]
+
+    def get_candidates_in_bounds(self, bounds):
+        '''
+        Candidates, as in get_candidates, for every point in the bounding
+        box (min lon, min lat, max lon, max lat), or None if the index
+        can't look up candidates by box
+        '''
+        return None
+
     def point_in_poly(self, lat, lon, return_all=False):
-        polys = self.get_candidate_polygons(lat, lon)
-        pt = Point(lon, lat)
+        if self.stats is not None:
+            return self.point_in_poly_with_stats(lat, lon, return_all=return_all)
+
+        region = self.point_region(lat, lon)
+        if region is not None:
+            return self.region_properties(region, return_all=return_all)
+        return self.test_candidates(lat, lon, self.get_candidates(lat, lon), return_all=return_all)
+
+    def point_in_poly_with_stats(self, lat, lon, return_all=False, candidates=None):
+        '''
+        point_in_poly, recording the query in self.stats. candidates can
+        be given if they were already looked up (see point_in_poly_batch).
+        '''
+        stats = self.stats
+        start = timer()
+
+        region = self.point_region(lat, lon)
+        if region is not None:
+            result = self.region_properties(region, return_all=return_all)
+            stats.add_query(timer() - start, result, raster=True)
+            return result
+
+        if candidates is None:
+            candidates = self.get_candidates(lat, lon)
+            stats.add_candidates(len(candidates), timer() - start)
+
+        test_start = timer()
+        result = self.test_candidates(lat, lon, candidates, return_all=return_all)
+        end = timer()
+        stats.add_query(end - start, result, test_time=end - test_start)
+        return result
+
+    def point_in_poly_batch(self, lats, lons, return_all=False, leaf_level=BATCH_LEAF_LEVEL):
+        '''
+        point_in_poly for a batch of points, returns the results in the
+        original order.
+
+        Points are looked up in Hilbert curve order (see
+        geodata.polygons.hilbert) so consecutive lookups touch the same
+        polygons and pages, and consecutive points in the same grid cell
+        at leaf_level reuse the cell's candidates if the index implements
+        get_candidates_in_bounds.
+        '''
+        results = [[] if return_all else None for j in xrange(len(lats))]
+        if not results:
+            return results
+
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+
+        stats = self.stats
+
+        leaf = None
+        leaf_candidates = None
+        for j in hilbert_order(lats, lons):
+            lat, lon = float(lats[j]), float(lons[j])
+
+            if stats is not None:
+                # Candidate lookups per leaf cell are recorded as they happen,
+                # queries only count the time spent on the point itself
+                cell = cell_coords(lon, lat, leaf_level)
+                if cell != leaf and self.point_region(lat, lon) is None:
+                    leaf = cell
+                    start = timer()
+                    leaf_candidates = self.get_candidates_in_bounds(cell_bounds(leaf_level, *cell))
+                    if leaf_candidates is not None:
+                        stats.add_candidates(len(leaf_candidates), timer() - start)
+                results[j] = self.point_in_poly_with_stats(lat, lon, return_all=return_all,
+                                                           candidates=leaf_candidates)
+                continue
+
+            region = self.point_region(lat, lon)
+            if region is not None:
+                results[j] = self.region_properties(region, return_all=return_all)
+                continue
+
+            cell = cell_coords(lon, lat, leaf_level)
+            if cell != leaf:
+                leaf = cell
+                leaf_candidates = self.get_candidates_in_bounds(cell_bounds(leaf_level, *cell))
+
+            candidates = leaf_candidates if leaf_candidates is not None else self.get_candidates(lat, lon)
+            results[j] = self.test_candidates(lat, lon, candidates, return_all=return_all)
+
+        return results
+
+    def test_candidates(self, lat, lon, candidates, return_all=False, pt=None):
+        '''
+        Properties of the first (or with return_all, every) candidate
+        polygon containing the point. pt is the point as a shapely Point,
+        if the caller already has one.
+        '''
+        if pt is None:
+            pt = Point(lon, lat)
+
+        if self.hierarchy is not None:
+            def contains(i, parts):
+                props, poly = self.polygons[i]
+                return self.polygon_contains(i, poly, lat, lon, pt, parts=parts)
+
+            if not return_all:
+                i = self.hierarchy.first_match(candidates, contains)
+                return self.polygons[i][0] if i is not None else None
+            return [self.polygons[i][0] for i in self.hierarchy.matches(candidates, contains)]
+
         containing = None
         if return_all:
             containing = []
-        for i in polys:
+        for i, parts in candidates:
             props, poly = self.polygons[i]
-            contains = poly.contains(pt)
+            contains = self.polygon_contains(i, poly, lat, lon, pt, parts=parts)
             if contains and not return_all:
                 return props
             elif contains:
                 containing.append(props)
         return containing
 
+    def contained_pairs_bulk(self, lats, lons):
+        '''
+        (point_indices, polygon_indices) for every polygon containing each point,
+        grouped by point in candidate order
+        '''
+        stats = self.stats
+        if stats is not None:
+            start = timer()
+        point_indices, poly_indices = self.get_candidate_polygons_bulk(lats, lons)
+        if stats is not None:
+            stats.add_candidates(len(poly_indices), timer() - start, num_lookups=len(lats))
+
+        contained = self.contains_bulk(point_indices, poly_indices, lats, lons)
+        return point_indices[contained], poly_indices[contained]
+
+    def points_in_polys(self, lats, lons, return_all=False):
+        '''
+        Batch version of point_in_poly for NumPy arrays, array.array buffers
+        or any other sequences of latitudes and longitudes.
+
+        Returns polygon indices rather than properties (self.polygons[i] has
+        the properties). If return_all is False, the result is an array with
+        one polygon index per point, -1 where no polygon contains the point.
+        Otherwise it's a pair of parallel arrays (point_indices, polygon_indices)
+        grouped by point, in the same order point_in_poly would use.
+        '''
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+
+        stats = self.stats
+        if stats is not None:
+            start = timer()
+            candidates_time = stats.candidates_time
+
+        point_indices, poly_indices = self.contained_pairs_bulk(lats, lons)
+
+        if stats is not None:
+            elapsed = timer() - start
+            stats.add_queries(len(lats), len(numpy.unique(point_indices)), elapsed,
+                              test_time=elapsed - (stats.candidates_time - candidates_time))
+
+        if return_all:
+            return point_indices, poly_indices
+
+        ret = numpy.empty(len(lats), dtype=numpy.int64)
+        ret.fill(-1)
+        # Pairs are grouped by point, so the first occurrence is the best match
+        points, first = numpy.unique(point_indices, return_index=True)
+        ret[points] = poly_indices[first]
+        return ret
+
 
 class RTreePolygonIndex(PolygonIndex):
+    '''
+    R-tree over polygon bounding boxes.
+
+    While building, bounding boxes are only collected. The tree is
+    bulk-loaded in one pass (sort-tile-recursive packing in libspatialindex)
+    when the index is saved or first queried, which is much faster than
+    inserting one box at a time and gives a smaller, better packed tree.
+
+    Each part of a MultiPolygon gets its own entry in the tree. Entries are
+    part ids, with arrays mapping each part to its polygon and to its
+    position in the polygon, so a point near an archipelago is only tested
+    against the islands whose bounding boxes contain it rather than the
+    whole MultiPolygon. If the parts indexed for a polygon don't line up
+    with the parts of the geometry that was added (e.g. a MultiPolygon
+    indexed as a whole), the polygon is tested as a whole.
+    '''
+
     INDEX_FILENAME = 'rtree'
+    PARTS_MAGIC = 'RTPT'
+
+    # Bulk-loaded trees are read-only, so nodes can be packed nearly full
+    fill_factor = 0.9
+
+    # Indexes saved before part-level indexing have polygon ids in the tree
+    part_features = None
+    part_numbers = None
+    parts_match = None
+    part_cache = None
 
     def create_index(self, overwrite=False):
-        self.index = rtree.index.Index(self.index_path, overwrite=overwrite)
+        self.index = None
+        self.index_ids = array.array('l')
+        self.index_bounds = array.array('d')
+
+        self.part_features = array.array('l')
+        self.part_numbers = array.array('l')
+        self.parts_match = array.array('B')
+
+    def writable_parts(self):
+        if not isinstance(self.part_features, array.array):
+            self.part_features = array.array('l', self.part_features)
+            self.part_numbers = array.array('l', self.part_numbers)
+            self.parts_match = array.array('B', self.parts_match)
 
     def index_polygon(self, polygon):
-        self.index.insert(self.i, polygon.bounds)
+        self.check_writable()
+        if polygon.type == 'MultiPolygon':
+            for part in polygon:
+                self.index_polygon(part)
+            return
+
+        if self.part_features is None:
+            entry_id = self.i
+        else:
+            self.writable_parts()
+            entry_id = len(self.part_features)
+            if self.part_features and self.part_features[-1] == self.i:
+                part_number = self.part_numbers[-1] + 1
+            else:
+                part_number = 0
+            self.part_features.append(self.i)
+            self.part_numbers.append(part_number)
+
+        if self.index is not None:
+            # Already built or loaded, insert into the existing tree
+            self.index.insert(entry_id, polygon.bounds)
+            return
+        self.index_ids.append(entry_id)
+        self.index_bounds.extend(polygon.bounds)
+
+    def add_polygon(self, poly, properties, include_only_properties=None):
+        self.check_writable()
+        if self.part_features is not None:
+            self.writable_parts()
+            if self.part_features and self.part_features[-1] == self.i:
+                num_indexed = self.part_numbers[-1] + 1
+            else:
+                num_indexed = 0
+
+            if poly.type == 'MultiPolygon':
+                num_parts = len(poly.geoms)
+            elif poly.type == 'Polygon':
+                num_parts = 1
+            else:
+                num_parts = 0
+            self.parts_match.append(num_indexed == num_parts)
+
+        super(RTreePolygonIndex, self).add_polygon(poly, properties, include_only_properties=include_only_properties)
+
+    def index_stream(self):
+        bounds = self.index_bounds
+        for j, i in enumerate(self.index_ids):
+            yield (i, tuple(bounds[j * 4:(j + 1) * 4]), None)
+
+    def build_index(self):
+        props = rtree.index.Property()
+        props.fill_factor = self.fill_factor
+        if self.index_ids:
+            self.index = rtree.index.Index(self.index_path, self.index_stream(),
+                                           properties=props, overwrite=True)
+        else:
+            # libspatialindex can't bulk-load an empty stream
+            self.index = rtree.index.Index(self.index_path, properties=props, overwrite=True)
+
+        self.index_ids = array.array('l')
+        self.index_bounds = array.array('d')
+
+    def get_index(self):
+        if self.index is None:
+            self.build_index()
+        return self.index
+
+    def prepared_part(self, part_id):
+        '''
+        Prepared geometry for a single part of a polygon. Parts are cached
+        in the polygon store's LRU cache in lazy mode, or in a cache of
+        their own otherwise.
+        '''
+        if self.part_cache is None:
+            cache = getattr(self.polygons, 'prepared_cache', None)
+            self.part_cache = cache if cache is not None else PreparedGeometryCache()
+
+        key = ('part', part_id)
+        poly = self.part_cache.get(key)
+        if poly is not None:
+            return poly
+
+        i = self.part_features[part_id]
+        k = self.part_numbers[part_id]
+        if isinstance(self.polygons, PolygonStore):
+            # Only build the part, not the whole polygon
+            part = self.polygons.part(self.polygons.polygon_parts[i] + k)
+        else:
+            props, geometry = self.polygons[i]
+            geometry = geometry.context
+            part = geometry.geoms[k] if geometry.type == 'MultiPolygon' else geometry
+
+        num_coords = len(part.exterior.coords) + sum(len(ring.coords) for ring in part.interiors)
+        poly = prep(part)
+        self.part_cache.put(key, poly, num_coords * PREPARED_BYTES_PER_COORD)
+        return poly
+
+    def get_candidate_parts(self, lat, lon):
+        '''
+        OrderedDict of polygon index => list of candidate part ids
+        '''
+        return self.get_candidate_parts_in_bounds((lon, lat, lon, lat))
+
+    def get_candidate_parts_in_bounds(self, bounds):
+        parts = OrderedDict()
+        for part_id in self.get_index().intersection(bounds):
+            parts.setdefault(int(self.part_features[part_id]), []).append(part_id)
+        return parts
+
+    def get_candidates(self, lat, lon):
+        if self.part_features is None:
+            return super(RTreePolygonIndex, self).get_candidates(lat, lon)
+        return self.get_candidates_in_bounds((lon, lat, lon, lat))
+
+    def get_candidates_in_bounds(self, bounds):
+        return self.entry_candidates(self.get_index().intersection(bounds))
+
+    def entry_candidates(self, entry_ids):
+        '''
+        Candidates, as in get_candidates, for a sequence of entries in the
+        tree (part ids, or polygon ids for indexes without parts)
+        '''
+        if self.part_features is None:
+            candidates = OrderedDict.fromkeys(entry_ids).keys()
+            return [(i, None) for i in self.sort_candidates(candidates)]
+
+        parts = OrderedDict()
+        for part_id in entry_ids:
+            parts.setdefault(int(self.part_features[part_id]), []).append(part_id)
+        return [(i, parts[i] if self.parts_match[i] else None)
+                for i in self.sort_candidates(parts.keys())]
+
+    def index_entries(self):
+        '''(entry id, bounds) for every entry in the tree'''
+        index = self.get_index()
+        for item in index.intersection(index.bounds, objects=True):
+            yield item.id, tuple(item.bbox)
 
     def get_candidate_polygons(self, lat, lon):
-        return OrderedDict.fromkeys(self.index.intersection((lon, lat, lon, lat))).keys()
+        if self.part_features is not None:
+            candidates = self.get_candidate_parts(lat, lon).keys()
+        else:
+            candidates = OrderedDict.fromkeys(self.get_index().intersection((lon, lat, lon, lat))).keys()
+        return self.sort_candidates(candidates)
+
+    def get_candidate_entries_bulk(self, lats, lons):
+        '''
+        Raw R-tree lookup for arrays of points, returns parallel arrays
+        (point_indices, entry ids), entries being part ids or polygon ids
+        for older indexes
+        '''
+        index = self.get_index()
+
+        # Vectorized queries are only available in newer versions of rtree
+        if hasattr(index, 'intersection_v'):
+            coords = numpy.column_stack((lons, lats))
+            ids, counts = index.intersection_v(coords, coords)
+            point_indices = numpy.repeat(numpy.arange(len(lats), dtype=numpy.int64), counts)
+            return point_indices, numpy.asarray(ids, dtype=numpy.int64)
+
+        point_indices = array.array('l')
+        ids = array.array('l')
+        for j in xrange(len(lats)):
+            lat = lats[j]
+            lon = lons[j]
+            for entry_id in index.intersection((lon, lat, lon, lat)):
+                point_indices.append(j)
+                ids.append(entry_id)
+        return (numpy.array(point_indices, dtype=numpy.int64),
+                numpy.array(ids, dtype=numpy.int64))
+
+    def get_candidate_polygons_bulk(self, lats, lons):
+        point_indices, poly_indices = self.get_candidate_entries_bulk(lats, lons)
+        if self.part_features is not None and len(poly_indices):
+            poly_indices = as_numpy_array(self.part_features)[poly_indices]
+
+        # Parts of a MultiPolygon share a polygon, keep each pair once
+        point_indices, poly_indices = unique_pairs(point_indices, poly_indices, max(len(self.polygons), 1))
+        return self.sort_candidates_bulk(point_indices, poly_indices)
+
+    def contained_pairs_bulk(self, lats, lons):
+        if self.part_features is None:
+            return super(RTreePolygonIndex, self).contained_pairs_bulk(lats, lons)
+
+        stats = self.stats
+        if stats is not None:
+            start = timer()
+
+        point_indices, part_ids = self.get_candidate_entries_bulk(lats, lons)
+        if not len(part_ids):
+            if stats is not None:
+                stats.add_candidates(0, timer() - start, num_lookups=len(lats))
+            return point_indices, part_ids
+
+        poly_indices = as_numpy_array(self.part_features)[part_ids]
+
+        # Polygons whose parts weren't indexed separately are tested whole, once per point
+        part_ids[as_numpy_array(self.parts_match)[poly_indices] == 0] = -1
+        order = numpy.lexsort((part_ids, poly_indices, point_indices))
+        point_indices = point_indices[order]
+        poly_indices = poly_indices[order]
+        part_ids = part_ids[order]
+
+        # A polygon is a candidate at the position of its first part in the
+        # tree's results, as in get_candidate_parts
+        same_polygon = (numpy.diff(point_indices) == 0) & (numpy.diff(poly_indices) == 0)
+        starts = numpy.flatnonzero(numpy.concatenate(([True], ~same_polygon)))
+        ranks = numpy.repeat(numpy.minimum.reduceat(order, starts),
+                             numpy.diff(numpy.append(starts, len(order))))
+
+        keep = numpy.ones(len(part_ids), dtype=bool)
+        keep[1:] = ~same_polygon | (numpy.diff(part_ids) != 0)
+        point_indices = point_indices[keep]
+        poly_indices = poly_indices[keep]
+        part_ids = part_ids[keep]
+        ranks = ranks[keep]
+        if stats is not None:
+            stats.add_candidates(len(starts), timer() - start, num_lookups=len(lats))
+
+        contained = self.contains_bulk(point_indices, poly_indices, lats, lons, part_ids=part_ids)
+
+        # A polygon contains the point if any of its candidate parts does
+        point_indices, poly_indices = unique_pairs(point_indices[contained], poly_indices[contained],
+                                                   max(len(self.polygons), 1), ranks=ranks[contained])
+        return self.sort_candidates_bulk(point_indices, poly_indices)
 
     def save_index(self):
+        self.get_index()
         # need to close index before loading it
         self.index.close()
 
+        if self.part_features is not None:
+            write_arrays(self.index_path + PARTS_FILENAME_SUFFIX, self.PARTS_MAGIC, [
+                ('part_features', self.part_features),
+                ('part_numbers', self.part_numbers),
+                ('parts_match', self.parts_match),
+            ])
+
     @classmethod
     def load_index(cls, d, index_name=None):
         return rtree.index.Index(os.path.join(d, index_name or cls.INDEX_FILENAME))
 
+    def load_parts(self, filename):
+        arrays = MappedArrays(filename, self.PARTS_MAGIC)
+        self.part_features = arrays['part_features']
+        self.part_numbers = arrays['part_numbers']
+        self.parts_match = arrays['parts_match']
+
+    @classmethod
+    def load(cls, d, index_name=None, **kw):
+        index = super(RTreePolygonIndex, cls).load(d, index_name=index_name, **kw)
+        parts_path = os.path.join(d, (index_name or cls.INDEX_FILENAME) + PARTS_FILENAME_SUFFIX)
+        if os.path.exists(parts_path):
+            index.load_parts(parts_path)
+        return index
+
 
 class GeohashPolygonIndex(PolygonIndex):
-    # Reference: https://www.elastic.co/guide/en/elasticsearch/guide/current/geohashes.html
-    GEOHASH_PRECISIONS = [
-        (7, 152.8 ** 2),
-        (6, 1200.0 * 610.0),
-        (5, 4900.0 * 4900.0),
-        (4, 39000.0 * 19500.0),
-        (3, 156000.0 * 156000.0),
-        (2, 1251000.0 * 625000.0),
-    ]
-
-    INDEX_FILENAME = 'index.json'
+    '''
+    Index of geohash cells covering each polygon (see geodata.polygons.geohash_cover),
+    stored as a sorted cell -> polygon ids table. A polygon is a candidate for
+    a point if any of its cells contains the point, whatever the cell's level.
 
-    def create_index(self, overwrite=False):
-        self.index = defaultdict(list)
+    Loaded indexes are read-only.
+    '''
+
+    INDEX_FILENAME = 'geohash_index.bin'
+    INDEX_MAGIC = 'GHCT'
 
-    def index_point(self, lat, lon, geohash_level):
-        code = geohash.encode(lat, lon)[:geohash_level]
+    # Indexes saved before the covers, a JSON object of geohash -> polygon ids
+    LEGACY_INDEX_FILENAME = 'index.json'
 
-        for key in [code] + geohash.neighbors(code):
-            self.index[key].append(self.i)
+    max_cover_cells = DEFAULT_MAX_COVER_CELLS
+
+    # Only set for new indexes, loaded ones just have the table
+    cell_keys = None
+    cell_ids = None
+
+    def create_index(self, overwrite=False):
+        self.index = None
+        self.cell_keys = array.array('l')
+        self.cell_ids = array.array('l')
 
     def index_polygon(self, polygon):
-        poly_area = polygon_bounding_box_area(polygon)
-        for geohash_level, area in self.GEOHASH_PRECISIONS:
-            if area * 9.0 >= poly_area:
-                break
+        if self.cell_keys is None:
+            raise ValueError('Loaded geohash indexes are read-only, polygons can only be added to new indexes')
+        for key in polygon_geohash_cover(polygon, max_cells=self.max_cover_cells):
+            self.cell_keys.append(key)
+            self.cell_ids.append(self.i)
+        # Rebuilt on the next query
+        self.index = None
 
-        bbox = polygon.bounds
-        lat, lon = (bbox[1] + bbox[3]) / 2.0, (bbox[0] + bbox[2]) / 2.0
-        self.index_point(lat, lon, geohash_level)
+    def build_index(self):
+        self.index = GeohashCellTable.create(self.cell_keys, self.cell_ids)
 
     def get_candidate_polygons(self, lat, lon, return_all=False):
-        candidates = []
-        code = geohash.encode(lat, lon)
-        for level, area in self.GEOHASH_PRECISIONS:
-            indices = self.index.get(code[:level])
-            if not indices:
-                continue
-            candidates.extend(indices)
-            if not return_all:
-                break
-        return candidates
+        '''
+        return_all is kept for compatibility, with a true cover the candidates
+        for a point are always the polygons of all the cells containing it
+        '''
+        if self.index is None:
+            self.build_index()
+        candidates = OrderedDict.fromkeys(self.index.point_candidates(lat, lon)).keys()
+        return self.sort_candidates(candidates)
+
+    def get_candidates_in_bounds(self, bounds):
+        # Candidates are only known per geohash cell (also takes precedence
+        # over RTreePolygonIndex in mixed classes)
+        return None
+
+    def get_candidate_polygons_bulk(self, lats, lons):
+        if self.index is None:
+            self.build_index()
+
+        point_indices, poly_indices = self.index.points_candidates(lats, lons)
+
+        # Candidates are returned level by level, sort_candidates_bulk groups
+        # them by point keeping that order, as in point_candidates
+        point_indices, poly_indices = unique_pairs(point_indices, poly_indices, max(len(self.polygons), 1))
+        return self.sort_candidates_bulk(point_indices, poly_indices)
 
     def save_index(self):
         if not self.index_path:
             self.index_path = os.path.join(self.save_dir or '.', self.INDEX_FILENAME)
-        json.dump(self.index, open(self.index_path, 'w'))
+        if self.index is None:
+            self.build_index()
+        write_arrays(self.index_path, self.INDEX_MAGIC, [
+            ('cells', self.index.cells),
+            ('indptr', self.index.indptr),
+            ('ids', self.index.ids),
+        ])
 
     @classmethod
     def load_index(cls, d, index_name=None):
-        return json.load(open(os.path.join(d, index_name or cls.INDEX_FILENAME)))
+        index_path = os.path.join(d, index_name or cls.INDEX_FILENAME)
+        legacy_path = os.path.join(d, cls.LEGACY_INDEX_FILENAME)
+        if not os.path.exists(index_path) and os.path.exists(legacy_path):
+            return cls.load_legacy_index(legacy_path)
+        arrays = MappedArrays(index_path, cls.INDEX_MAGIC)
+        return GeohashCellTable(arrays['cells'], arrays['indptr'], arrays['ids'])
+
+    @classmethod
+    def load_legacy_index(cls, filename):
+        '''
+        Table from an index.json saved by older versions, which indexed the
+        geohash cell around the center of each polygon's bounding box and its
+        neighbors. Candidates are those of all the cells containing a point
+        (as with return_all=True in older versions), saving the index again
+        writes the new format.
+        '''
+        keys = array.array('l')
+        ids = array.array('l')
+        for code, polygon_ids in json.load(open(filename)).iteritems():
+            key = geohash_key(code)
+            for i in polygon_ids:
+                keys.append(key)
+                ids.append(i)
+        return GeohashCellTable.create(keys, ids)
+
+
+class PrefetchedPolygonIndex(object):
+    '''
+    Stands in for an index in code that calls point_in_poly one point at
+    a time. Results for a batch of points are computed beforehand with
+    point_in_poly_batch, any other point is looked up in the index. Other
+    attributes are those of the index.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.results = {}
+
+    def __getattr__(self, attr):
+        return getattr(self.index, attr)
+
+    def batch_results(self, lats, lons):
+        return self.index.point_in_poly_batch(lats, lons, return_all=True)
+
+    def prefetch(self, lats, lons):
+        self.results = dict(zip(zip(lats, lons), self.batch_results(lats, lons)))
+
+    def point_in_poly(self, lat, lon, return_all=False):
+        containing = self.results.get((lat, lon))
+        if containing is None:
+            return self.index.point_in_poly(lat, lon, return_all=return_all)
+        elif return_all:
+            return list(containing)
+        return containing[0] if containing else None
@@ -5,6 +5,7 @@ import sys
 this_dir = os.path.realpath(os.path.dirname(__file__))
 sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
 
+from geodata.parallel import ordered_map
 from geodata.polygons.index import *
 from geodata.i18n.languages import *
 
@@ -33,20 +34,36 @@ class LanguagePolygonIndex(RTreePolygonIndex):
                                admin1_region_file,
                                output_dir,
                                index_filename=None,
-                               polys_filename=DEFAULT_POLYS_FILENAME):
+                               polys_filename=DEFAULT_POLYS_FILENAME,
+                               num_workers=1):
+        '''
+        Polygons are built and simplified in num_workers processes
+        (serially by default), see geodata.parallel
+        '''
 
         init_languages()
         index = cls(save_dir=output_dir, index_filename=index_filename)
 
-        i = 0
+        # Ordering of the files is important here as we want to match
+        # the most granular admin polygon first for regional languages. Currently
+        # most regional languages as they would apply to street signage are regional in
+        # terms of an admin 1 level (states, provinces, regions)
+        records = cls.shapefile_records(index, (admin0_shapefile, admin1_region_file, admin1_shapefile))
+        for result in ordered_map(simplified_polygon_record, records, num_workers=num_workers):
+            properties, parts, poly = result
+            for part in parts:
+                index.index_polygon(part)
+            index.add_polygon(poly, properties)
+
+        return index
 
+    @classmethod
+    def shapefile_records(cls, index, input_files):
         '''
-        Ordering of the files is important here as we want to match
-        the most granular admin polygon first for regional languages. Currently
-        most regional languages as they would apply to street signage are regional in
-        terms of an admin 1 level (states, provinces, regions)
+        Admin polygons with their languages from Quattroshapes shapefiles,
+        as arguments to simplified_polygon_record
         '''
-        for input_file in (admin0_shapefile, admin1_region_file, admin1_shapefile):
+        for input_file in input_files:
             f = fiona.open(input_file)
 
             for rec in f:
@@ -103,46 +120,30 @@ class LanguagePolygonIndex(RTreePolygonIndex):
                 properties['admin_level'] = level_num
 
                 poly_type = rec['geometry']['type']
-                if poly_type == 'Polygon':
-                    poly = Polygon(rec['geometry']['coordinates'][0])
-                    index.index_polygon(poly)
-                    poly = index.simplify_polygon(poly)
-                    index.add_polygon(poly, dict(rec['properties']))
-                elif poly_type == 'MultiPolygon':
-                    polys = []
-                    for coords in rec['geometry']['coordinates']:
-                        poly = Polygon(coords[0])
-                        polys.append(poly)
-                        index.index_polygon(poly)
-
-                    multi_poly = index.simplify_polygon(MultiPolygon(polys))
-                    index.add_polygon(multi_poly, dict(rec['properties']))
-                else:
+                if poly_type not in ('Polygon', 'MultiPolygon'):
                     continue
 
-                i += 1
-        return index
+                yield (dict(rec['properties']), poly_type, rec['geometry']['coordinates'],
+                       index.simplify_tolerance, index.preserve_topology)
 
     @classmethod
     def create_with_quattroshapes(cls, quattroshapes_dir,
                                   output_dir,
                                   index_filename=None,
-                                  polys_filename=DEFAULT_POLYS_FILENAME):
+                                  polys_filename=DEFAULT_POLYS_FILENAME,
+                                  num_workers=1):
         admin0_filename = os.path.join(quattroshapes_dir, 'qs_adm0.shp')
         admin1_filename = os.path.join(quattroshapes_dir, 'qs_adm1.shp')
         admin1r_filename = os.path.join(quattroshapes_dir, 'qs_adm1_region.shp')
 
         return cls.create_from_shapefiles(admin0_filename, admin1_filename, admin1r_filename,
                                           output_dir, index_filename=index_filename,
-                                          polys_filename=polys_filename)
+                                          polys_filename=polys_filename,
+                                          num_workers=num_workers)
 
-    def admin_level(self, i):
-        props, p = self.polygons[i]
-        return props['admin_level']
-
-    def get_candidate_polygons(self, lat, lon):
-        candidates = OrderedDict.fromkeys(self.index.intersection((lon, lat, lon, lat))).keys()
-        return sorted(candidates, key=self.admin_level, reverse=True)
+    def polygon_priority(self, props):
+        # Highest admin level first
+        return -props['admin_level']
 
 
 if __name__ == '__main__':
@@ -156,6 +157,33 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('-c', '--coverage',
+                        action='store_true',
+                        default=False,
+                        help='Precompute inside/outside cells so most lookups skip exact tests')
+
+    parser.add_argument('-j', '--workers',
+                        type=int,
+                        default=1,
+                        help='Processes for building/simplifying polygons (default: 1, serial)')
+
+    parser.add_argument('-r', '--raster',
+                        action='store_true',
+                        default=False,
+                        help='Precompute a raster resolving most points without any polygon tests')
+
+    parser.add_argument('--raster-max-level',
+                        type=int,
+                        default=DEFAULT_RASTER_MAX_LEVEL,
+                        help='Finest raster level, cells at level 15 are about 0.01 degrees wide')
+
+    parser.add_argument('-m', '--multi-resolution',
+                        action='store_true',
+                        default=False,
+                        help='Store coarse polygons with error bounds, full geometries are only tested near edges')
+
     args = parser.parse_args()
-    index = LanguagePolygonIndex.create_with_quattroshapes(args.quattroshapes_dir, args.out_dir)
-    index.save()
+    index = LanguagePolygonIndex.create_with_quattroshapes(args.quattroshapes_dir, args.out_dir,
+                                                           num_workers=args.workers)
+    index.save(build_coverage=args.coverage, build_raster=args.raster,
+               raster_max_level=args.raster_max_level, build_resolutions=args.multi_resolution)
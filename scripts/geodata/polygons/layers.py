@@ -0,0 +1,166 @@
+'''
+geodata.polygons.layers
+-----------------------
+
+Reverse geocoding against several polygon indexes (layers) in one query.
+
+Looking a point up in, say, the language, OSM admin, Quattroshapes and
+neighborhoods indexes separately walks four R-trees and builds four
+Points. MultiLayerPolygonIndex copies the entries of every layer's tree
+into a single R-tree, tagged with the layer they came from, so one
+traversal finds the candidates for all the layers. Each layer's
+candidates are then sorted and tested by the layer itself (priorities,
+parts, coverage, coarse resolutions and hierarchies all apply as usual)
+against one shared Point.
+
+Layers are resolved lazily: point_in_layers returns a PointLayers mapping
+whose values are only tested on first access, so a layer that isn't
+needed for a given point costs nothing beyond the shared traversal.
+Layers with a raster resolve points away from their boundaries from the
+raster, and layers which aren't R-tree indexes (GeohashPolygonIndex,
+PrefetchedPolygonIndex wrappers, etc.) are looked up with point_in_poly.
+
+Usage:
+    >>> layers = MultiLayerPolygonIndex([('language', language_rtree), ('admin', osm_rtree)])
+    >>> result = layers.point_in_layers(40.74, -74.0)
+    >>> result['admin']
+'''
+
+import array
+import rtree
+
+from collections import defaultdict
+from shapely.geometry import Point
+
+from geodata.polygons.index import RTreePolygonIndex
+
+
+class PointLayers(object):
+    '''
+    Mapping of layer name => properties of every polygon in the layer
+    containing the point, in the order of point_in_poly(return_all=True),
+    looked up on first access
+    '''
+
+    def __init__(self, names, lat, lon):
+        self.names = names
+        self.lat = lat
+        self.lon = lon
+        self.results = {}
+
+    def lookup(self, name):
+        raise NotImplementedError('Children must implement')
+
+    def __getitem__(self, name):
+        result = self.results.get(name)
+        if result is None:
+            if name not in self.names:
+                raise KeyError(name)
+            result = self.results[name] = self.lookup(name)
+        return result
+
+    def get(self, name, default=None):
+        if name not in self.names:
+            return default
+        return self[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+
+class SeparatePointLayers(PointLayers):
+    '''Each layer looked up in its own index'''
+
+    def __init__(self, indexes, lat, lon):
+        super(SeparatePointLayers, self).__init__(indexes.keys(), lat, lon)
+        self.indexes = indexes
+
+    def lookup(self, name):
+        return self.indexes[name].point_in_poly(self.lat, self.lon, return_all=True)
+
+
+class SharedPointLayers(PointLayers):
+    '''Layers sharing one traversal of a MultiLayerPolygonIndex'''
+
+    def __init__(self, layer_index, lat, lon):
+        super(SharedPointLayers, self).__init__(layer_index.names, lat, lon)
+        self.layer_index = layer_index
+        self.pt = Point(lon, lat)
+        self.entries = None
+
+    def lookup(self, name):
+        index = self.layer_index.layers[name]
+        if name not in self.layer_index.tree_layers:
+            return index.point_in_poly(self.lat, self.lon, return_all=True)
+
+        region = index.point_region(self.lat, self.lon)
+        if region is not None:
+            return index.region_properties(region, return_all=True)
+
+        if self.entries is None:
+            self.entries = self.layer_index.layer_entries(self.lat, self.lon)
+        candidates = index.entry_candidates(self.entries.get(name, ()))
+        return index.test_candidates(self.lat, self.lon, candidates, return_all=True, pt=self.pt)
+
+
+class MultiLayerPolygonIndex(object):
+    '''
+    layers is a sequence of (name, index). The combined tree is built in
+    memory from the layers' trees when the object is created.
+    '''
+
+    fill_factor = RTreePolygonIndex.fill_factor
+
+    def __init__(self, layers):
+        self.names = [name for name, index in layers]
+        self.layers = dict(layers)
+        self.tree_layers = set([name for name, index in layers
+                                if isinstance(index, RTreePolygonIndex)])
+        self.build_index()
+
+    def index_stream(self):
+        for layer, name in enumerate(self.names):
+            if name not in self.tree_layers:
+                continue
+            for entry_id, bounds in self.layers[name].index_entries():
+                yield (len(self.entry_ids), bounds, None)
+                self.entry_layers.append(layer)
+                self.entry_ids.append(entry_id)
+
+    def build_index(self):
+        # Layer number and entry id in the layer's own tree, by entry id in the combined tree
+        self.entry_layers = array.array('l')
+        self.entry_ids = array.array('l')
+
+        props = rtree.index.Property()
+        props.fill_factor = self.fill_factor
+        stream = self.index_stream()
+        try:
+            first = next(stream)
+        except StopIteration:
+            # libspatialindex can't bulk-load an empty stream
+            self.index = rtree.index.Index(properties=props)
+            return
+
+        def entries():
+            yield first
+            for entry in stream:
+                yield entry
+
+        self.index = rtree.index.Index(entries(), properties=props)
+
+    def layer_entries(self, lat, lon):
+        '''Dict of layer name => entry ids in the layer's tree whose bounds contain the point'''
+        entries = defaultdict(list)
+        for j in self.index.intersection((lon, lat, lon, lat)):
+            entries[self.names[self.entry_layers[j]]].append(self.entry_ids[j])
+        return entries
+
+    def point_in_layers(self, lat, lon):
+        return SharedPointLayers(self, lat, lon)
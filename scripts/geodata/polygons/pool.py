@@ -0,0 +1,145 @@
+'''
+geodata.polygons.pool
+---------------------
+
+Process pool for batched point-in-polygon lookups over one or more saved
+polygon indexes.
+
+A loaded index holding Python dicts and shapely objects can't be shared
+between forked processes: reference count updates touch every page, so
+copy-on-write ends up copying the whole thing into each worker. Here each
+worker loads the indexes itself after the fork in lazy mode, where
+coordinates and properties stay in the memory-mapped polygon store (see
+geodata.polygons.store), so all the workers share a single copy through
+the page cache and only keep a bounded LRU of prepared geometries each.
+
+Usage:
+    >>> pool = PolygonIndexPool({'osm': (OSMReverseGeocoder, '/data/rtree')}, num_workers=8)
+    >>> pool.point_in_poly_batch('osm', lats, lons, return_all=True)
+'''
+
+import multiprocessing
+import numpy
+
+from geodata.polygons.hilbert import hilbert_order
+from geodata.polygons.index import PrefetchedPolygonIndex
+from geodata.polygons.store import DEFAULT_PREPARED_CACHE_SIZE
+
+# Indexes loaded in each worker process by init_worker
+worker_indexes = None
+
+
+def load_indexes(specs, cache_size=DEFAULT_PREPARED_CACHE_SIZE):
+    indexes = {}
+    for name, spec in specs.iteritems():
+        index_cls, index_dir = spec[:2]
+        load_kw = spec[2] if len(spec) > 2 else {}
+        indexes[name] = index_cls.load(index_dir, lazy=True, cache_size=cache_size, **load_kw)
+    return indexes
+
+
+def init_worker(specs, cache_size):
+    global worker_indexes
+    worker_indexes = load_indexes(specs, cache_size=cache_size)
+
+
+def worker_points_in_polys(args):
+    name, lats, lons, return_all = args
+    return worker_indexes[name].points_in_polys(lats, lons, return_all=return_all)
+
+
+class PolygonIndexPool(object):
+    '''
+    specs is a dict of name => (index class, index directory) or
+    (index class, index directory, dict of extra arguments to load).
+
+    cache_size is the prepared geometry budget of each worker, per index.
+    The pool process keeps its own lazily loaded copy of the indexes,
+    only used to look up properties.
+    '''
+
+    def __init__(self, specs, num_workers=None, cache_size=DEFAULT_PREPARED_CACHE_SIZE):
+        self.specs = specs
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        # Properties are read from the store, no need for prepared geometries here
+        self.indexes = load_indexes(specs, cache_size=0)
+        self.pool = multiprocessing.Pool(self.num_workers, initializer=init_worker,
+                                         initargs=(specs, cache_size))
+
+    def chunks(self, n):
+        chunk_size = max((n + self.num_workers - 1) // self.num_workers, 1)
+        for start in xrange(0, n, chunk_size):
+            yield start, min(start + chunk_size, n)
+
+    def points_in_polys(self, name, lats, lons, return_all=False):
+        '''
+        Same as PolygonIndex.points_in_polys on the index called name, with
+        the points split evenly between the workers. Points are sorted
+        along a Hilbert curve first so each worker gets a compact area
+        (see geodata.polygons.hilbert).
+        '''
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+
+        order = hilbert_order(lats, lons)
+        lats = lats[order]
+        lons = lons[order]
+
+        chunks = list(self.chunks(len(lats)))
+        results = self.pool.map(worker_points_in_polys,
+                                [(name, lats[start:end], lons[start:end], return_all)
+                                 for start, end in chunks])
+
+        if not return_all:
+            contained = numpy.empty(len(lats), dtype=numpy.int64)
+            if results:
+                contained[order] = numpy.concatenate(results)
+            return contained
+
+        point_indices = [order[p + start] for (start, end), (p, i) in zip(chunks, results)]
+        poly_indices = [i for p, i in results]
+        if not point_indices:
+            return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+        return numpy.concatenate(point_indices), numpy.concatenate(poly_indices)
+
+    def point_in_poly_batch(self, name, lats, lons, return_all=False):
+        '''
+        Batch version of point_in_poly, returns one result per point:
+        the properties of the best match (or None) or, if return_all is
+        True, a list of the properties of every matching polygon
+        '''
+        index = self.indexes[name]
+
+        if not return_all:
+            return [index.get_properties(i) if i >= 0 else None
+                    for i in self.points_in_polys(name, lats, lons)]
+
+        point_indices, poly_indices = self.points_in_polys(name, lats, lons, return_all=True)
+        results = [[] for j in xrange(len(lats))]
+        for j, i in zip(point_indices, poly_indices):
+            results[j].append(index.get_properties(i))
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class PooledPolygonIndex(PrefetchedPolygonIndex):
+    '''
+    PrefetchedPolygonIndex for one of the pool's indexes, batches are
+    computed by the pool's workers and any other point is looked up in
+    the pool process's own copy of the index.
+    '''
+
+    def __init__(self, pool, name):
+        super(PooledPolygonIndex, self).__init__(pool.indexes[name])
+        self.pool = pool
+        self.name = name
+
+    def batch_results(self, lats, lons):
+        return self.pool.point_in_poly_batch(self.name, lats, lons, return_all=True)
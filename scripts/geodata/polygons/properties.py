@@ -0,0 +1,207 @@
+'''
+geodata.polygons.properties
+---------------------------
+
+Interned, column-oriented storage for the properties of the polygons in
+a polygon store (see geodata.polygons.store).
+
+OSM admin boundaries and neighborhoods carry dozens of name:*,
+official_name:*, wikipedia:*, etc. tags each, so keeping one dict per
+polygon means the same key strings and many of the same values (admin
+levels, boundary types, language codes...) are stored millions of times.
+
+Here every distinct key and every distinct value is stored once, in a key
+pool and a value pool, and the properties of all polygons are two columns
+of (key id, value id) entries with an offset table per polygon, sorted
+by key id within a polygon. Strings are stored as UTF-8, other values as
+JSON.
+
+Properties are exposed through PropertyView, a read-only mapping which
+only holds a reference to the table and the polygon number until it's
+first read, and then decodes all of the polygon's properties at once.
+Decoded strings are shared by all the polygons which use them.
+'''
+
+import array
+import numpy
+import ujson as json
+
+from collections import Mapping
+
+from geodata.encoding import safe_decode, safe_encode
+
+STRING_VALUE, JSON_VALUE = range(1, 3)
+
+
+class StringPoolWriter(object):
+    '''Deduplicated byte strings with CSR-style offsets'''
+
+    def __init__(self):
+        self.ids = {}
+        self.indptr = array.array('l', [0])
+        self.data = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, s):
+        string_id = self.ids.get(s)
+        if string_id is None:
+            string_id = self.ids[s] = len(self.ids)
+            self.data.append(s)
+            self.size += len(s)
+            self.indptr.append(self.size)
+        return string_id
+
+
+class PropertyTableWriter(object):
+    def __init__(self):
+        self.keys = StringPoolWriter()
+        self.values = StringPoolWriter()
+        self.value_types = array.array('B')
+
+        self.indptr = array.array('l', [0])
+        self.entry_keys = array.array('I')
+        self.entry_values = array.array('I')
+
+    def value_id(self, value):
+        if isinstance(value, basestring):
+            value_type, encoded = STRING_VALUE, safe_encode(value)
+        else:
+            value_type, encoded = JSON_VALUE, json.dumps(value)
+
+        # The type is part of the interned string so that e.g. u'1' and 1 don't collide
+        num_values = len(self.values)
+        value_id = self.values.add(chr(value_type) + encoded)
+        if value_id == num_values:
+            self.value_types.append(value_type)
+        return value_id
+
+    def add(self, properties):
+        entries = sorted((self.keys.add(safe_encode(k)), self.value_id(v))
+                         for k, v in properties.iteritems())
+        for key_id, value_id in entries:
+            self.entry_keys.append(key_id)
+            self.entry_values.append(value_id)
+        self.indptr.append(len(self.entry_keys))
+
+    def arrays(self):
+        '''Named arrays to be written with geodata.mmap_arrays.write_arrays'''
+        return [
+            ('property_indptr', self.indptr),
+            ('property_keys', self.entry_keys),
+            ('property_values', self.entry_values),
+            ('key_indptr', self.keys.indptr),
+            ('key_data', ''.join(self.keys.data)),
+            ('value_types', self.value_types),
+            # Strip the type prefix added for interning
+            ('value_indptr', numpy.array(self.values.indptr, dtype=numpy.int64) - numpy.arange(len(self.values) + 1)),
+            ('value_data', ''.join(v[1:] for v in self.values.data)),
+        ]
+
+
+class PropertyTable(object):
+    '''
+    Read-only property table over the arrays written by PropertyTableWriter
+    (normally memory-mapped). Only the keys, of which there are few, are
+    decoded up front.
+    '''
+
+    def __init__(self, arrays):
+        self.indptr = arrays['property_indptr']
+        self.entry_keys = arrays['property_keys']
+        self.entry_values = arrays['property_values']
+        self.value_types = arrays['value_types']
+        self.value_indptr = arrays['value_indptr']
+        self.value_data = arrays['value_data']
+
+        key_indptr = arrays['key_indptr']
+        key_data = arrays['key_data'].tostring()
+        self.keys = [safe_decode(key_data[key_indptr[k]:key_indptr[k + 1]])
+                     for k in xrange(len(key_indptr) - 1)]
+
+        # Decoded string values by value id, JSON values are decoded every
+        # time so that polygons don't share mutable lists or dicts
+        self.strings = {}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return PropertyView(self, i)
+
+    def value(self, value_id):
+        value = self.strings.get(value_id)
+        if value is not None:
+            return value
+
+        start, end = self.value_indptr[value_id], self.value_indptr[value_id + 1]
+        data = self.value_data[start:end].tostring()
+        if self.value_types[value_id] == STRING_VALUE:
+            value = self.strings[value_id] = safe_decode(data)
+            return value
+        return json.loads(data)
+
+    def properties(self, i):
+        '''Properties of polygon i as a dict'''
+        keys, values = self.entries(i)
+        return {self.keys[key_id]: self.value(value_id)
+                for key_id, value_id in zip(keys.tolist(), values.tolist())}
+
+    def entries(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.entry_keys[start:end], self.entry_values[start:end]
+
+
+class PropertyView(Mapping):
+    '''
+    Read-only mapping of the properties of polygon i in a PropertyTable,
+    usable in place of the dict of properties of an in-memory index.
+    The properties are decoded into a dict the first time the view is
+    read, so repeated lookups cost the same as with a dict. Use copy()
+    for a mutable copy.
+    '''
+    __slots__ = ('table', 'i', '_decoded')
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+        self._decoded = None
+
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = self.table.properties(self.i)
+        return self._decoded
+
+    def __getitem__(self, key):
+        return self.decoded()[key]
+
+    def get(self, key, default=None):
+        return self.decoded().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.decoded()
+
+    def __len__(self):
+        return len(self.decoded())
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def iteritems(self):
+        return self.decoded().iteritems()
+
+    def items(self):
+        return self.decoded().items()
+
+    def copy(self):
+        '''A dict of the properties, like dict.copy for in-memory indexes'''
+        return dict(self.decoded())
+
+    def __reduce__(self):
+        # Pickles (e.g. to other processes) as a plain dict
+        return (dict, (self.copy(),))
+
+    def __repr__(self):
+        return repr(self.decoded())
@@ -0,0 +1,203 @@
+'''
+geodata.polygons.raster
+-----------------------
+
+Adaptive quadtree raster resolving points to the full set of polygons of
+an index containing them, for indexes of large, rarely changing regions
+like the language polygons (countries and admin 1 regions), where nearly
+every point is far from any boundary.
+
+The world is split into a fixed grid of 2^base_level x 2^base_level
+lon/lat cells (the same cells as geodata.polygons.coverage). A cell that
+isn't crossed by any polygon boundary is resolved: every point in it is
+contained in the same polygons. Cells on a boundary are subdivided down
+to max_level (level 15 cells are roughly 0.01 x 0.005 degrees), after
+which, or once the node budget is spent, they're left unresolved and
+points in them need exact tests.
+
+Each distinct set of polygons is stored once as a region, in the order
+point_in_poly would return them. Grid and node entries are int32:
+
+    >= 0: region id
+      -1: unresolved, use exact tests
+    <= -2: quadtree node -2 - entry, whose 4 children are nodes[4 * node:4 * node + 4]
+
+so a lookup is one grid access plus at most max_level - base_level node
+accesses.
+'''
+
+import array
+import numpy
+
+from shapely.geometry import box
+
+from geodata.mmap_arrays import write_arrays, MappedArrays
+from geodata.polygons.coverage import cell_coords, cell_bounds
+from geodata.polygons.store import prepared_geometry
+
+RASTER_MAGIC = 'PRST'
+
+UNRESOLVED = -1
+
+DEFAULT_BASE_LEVEL = 8
+DEFAULT_MAX_LEVEL = 15
+DEFAULT_MAX_NODES = 1 << 20
+
+
+def node_entry(node):
+    return -2 - node
+
+
+def classify_cell(polys, bounds, level, x, y, inside, boundary):
+    '''
+    Split the polygons in boundary (crossing the parent cell) into those
+    containing cell (level, x, y), which are added to inside, and those
+    still crossing it. Polygons not touching the cell are dropped.
+    '''
+    xmin, ymin, xmax, ymax = cell_bounds(level, x, y)
+    cell = box(xmin, ymin, xmax, ymax)
+
+    inside = list(inside)
+    crossing = []
+    for i in boundary:
+        b = bounds[i]
+        if b[0] > xmax or b[2] < xmin or b[1] > ymax or b[3] < ymin:
+            continue
+        poly = polys[i]
+        if poly.contains_properly(cell):
+            inside.append(i)
+        elif poly.intersects(cell):
+            crossing.append(i)
+    return inside, crossing
+
+
+class PolygonRaster(object):
+    def __init__(self, grid, nodes, region_indptr, region_polygons, base_level, max_level):
+        self.grid = grid
+        self.nodes = nodes
+        self.region_indptr = region_indptr
+        self.region_polygons = region_polygons
+        self.base_level = base_level
+        self.max_level = max_level
+
+        # Values derived from a region's polygons by callers, e.g. the
+        # resolved languages in geodata.language_id.polygon_lookup
+        self.results = {}
+
+    @classmethod
+    def create(cls, index, base_level=DEFAULT_BASE_LEVEL, max_level=DEFAULT_MAX_LEVEL,
+               max_nodes=DEFAULT_MAX_NODES):
+        '''
+        Build the raster for a PolygonIndex. Regions are ordered with the
+        index's sort_candidates.
+        '''
+        polys = []
+        bounds = []
+        for props, poly in index.polygons:
+            poly = prepared_geometry(poly)
+            polys.append(poly)
+            bounds.append(poly.context.bounds if not poly.context.is_empty else (1.0, 1.0, -1.0, -1.0))
+
+        regions = {}
+        region_polygons = []
+
+        def region_id(inside):
+            key = tuple(sorted(inside))
+            region = regions.get(key)
+            if region is None:
+                region = regions[key] = len(regions)
+                region_polygons.append(index.sort_candidates(list(key)))
+            return region
+
+        n = 1 << base_level
+        grid = numpy.empty((n, n), dtype=numpy.int32)
+
+        # Cells at base_level still crossed by a boundary, as
+        # (target array, slot, x, y, polygons inside, polygons crossing)
+        pending = []
+
+        def descend(level, x, y, inside, crossing):
+            inside, crossing = classify_cell(polys, bounds, level, x, y, inside, crossing)
+            if crossing and level < base_level:
+                for dx in (0, 1):
+                    for dy in (0, 1):
+                        descend(level + 1, 2 * x + dx, 2 * y + dy, inside, crossing)
+            elif crossing:
+                pending.append((grid.ravel(), x * n + y, x, y, inside, crossing))
+            else:
+                size = 1 << (base_level - level)
+                grid[x * size:(x + 1) * size, y * size:(y + 1) * size] = region_id(inside)
+
+        descend(0, 0, 0, [], range(len(polys)))
+
+        # Subdivide boundary cells breadth-first so the node budget is
+        # spent evenly rather than on the first cells visited
+        nodes = array.array('i')
+        level = base_level
+        while pending:
+            next_pending = []
+            for target, slot, x, y, inside, crossing in pending:
+                if level >= max_level or len(nodes) // 4 >= max_nodes:
+                    target[slot] = UNRESOLVED
+                    continue
+
+                node = len(nodes) // 4
+                target[slot] = node_entry(node)
+                nodes.extend([UNRESOLVED] * 4)
+
+                for dx in (0, 1):
+                    for dy in (0, 1):
+                        cx, cy = 2 * x + dx, 2 * y + dy
+                        child_slot = 4 * node + 2 * dx + dy
+                        child_inside, child_crossing = classify_cell(polys, bounds, level + 1, cx, cy,
+                                                                     inside, crossing)
+                        if child_crossing:
+                            next_pending.append((nodes, child_slot, cx, cy, child_inside, child_crossing))
+                        else:
+                            nodes[child_slot] = region_id(child_inside)
+            pending = next_pending
+            level += 1
+
+        region_indptr = numpy.cumsum([0] + [len(r) for r in region_polygons]).astype(numpy.int64)
+        region_polygons = numpy.array([i for r in region_polygons for i in r], dtype=numpy.int64)
+
+        return cls(grid, numpy.frombuffer(nodes, dtype=numpy.int32) if nodes else numpy.empty(0, dtype=numpy.int32),
+                   region_indptr, region_polygons, base_level, max_level)
+
+    def save(self, filename):
+        write_arrays(filename, RASTER_MAGIC, [
+            ('grid', self.grid),
+            ('nodes', self.nodes),
+            ('region_indptr', self.region_indptr),
+            ('region_polygons', self.region_polygons),
+        ], metadata={'base_level': self.base_level, 'max_level': self.max_level})
+
+    @classmethod
+    def load(cls, filename):
+        arrays = MappedArrays(filename, RASTER_MAGIC)
+        return cls(arrays['grid'], arrays['nodes'], arrays['region_indptr'], arrays['region_polygons'],
+                   arrays.metadata['base_level'], arrays.metadata['max_level'])
+
+    def __len__(self):
+        return len(self.region_indptr) - 1
+
+    def region(self, lat, lon):
+        '''
+        Region id of the cell containing the point or None if the cell is
+        unresolved and the point needs exact tests
+        '''
+        level = self.base_level
+        x, y = cell_coords(lon, lat, level)
+        entry = int(self.grid[x, y])
+        while entry < UNRESOLVED:
+            node = -2 - entry
+            level += 1
+            x, y = cell_coords(lon, lat, level)
+            entry = int(self.nodes[4 * node + 2 * (x & 1) + (y & 1)])
+        if entry == UNRESOLVED:
+            return None
+        return entry
+
+    def polygons(self, region):
+        '''Indices of the polygons containing every point of a region, in priority order'''
+        return self.region_polygons[self.region_indptr[region]:self.region_indptr[region + 1]].tolist()
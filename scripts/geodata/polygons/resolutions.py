@@ -0,0 +1,193 @@
+'''
+geodata.polygons.resolutions
+----------------------------
+
+Coarser versions of the polygons in an index, each with an error bound,
+so most point-in-polygon tests never touch the full-resolution geometry.
+
+For each polygon and each coarse tolerance (coarsest first), we store the
+polygon simplified at that tolerance plus an error band: the coarse
+boundary buffered by an error bound e such that the coarse and full
+polygons only differ inside the band, which is checked when the band is
+built (e starts at the Hausdorff distance between the two boundaries and
+is doubled if needed). A point outside the band is in the full polygon
+if and only if it's in the coarse one. Points inside the band go on to
+the next, finer resolution and finally to the full geometry.
+
+Since the band test and the coarse test only use small geometries, full
+geometries are only built and prepared for polygons that have points
+near their edges, which in lazy mode keeps them out of memory entirely
+for most polygons.
+
+Each resolution is saved as a pair of polygon stores (see
+geodata.polygons.store), coarse polygons and bands, aligned with the
+index's polygons, plus an array of error bounds.
+'''
+
+import numpy
+import os
+
+from shapely import vectorized
+from shapely.geometry import box
+from shapely.geos import TopologicalError
+from shapely.prepared import prep
+
+from geodata.mmap_arrays import write_arrays, MappedArrays
+from geodata.polygons.coverage import BOUNDARY, INSIDE, OUTSIDE
+from geodata.polygons.store import PolygonStore, PolygonStoreWriter, prepared_geometry, DEFAULT_PREPARED_CACHE_SIZE
+
+RESOLUTIONS_MAGIC = 'PRES'
+
+RESOLUTIONS_FILENAME = 'resolutions.bin'
+COARSE_FILENAME = 'resolution_{}.bin'
+BAND_FILENAME = 'resolution_{}_band.bin'
+
+# Coarsest first, in degrees
+DEFAULT_RESOLUTION_TOLERANCES = (0.01, 0.001)
+
+# Widen the band a little since buffers approximate arcs with chords
+BAND_MARGIN = 1.05
+BAND_BUFFER_RESOLUTION = 4
+MAX_BAND_ATTEMPTS = 3
+
+
+def error_band(full, coarse, tolerance):
+    '''
+    Returns (band, error) for a coarse version of a polygon, or None if
+    no band could be found in which the two polygons differ
+    '''
+    if coarse.is_empty or coarse.type not in ('Polygon', 'MultiPolygon') or not coarse.is_valid:
+        return None
+
+    try:
+        error = max(tolerance, coarse.boundary.hausdorff_distance(full.boundary))
+        difference = full.symmetric_difference(coarse)
+    except (TopologicalError, ValueError):
+        return None
+
+    for attempt in xrange(MAX_BAND_ATTEMPTS):
+        band = coarse.boundary.buffer(error * BAND_MARGIN, resolution=BAND_BUFFER_RESOLUTION)
+        if difference.is_empty or prep(band).contains(difference):
+            return band, error
+        error *= 2
+    return None
+
+
+class MultiResolutionPolygons(object):
+    '''
+    levels is a list of (coarse polygons, bands) per resolution, coarsest
+    first. Both are sequences of (properties, prepared geometry) like
+    PolygonIndex.polygons. errors is an (n, levels) array of error bounds,
+    infinite where a resolution isn't usable for a polygon.
+    '''
+
+    def __init__(self, tolerances, levels, errors):
+        self.tolerances = tolerances
+        self.levels = levels
+        self.errors = errors
+
+    @classmethod
+    def create(cls, polygons, tolerances=DEFAULT_RESOLUTION_TOLERANCES, preserve_topology=True):
+        '''
+        Build coarse versions of a sequence of (properties, prepared
+        polygon) tuples, e.g. PolygonIndex.polygons
+        '''
+        levels = [([], []) for t in tolerances]
+        errors = numpy.empty((len(polygons), len(tolerances)), dtype=numpy.float64)
+        errors.fill(numpy.inf)
+
+        for i, (props, poly) in enumerate(polygons):
+            full = prepared_geometry(poly).context
+            for k, tolerance in enumerate(tolerances):
+                coarse_polys, bands = levels[k]
+
+                band = None
+                if not full.is_empty:
+                    coarse = full.simplify(tolerance, preserve_topology=preserve_topology)
+                    band = error_band(full, coarse, tolerance)
+
+                if band is not None:
+                    band, errors[i, k] = band
+                else:
+                    # The band covers the whole bounding box, so points
+                    # inside it always go on to the next resolution
+                    coarse = band = box(*full.bounds) if not full.is_empty else box(0.0, 0.0, 0.0, 0.0)
+
+                coarse_polys.append(({}, prep(coarse)))
+                bands.append(({}, prep(band)))
+
+        return cls(tolerances, levels, errors)
+
+    def save(self, d):
+        for k, (coarse_polys, bands) in enumerate(self.levels):
+            for polys, filename in ((coarse_polys, COARSE_FILENAME), (bands, BAND_FILENAME)):
+                writer = PolygonStoreWriter()
+                for props, poly in polys:
+                    writer.add(prepared_geometry(poly).context, props)
+                writer.save(os.path.join(d, filename.format(k)))
+
+        write_arrays(os.path.join(d, RESOLUTIONS_FILENAME), RESOLUTIONS_MAGIC, [
+            ('errors', self.errors),
+        ], metadata={'tolerances': list(self.tolerances)})
+
+    @classmethod
+    def exists(cls, d):
+        return os.path.exists(os.path.join(d, RESOLUTIONS_FILENAME))
+
+    @classmethod
+    def load(cls, d, cache_size=DEFAULT_PREPARED_CACHE_SIZE):
+        '''
+        Coarse polygons and bands are always loaded lazily, cache_size is
+        split between them
+        '''
+        arrays = MappedArrays(os.path.join(d, RESOLUTIONS_FILENAME), RESOLUTIONS_MAGIC)
+        tolerances = arrays.metadata['tolerances']
+
+        store_cache_size = cache_size // max(2 * len(tolerances), 1)
+        levels = [(PolygonStore(os.path.join(d, COARSE_FILENAME.format(k)), lazy=True, cache_size=store_cache_size),
+                   PolygonStore(os.path.join(d, BAND_FILENAME.format(k)), lazy=True, cache_size=store_cache_size))
+                  for k in xrange(len(tolerances))]
+        return cls(tolerances, levels, arrays['errors'])
+
+    def point_state(self, i, pt):
+        '''
+        INSIDE or OUTSIDE if a coarse version of polygon i decides the
+        point, BOUNDARY if it's near the edge at every resolution
+        '''
+        for coarse_polys, bands in self.levels:
+            props, band = bands[i]
+            if not band.contains(pt):
+                props, coarse = coarse_polys[i]
+                return INSIDE if coarse.contains(pt) else OUTSIDE
+        return BOUNDARY
+
+    def point_states(self, poly_indices, lats, lons):
+        '''
+        Vectorized point_state for parallel arrays of polygon indices and
+        point coordinates
+        '''
+        states = numpy.zeros(len(poly_indices), dtype=numpy.uint8)
+        if not len(poly_indices):
+            return states
+
+        unresolved = numpy.argsort(poly_indices, kind='mergesort')
+        for coarse_polys, bands in self.levels:
+            if not len(unresolved):
+                break
+            splits = numpy.flatnonzero(numpy.diff(poly_indices[unresolved])) + 1
+            near_edge = []
+            for group in numpy.split(unresolved, splits):
+                i = poly_indices[group[0]]
+                x, y = lons[group], lats[group]
+
+                props, band = bands[i]
+                in_band = vectorized.contains(prepared_geometry(band), x, y)
+                decided = group[~in_band]
+                if len(decided):
+                    props, coarse = coarse_polys[i]
+                    inside = vectorized.contains(prepared_geometry(coarse), x[~in_band], y[~in_band])
+                    states[decided] = numpy.where(inside, INSIDE, OUTSIDE)
+                near_edge.append(group[in_band])
+            unresolved = numpy.concatenate(near_edge)
+
+        return states
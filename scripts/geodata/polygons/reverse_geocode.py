@@ -23,6 +23,7 @@ import sys
 import tempfile
 
 from functools import partial
+from shapely.geos import TopologicalError
 
 this_dir = os.path.realpath(os.path.dirname(__file__))
 sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
@@ -35,6 +36,7 @@ from geodata.i18n.word_breaks import ideographic_scripts
 from geodata.names.deduping import NameDeduper
 from geodata.osm.extract import parse_osm, OSM_NAME_TAGS
 from geodata.osm.osm_admin_boundaries import OSMAdminPolygonReader
+from geodata.parallel import ordered_map
 from geodata.polygons.index import *
 from geodata.statistics.tf_idf import IDFIndex
 
@@ -220,7 +222,7 @@ class NeighborhoodReverseGeocoder(RTreePolygonIndex):
                 f = open(os.path.join(repo_path, filename))
             else:
                 continue
-            index.add_geojson_like_file(json.load(f)['features'])
+            index.add_geojson_like_file(GeoJSONFeatureReader(f))
 
         return index
 
@@ -232,7 +234,8 @@ class NeighborhoodReverseGeocoder(RTreePolygonIndex):
         return doc
 
     @classmethod
-    def create_from_osm_and_quattroshapes(cls, filename, quattroshapes_dir, output_dir, scratch_dir=SCRATCH_DIR):
+    def create_from_osm_and_quattroshapes(cls, filename, quattroshapes_dir, output_dir, scratch_dir=SCRATCH_DIR,
+                                          osm_cache_dir=None):
         '''
         Given an OSM file (planet or some other bounds) containing neighborhoods
         as points (some suburbs have boundaries)
@@ -271,8 +274,9 @@ class NeighborhoodReverseGeocoder(RTreePolygonIndex):
                     doc = cls.count_words(name)
                     idf.update(doc)
 
-        for key, attrs, deps in parse_osm(filename):
-            for k, v in attrs.iteritems():
+        for element in parse_osm(filename, tag_prefixes=OSM_NAME_TAGS, attributes=(), compact=True,
+                                 cache_dir=osm_cache_dir):
+            for k, v in element.tags:
                 if any((k.startswith(name_key) for name_key in OSM_NAME_TAGS)):
                     doc = cls.count_words(v)
                     idf.update(doc)
@@ -283,7 +287,7 @@ class NeighborhoodReverseGeocoder(RTreePolygonIndex):
         logger.info('Matching OSM points to neighborhood polygons')
         # Parse OSM and match neighborhood/suburb points to Quattroshapes/Zetashapes polygons
         num_polys = 0
-        for node_id, attrs, deps in parse_osm(filename):
+        for node_id, attrs, deps in parse_osm(filename, cache_dir=osm_cache_dir):
             try:
                 lat, lon = latlon_to_decimal(attrs['lat'], attrs['lon'])
             except ValueError:
@@ -386,13 +390,10 @@ class NeighborhoodReverseGeocoder(RTreePolygonIndex):
 
         return index
 
-    def priority(self, i):
-        props, p = self.polygons[i]
-        return (self.level_priorities[props['polygon_type']], self.source_priorities[props['source']])
-
-    def get_candidate_polygons(self, lat, lon):
-        candidates = super(NeighborhoodReverseGeocoder, self).get_candidate_polygons(lat, lon)
-        return sorted(candidates, key=self.priority)
+    def polygon_priority(self, props):
+        # Order by level, then by source
+        num_sources = max(self.source_priorities.values()) + 1
+        return self.level_priorities[props['polygon_type']] * num_sources + self.source_priorities[props['source']]
 
 
 class QuattroshapesReverseGeocoder(RTreePolygonIndex):
@@ -501,10 +502,30 @@ class QuattroshapesReverseGeocoder(RTreePolygonIndex):
                                output_dir,
                                index_filename=None,
                                polys_filename=DEFAULT_POLYS_FILENAME,
-                               use_all_props=False):
+                               use_all_props=False,
+                               num_workers=1):
+        '''
+        Polygons are built and simplified in num_workers processes
+        (serially by default), see geodata.parallel
+        '''
 
         index = cls(save_dir=output_dir, index_filename=index_filename)
 
+        records = cls.shapefile_records(index, input_files, use_all_props=use_all_props)
+        for result in ordered_map(simplified_polygon_record, records, num_workers=num_workers):
+            (properties, include_props), parts, poly = result
+            for part in parts:
+                index.index_polygon(part)
+            index.add_polygon(poly, properties, include_only_properties=include_props)
+
+        return index
+
+    @classmethod
+    def shapefile_records(cls, index, input_files, use_all_props=False):
+        '''
+        Records with the required properties from Quattroshapes shapefiles,
+        as arguments to simplified_polygon_record
+        '''
         for input_file in input_files:
             f = fiona.open(input_file)
 
@@ -540,30 +561,18 @@ class QuattroshapesReverseGeocoder(RTreePolygonIndex):
                     continue
 
                 poly_type = rec['geometry']['type']
-                if poly_type == 'Polygon':
-                    poly = Polygon(rec['geometry']['coordinates'][0])
-                    index.index_polygon(poly)
-                    poly = index.simplify_polygon(poly)
-                    index.add_polygon(poly, dict(rec['properties']), include_only_properties=include_props)
-                elif poly_type == 'MultiPolygon':
-                    polys = []
-                    for coords in rec['geometry']['coordinates']:
-                        poly = Polygon(coords[0])
-                        polys.append(poly)
-                        index.index_polygon(poly)
-
-                    multi_poly = index.simplify_polygon(MultiPolygon(polys))
-                    index.add_polygon(multi_poly, dict(rec['properties']), include_only_properties=include_props)
-                else:
+                if poly_type not in ('Polygon', 'MultiPolygon'):
                     continue
 
-        return index
+                yield ((dict(rec['properties']), include_props), poly_type, rec['geometry']['coordinates'],
+                       index.simplify_tolerance, index.preserve_topology)
 
     @classmethod
     def create_with_quattroshapes(cls, quattroshapes_dir,
                                   output_dir,
                                   index_filename=None,
-                                  polys_filename=DEFAULT_POLYS_FILENAME):
+                                  polys_filename=DEFAULT_POLYS_FILENAME,
+                                  num_workers=1):
 
         admin0_filename = os.path.join(quattroshapes_dir, cls.COUNTRIES_FILENAME)
         admin1_filename = os.path.join(quattroshapes_dir, cls.ADMIN1_FILENAME)
@@ -576,15 +585,12 @@ class QuattroshapesReverseGeocoder(RTreePolygonIndex):
                                           admin2_filename, admin2r_filename,
                                           localities_filename],
                                           output_dir, index_filename=index_filename,
-                                          polys_filename=polys_filename)
-
-    def sort_level(self, i):
-        props, p = self.polygons[i]
-        return self.sort_levels.get(props[self.LEVEL], 0)
+                                          polys_filename=polys_filename,
+                                          num_workers=num_workers)
 
-    def get_candidate_polygons(self, lat, lon):
-        candidates = super(QuattroshapesReverseGeocoder, self).get_candidate_polygons(lat, lon)
-        return sorted(candidates, key=self.sort_level, reverse=True)
+    def polygon_priority(self, props):
+        # Highest sort level first
+        return -self.sort_levels.get(props[self.LEVEL], 0)
 
 
 class QuattroshapesNeighborhoodsReverseGeocoder(GeohashPolygonIndex, QuattroshapesReverseGeocoder):
@@ -600,6 +606,84 @@ class QuattroshapesNeighborhoodsReverseGeocoder(GeohashPolygonIndex, Quattroshap
                                           polys_filename=polys_filename)
 
 
+def osm_admin_polygon(args):
+    '''
+    Builds the polygon for an OSM admin relation from its outer and inner
+    rings, matching holes to outer rings and repairing invalid geometries,
+    then simplifies it. Run in worker processes by
+    OSMReverseGeocoder.create_from_osm_file.
+
+    args is (index class, payload, outer rings, inner rings, simplify
+    tolerance, preserve topology). Returns (payload, parts, polygon) like
+    simplified_polygon_record or None if there's no valid polygon.
+    '''
+    cls, payload, outer_polys, inner_polys, simplify_tolerance, preserve_topology = args
+
+    parts = []
+    if len(outer_polys) == 1 and not inner_polys:
+        poly = cls.to_polygon(outer_polys[0])
+        if poly is None or not poly.bounds or len(poly.bounds) != 4:
+            return None
+        if poly.type != 'MultiPolygon':
+            parts.append(poly)
+        else:
+            parts.extend(poly)
+    else:
+        inner = []
+        # Validate inner polygons (holes)
+        for p in inner_polys:
+            poly = cls.to_polygon(p)
+            if poly is None or not poly.bounds or len(poly.bounds) != 4:
+                continue
+            if not poly.is_valid:
+                poly = cls.fix_polygon(poly)
+                if poly is None or not poly.bounds or len(poly.bounds) != 4:
+                    continue
+
+            if poly.type != 'MultiPolygon':
+                inner.append(poly)
+            else:
+                inner.extend(poly)
+
+        # Validate outer polygons
+        for p in outer_polys:
+            poly = cls.to_polygon(p)
+            if poly is None or not poly.bounds or len(poly.bounds) != 4:
+                continue
+
+            interior = []
+            try:
+                # Figure out which outer polygon contains each inner polygon
+                interior = [p2 for p2 in inner if poly.contains(p2)]
+            except TopologicalError:
+                poly = cls.fix_polygon(poly)
+                if poly is None or not poly.bounds or len(poly.bounds) != 4:
+                    continue
+                if poly.is_valid:
+                    interior = [p2 for p2 in inner if poly.contains(p2)]
+
+            if interior:
+                # Polygon with holes constructor
+                poly = Polygon(p, [zip(*p2.exterior.coords.xy) for p2 in interior])
+                poly = cls.fix_polygon(poly)
+                if poly is None or not poly.bounds or len(poly.bounds) != 4:
+                    continue
+            # R-tree only stores the bounding box, so add the whole polygon
+            if poly.type != 'MultiPolygon':
+                parts.append(poly)
+            else:
+                parts.extend(poly)
+
+        if not parts:
+            return None
+        elif len(parts) > 1:
+            poly = MultiPolygon(parts)
+        else:
+            poly = parts[0]
+
+    return payload, parts, poly.simplify(simplify_tolerance, preserve_topology=preserve_topology)
+
+
 class OSMReverseGeocoder(RTreePolygonIndex):
     '''
     OSM has among the best, most carefully-crafted, accurate administrative
@@ -637,12 +721,16 @@ class OSMReverseGeocoder(RTreePolygonIndex):
     @classmethod
     def create_from_osm_file(cls, filename, output_dir,
                              index_filename=None,
-                             polys_filename=DEFAULT_POLYS_FILENAME):
+                             polys_filename=DEFAULT_POLYS_FILENAME,
+                             num_workers=1):
         '''
         Given an OSM file (planet or some other bounds) containing relations
         and their dependencies, create an R-tree index for coarse-grained
         reverse geocoding.
 
+        Polygons are repaired and simplified in num_workers processes
+        (serially by default), see geodata.parallel
+
         Note: the input file is expected to have been created using
         osmfilter. Use fetch_osm_address_data.sh for planet or copy the
         admin borders commands if using other bounds.
@@ -658,96 +746,38 @@ class OSMReverseGeocoder(RTreePolygonIndex):
 
         logger = logging.getLogger('osm.reverse_geocode')
 
-        for relation_id, props, outer_polys, inner_polys in polygons:
-            props = {k: v for k, v in props.iteritems() if k in cls.include_property_patterns
-                     or (':' in k and '{}:*'.format(k.split(':', 1)[0]) in cls.include_property_patterns)}
+        def records():
+            for relation_id, props, outer_polys, inner_polys in polygons:
+                props = {k: v for k, v in props.iteritems() if k in cls.include_property_patterns
+                         or (':' in k and '{}:*'.format(k.split(':', 1)[0]) in cls.include_property_patterns)}
 
-            props['id'] = relation_id
+                props['id'] = relation_id
 
-            if inner_polys and not outer_polys:
-                logger.warn('inner polygons with no outer')
-                continue
-            if len(outer_polys) == 1 and not inner_polys:
-                poly = cls.to_polygon(outer_polys[0])
-                if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                    continue
-                if poly.type != 'MultiPolygon':
-                    index.index_polygon(poly)
-                else:
-                    for p in poly:
-                        index.index_polygon(p)
-            else:
-                multi = []
-                inner = []
-                # Validate inner polygons (holes)
-                for p in inner_polys:
-                    poly = cls.to_polygon(p)
-                    if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                        continue
-                    if not poly.is_valid:
-                        poly = cls.fix_polygon(poly)
-                        if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                            continue
-
-                    if poly.type != 'MultiPolygon':
-                        inner.append(poly)
-                    else:
-                        inner.extend(poly)
-
-                # Validate outer polygons
-                for p in outer_polys:
-                    poly = cls.to_polygon(p)
-                    if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                        continue
-
-                    interior = []
-                    try:
-                        # Figure out which outer polygon contains each inner polygon
-                        interior = [p2 for p2 in inner if poly.contains(p2)]
-                    except TopologicalError:
-                        poly = cls.fix_polygon(poly)
-                        if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                            continue
-                        if poly.is_valid:
-                            interior = [p2 for p2 in inner if poly.contains(p2)]
-
-                    if interior:
-                        # Polygon with holes constructor
-                        poly = Polygon(p, [zip(*p2.exterior.coords.xy) for p2 in interior])
-                        poly = cls.fix_polygon(poly)
-                        if poly is None or not poly.bounds or len(poly.bounds) != 4:
-                            continue
-                    # R-tree only stores the bounding box, so add the whole polygon
-                    if poly.type != 'MultiPolygon':
-                        index.index_polygon(poly)
-                        multi.append(poly)
-                    else:
-                        for p in poly:
-                            index.index_polygon(p)
-                        multi.extend(poly)
-
-                if len(multi) > 1:
-                    poly = MultiPolygon(multi)
-                elif multi:
-                    poly = multi[0]
-                else:
+                if inner_polys and not outer_polys:
+                    logger.warn('inner polygons with no outer')
                     continue
-            poly = index.simplify_polygon(poly)
+
+                yield cls, props, outer_polys, inner_polys, index.simplify_tolerance, index.preserve_topology
+
+        # Geometry repair and simplification run in parallel, ids are assigned here in input order
+        for result in ordered_map(osm_admin_polygon, records(), num_workers=num_workers):
+            if result is None:
+                continue
+            props, parts, poly = result
+            for part in parts:
+                index.index_polygon(part)
             index.add_polygon(poly, props)
 
         return index
 
-    def sort_level(self, i):
-        props, p = self.polygons[i]
+    def polygon_priority(self, props):
+        # Highest admin level first
         admin_level = props.get(self.ADMIN_LEVEL, 0)
         try:
-            return int(admin_level)
+            return -int(admin_level)
         except ValueError:
             return 0
 
-    def get_candidate_polygons(self, lat, lon):
-        candidates = super(OSMReverseGeocoder, self).get_candidate_polygons(lat, lon)
-        return sorted(candidates, key=self.sort_level, reverse=True)
 
 if __name__ == '__main__':
     # Handle argument parsing here
@@ -757,27 +787,54 @@ if __name__ == '__main__':
                         help='Path to quattroshapes dir')
 
     parser.add_argument('-a', '--osm-admin-file',
-                        help='Path to OSM borders file (with dependencies, .osm format)')
+                        help='Path to OSM borders file (with dependencies, .osm or .osm.pbf format)')
 
     parser.add_argument('-n', '--osm-neighborhoods-file',
-                        help='Path to OSM neighborhoods file (no dependencies, .osm format)')
+                        help='Path to OSM neighborhoods file (no dependencies, .osm or .osm.pbf format)')
 
     parser.add_argument('-o', '--out-dir',
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('-c', '--coverage',
+                        action='store_true',
+                        default=False,
+                        help='Precompute inside/outside cells so most lookups skip exact tests')
+
+    parser.add_argument('--hierarchy',
+                        action='store_true',
+                        default=False,
+                        help='Link polygons to their parents for hierarchical lookups')
+
+    parser.add_argument('-j', '--workers',
+                        type=int,
+                        default=1,
+                        help='Processes for building/repairing polygons (default: 1, serial)')
+
+    parser.add_argument('-m', '--multi-resolution',
+                        action='store_true',
+                        default=False,
+                        help='Store coarse polygons with error bounds, full geometries are only tested near edges')
+
+    parser.add_argument('--osm-cache-dir',
+                        help='Cache the parsed neighborhoods file here, it\'s read twice (and again on rebuilds)')
+
     args = parser.parse_args()
     if args.osm_admin_file:
-        index = OSMReverseGeocoder.create_from_osm_file(args.osm_admin_file, args.out_dir)
+        index = OSMReverseGeocoder.create_from_osm_file(args.osm_admin_file, args.out_dir,
+                                                        num_workers=args.workers)
     elif args.osm_neighborhoods_file and args.quattroshapes_dir:
         index = NeighborhoodReverseGeocoder.create_from_osm_and_quattroshapes(
             args.osm_neighborhoods_file,
             args.quattroshapes_dir,
-            args.out_dir
+            args.out_dir,
+            osm_cache_dir=args.osm_cache_dir
         )
     elif args.quattroshapes_dir:
-        index = QuattroshapesReverseGeocoder.create_with_quattroshapes(args.quattroshapes_dir, args.out_dir)
+        index = QuattroshapesReverseGeocoder.create_with_quattroshapes(args.quattroshapes_dir, args.out_dir,
+                                                                       num_workers=args.workers)
     else:
         parser.error('Must specify quattroshapes dir or osm admin borders file')
 
-    index.save()
+    index.save(build_coverage=args.coverage, build_hierarchy=args.hierarchy,
+               build_resolutions=args.multi_resolution)
@@ -0,0 +1,126 @@
+'''
+geodata.polygons.stats
+----------------------
+
+Opt-in counters and timers for point-in-polygon lookups, to find out why
+lookups are slow in a given region and which geometries are to blame.
+
+Enabled per index with PolygonIndex.enable_stats(). For each query we
+record the number of candidates, the time spent finding them vs. testing
+them and the overall latency (in a histogram with power of two buckets,
+in microseconds). For each polygon we record the number of exact
+containment tests and the cumulative time spent in them, tests decided
+by precomputed cells or coarse resolutions are only counted. Bulk
+lookups (points_in_polys) count every point as a query, with the mean
+latency of the batch.
+
+Usage:
+    >>> index.enable_stats()
+    >>> ...
+    >>> index.stats_snapshot()['exact_tests']
+'''
+
+import ujson as json
+
+from collections import defaultdict
+from timeit import default_timer as timer
+
+DEFAULT_NUM_SLOWEST = 20
+
+
+def geometry_num_coords(geometry):
+    parts = geometry.geoms if geometry.type == 'MultiPolygon' else [geometry]
+    return sum(len(p.exterior.coords) + sum(len(r.coords) for r in p.interiors)
+               for p in parts if not p.is_empty)
+
+
+def latency_bucket(seconds):
+    '''Histogram bucket b holds latencies in [2^(b-1), 2^b) microseconds'''
+    return int(seconds * 1e6).bit_length()
+
+
+class PolygonIndexStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.hits = 0
+        self.raster_queries = 0
+        self.candidates = 0
+        self.candidate_lookups = 0
+        self.precomputed_tests = 0
+        self.exact_tests = 0
+
+        self.candidates_time = 0.0
+        self.test_time = 0.0
+        self.query_time = 0.0
+        self.latencies = defaultdict(int)
+
+        self.polygon_tests = defaultdict(int)
+        self.polygon_time = defaultdict(float)
+
+    def add_candidates(self, num_candidates, elapsed, num_lookups=1):
+        self.candidate_lookups += num_lookups
+        self.candidates += num_candidates
+        self.candidates_time += elapsed
+
+    def add_precomputed_test(self, num_tests=1):
+        self.precomputed_tests += num_tests
+
+    def add_exact_tests(self, i, elapsed, num_points=1):
+        self.exact_tests += num_points
+        self.polygon_tests[i] += num_points
+        self.polygon_time[i] += elapsed
+
+    def add_query(self, elapsed, result, test_time=0.0, raster=False):
+        self.queries += 1
+        if result:
+            self.hits += 1
+        if raster:
+            self.raster_queries += 1
+        self.test_time += test_time
+        self.query_time += elapsed
+        self.latencies[latency_bucket(elapsed)] += 1
+
+    def add_queries(self, num_queries, hits, elapsed, test_time=0.0):
+        '''A bulk lookup of num_queries points, hits of which are in a polygon'''
+        if not num_queries:
+            return
+        self.queries += num_queries
+        self.hits += hits
+        self.test_time += test_time
+        self.query_time += elapsed
+        self.latencies[latency_bucket(elapsed / num_queries)] += num_queries
+
+    def slowest_polygons(self, n=DEFAULT_NUM_SLOWEST):
+        '''(polygon index, cumulative exact test time, number of tests), slowest first'''
+        slowest = sorted(self.polygon_time.iteritems(), key=lambda (i, t): t, reverse=True)[:n]
+        return [(i, t, self.polygon_tests[i]) for i, t in slowest]
+
+    def snapshot(self, num_slowest=DEFAULT_NUM_SLOWEST):
+        queries = max(self.queries, 1)
+        return {
+            'queries': self.queries,
+            'hits': self.hits,
+            'hit_rate': float(self.hits) / queries,
+            'raster_queries': self.raster_queries,
+            'candidates_per_lookup': float(self.candidates) / max(self.candidate_lookups, 1),
+            'candidate_lookups': self.candidate_lookups,
+            'precomputed_tests': self.precomputed_tests,
+            'exact_tests': self.exact_tests,
+            'exact_tests_per_query': float(self.exact_tests) / queries,
+            'candidates_time': self.candidates_time,
+            'test_time': self.test_time,
+            'query_time': self.query_time,
+            'latency_histogram_us': {'<{}'.format(1 << b): n for b, n in self.latencies.iteritems()},
+            'slowest_polygons': [{'polygon': i, 'time': t, 'tests': n}
+                                 for i, t, n in self.slowest_polygons(num_slowest)],
+        }
+
+
+def dump_stats(snapshots, filename):
+    '''Write a dict of name => stats snapshot as JSON'''
+    f = open(filename, 'w')
+    f.write(json.dumps(snapshots, indent=2))
+    f.close()
@@ -0,0 +1,265 @@
+'''
+geodata.polygons.store
+----------------------
+
+Compact binary storage for the polygons in a PolygonIndex.
+
+Coordinates for all polygons are packed into a single array of doubles
+with CSR-style offset tables (polygon -> parts -> rings -> coordinates),
+plus per-polygon bounding boxes. Properties are kept in an interned
+property table in the same file (see geodata.polygons.properties).
+
+The file is memory-mapped on load (see geodata.mmap_arrays) and shapely
+geometries are only built when a polygon is accessed, so loading is
+close to instant and the page cache is shared by all the processes
+reading the same index.
+
+In lazy mode, prepared geometries are only created when a polygon is
+actually tested and are kept in an LRU cache with a memory budget, so
+a regional job only pays for the polygons it touches.
+'''
+
+import numpy
+
+from collections import OrderedDict
+
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.prepared import prep
+
+from geodata.mmap_arrays import write_arrays, MappedArrays
+from geodata.polygons.properties import PropertyTable, PropertyTableWriter
+
+POLYGON_STORE_MAGIC = 'PLYS'
+POLYGON_STORE_VERSION = 1
+
+POLYGON, MULTIPOLYGON = range(1, 3)
+
+# Rough per-coordinate memory use of a GEOS geometry plus its prepared
+# index structures, used to keep the prepared geometry cache within budget
+PREPARED_BYTES_PER_COORD = 64
+
+DEFAULT_PREPARED_CACHE_SIZE = 1 << 30
+
+
+class PolygonStoreWriter(object):
+    def __init__(self):
+        self.polygon_types = []
+        self.polygon_parts = [0]
+        self.part_rings = [0]
+        self.ring_coords = [0]
+        self.coords = []
+        self.bounds = []
+
+        self.properties = PropertyTableWriter()
+
+        self.num_coords = 0
+
+    def add_ring(self, ring):
+        coords = numpy.array(ring.coords, dtype=numpy.float64)[:, :2]
+        self.coords.append(coords)
+        self.num_coords += len(coords)
+        self.ring_coords.append(self.num_coords)
+
+    def add_part(self, poly):
+        self.add_ring(poly.exterior)
+        for ring in poly.interiors:
+            self.add_ring(ring)
+        self.part_rings.append(len(self.ring_coords) - 1)
+
+    def add(self, poly, properties):
+        if poly.type == 'MultiPolygon':
+            self.polygon_types.append(MULTIPOLYGON)
+            for p in poly:
+                self.add_part(p)
+        else:
+            self.polygon_types.append(POLYGON)
+            self.add_part(poly)
+
+        self.polygon_parts.append(len(self.part_rings) - 1)
+        self.bounds.append(poly.bounds if not poly.is_empty else (0.0, 0.0, 0.0, 0.0))
+
+        self.properties.add(properties)
+
+    def save(self, filename):
+        if self.coords:
+            coords = numpy.concatenate(self.coords)
+        else:
+            coords = numpy.empty((0, 2), dtype=numpy.float64)
+
+        write_arrays(filename, POLYGON_STORE_MAGIC, [
+            ('polygon_types', numpy.array(self.polygon_types, dtype=numpy.uint8)),
+            ('polygon_parts', numpy.array(self.polygon_parts, dtype=numpy.int64)),
+            ('part_rings', numpy.array(self.part_rings, dtype=numpy.int64)),
+            ('ring_coords', numpy.array(self.ring_coords, dtype=numpy.int64)),
+            ('coords', coords),
+            ('bounds', numpy.array(self.bounds, dtype=numpy.float64).reshape(-1, 4)),
+        ] + self.properties.arrays(), metadata={'version': POLYGON_STORE_VERSION})
+
+
+class PreparedGeometryCache(object):
+    '''
+    LRU cache of prepared geometries bounded by an estimate of their
+    memory use in bytes rather than by the number of entries.
+    '''
+
+    def __init__(self, max_size=DEFAULT_PREPARED_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        # Re-insert to mark as most recently used
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, size):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        # Always keep the newest entry even if it alone exceeds the budget
+        while self.size > self.max_size and len(self.entries) > 1:
+            k, (v, s) = self.entries.popitem(last=False)
+            self.size -= s
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class LazyPreparedPolygon(object):
+    '''
+    Stands in for a prepared geometry in lazy mode. The geometry is built
+    from the store the first time .context is accessed and the prepared
+    geometry is fetched from the store's LRU cache when testing points.
+    '''
+    __slots__ = ('store', 'i', 'geometry')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+        self.geometry = None
+
+    @property
+    def context(self):
+        if self.geometry is None:
+            self.geometry = self.store.geometry(self.i)
+        return self.geometry
+
+    def prepared(self):
+        return self.store.prepared(self.i, geometry=self.geometry)
+
+    def contains(self, other):
+        return self.prepared().contains(other)
+
+    def intersects(self, other):
+        return self.prepared().intersects(other)
+
+
+def prepared_geometry(poly):
+    '''
+    Returns the prepared geometry for either a shapely prepared geometry
+    or a LazyPreparedPolygon
+    '''
+    if isinstance(poly, LazyPreparedPolygon):
+        return poly.prepared()
+    return poly
+
+
+class PolygonStore(object):
+    '''
+    Read-only sequence of (properties, prepared geometry) tuples backed
+    by a memory-mapped polygon store, usable anywhere PolygonIndex expects
+    its list of polygons.
+
+    By default each polygon is built from the packed coordinates the first
+    time it's accessed and kept from then on. With lazy=True, nothing is
+    kept except up to cache_size bytes of prepared geometries.
+    '''
+
+    def __init__(self, filename, lazy=False, cache_size=DEFAULT_PREPARED_CACHE_SIZE):
+        self.arrays = MappedArrays(filename, POLYGON_STORE_MAGIC)
+        version = self.arrays.metadata.get('version')
+        if version != POLYGON_STORE_VERSION:
+            self.arrays.close()
+            raise ValueError('{} has unsupported polygon store version {}, expected {}'.format(
+                             filename, version, POLYGON_STORE_VERSION))
+
+        self.polygon_types = self.arrays['polygon_types']
+        self.polygon_parts = self.arrays['polygon_parts']
+        self.part_rings = self.arrays['part_rings']
+        self.ring_coords = self.arrays['ring_coords']
+        self.coords = self.arrays['coords']
+        self.bounds = self.arrays['bounds']
+
+        self.property_table = PropertyTable(self.arrays)
+
+        self.lazy = lazy
+        self.cache = {}
+        self.prepared_cache = PreparedGeometryCache(cache_size) if lazy else None
+
+    def __len__(self):
+        return len(self.polygon_types)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('polygon index out of range')
+
+        if self.lazy:
+            return self.properties(i), LazyPreparedPolygon(self, i)
+
+        polygon = self.cache.get(i)
+        if polygon is None:
+            polygon = self.cache[i] = (self.properties(i), prep(self.geometry(i)))
+        return polygon
+
+    def properties(self, i):
+        '''
+        Properties of polygon i, as a read-only PropertyView which decodes
+        them when first read
+        '''
+        return self.property_table[i]
+
+    def num_coords(self, i):
+        first_ring = self.part_rings[self.polygon_parts[i]]
+        last_ring = self.part_rings[self.polygon_parts[i + 1]]
+        return self.ring_coords[last_ring] - self.ring_coords[first_ring]
+
+    def prepared(self, i, geometry=None):
+        if not self.lazy:
+            return self[i][1]
+
+        poly = self.prepared_cache.get(i)
+        if poly is None:
+            poly = prep(geometry if geometry is not None else self.geometry(i))
+            self.prepared_cache.put(i, poly, self.num_coords(i) * PREPARED_BYTES_PER_COORD)
+        return poly
+
+    def part(self, p):
+        rings = [self.coords[self.ring_coords[r]:self.ring_coords[r + 1]]
+                 for r in xrange(self.part_rings[p], self.part_rings[p + 1])]
+        return Polygon(rings[0], rings[1:])
+
+    def geometry(self, i):
+        parts = [self.part(p) for p in xrange(self.polygon_parts[i], self.polygon_parts[i + 1])]
+        if self.polygon_types[i] == POLYGON:
+            return parts[0]
+        return MultiPolygon(parts)
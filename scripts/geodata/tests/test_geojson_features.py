@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import ujson as json
+
+from cStringIO import StringIO
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(this_dir, os.pardir, os.pardir)))
+
+from geodata.polygons.features import GeoJSONFeatureReader
+
+CHUNK_SIZES = (1, 2, 3, 7, 64, 1 << 20)
+
+
+def feature(j):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'id': j,
+            'name': u'Zoë "{quoted}" \\ [{}]',
+            'features': [{'type': 'Feature'}],
+            'nested': {'a': [1, 2.5, None, True, False], 'b': {}},
+        },
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [[[j, 0.0], [j + 1, 0.0], [j + 1, 1.5], [j, 0.0]]],
+        },
+    }
+
+
+class TestGeoJSONFeatureReader(unittest.TestCase):
+    features = [feature(j) for j in xrange(5)]
+
+    def read(self, text, chunk_size):
+        return list(GeoJSONFeatureReader(StringIO(text), chunk_size=chunk_size))
+
+    def check(self, text, expected=None):
+        if expected is None:
+            expected = self.features
+        for chunk_size in CHUNK_SIZES:
+            self.assertEqual(self.read(text, chunk_size), expected, 'chunk_size={}'.format(chunk_size))
+
+    def test_feature_collection(self):
+        collection = {'type': 'FeatureCollection', 'features': self.features}
+        self.check(json.dumps(collection))
+
+    def test_other_members(self):
+        # Members before and after the features array are skipped, whatever they contain
+        text = ('{"type": "FeatureCollection", "name": "x}\\"{", "crs": {"properties": {"name": ["a", {"b": "]"}]}},\n'
+                '"bbox": [0, 0, 6, 1.5], "count": -5, "valid": true, "empty": null,\n'
+                '"features": [\n  ' + ',\n  '.join(json.dumps(f) for f in self.features) + '\n],\n'
+                '"extra": {"features": [{"type": "Feature"}]}}\n')
+        self.check(text)
+
+    def test_empty(self):
+        self.check('', [])
+        self.check('  \n', [])
+        self.check('{"type": "FeatureCollection", "features": []}', [])
+
+    def test_newline_delimited(self):
+        self.check('\n'.join(json.dumps(f) for f in self.features) + '\n')
+
+    def test_utf8(self):
+        # Chunks can end in the middle of a character
+        self.check('\n'.join(json.dumps(f, ensure_ascii=False) for f in self.features))
+
+    def test_text_sequence(self):
+        self.check(''.join('\x1e' + json.dumps(f) + '\n' for f in self.features))
+
+    def test_non_features_skipped(self):
+        text = '\n'.join([json.dumps(self.features[0]), '{"type": "Polygon", "coordinates": []}',
+                          json.dumps(self.features[1])])
+        self.check(text, self.features[:2])
+
+    def test_invalid(self):
+        for text in ('[1, 2]', '{"type": "FeatureCollection", "features": [{"type": "Feature"}',
+                     '{"type": "FeatureCollection", 5: 1}', '{"type": "Feature", "name": "unterminated'):
+            for chunk_size in CHUNK_SIZES:
+                self.assertRaises(ValueError, self.read, text, chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
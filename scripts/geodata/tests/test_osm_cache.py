@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(this_dir, os.pardir, os.pardir)))
+
+import geodata.osm.cache as osm_cache
+
+from geodata.osm.extract import parse_osm, parse_osm_parallel, ALL_OSM_TAGS, LAT_LON_ATTRIBUTES
+
+
+def osm_xml(num_nodes=500):
+    lines = [u'<?xml version="1.0" encoding="UTF-8"?>', u'<osm version="0.6">']
+    for i in xrange(1, num_nodes):
+        # Coordinates as written, in either attribute order, with other attributes
+        if i % 2:
+            lines.append(u'<node id="{}" lat="{}.0" lon="-0.{}0" version="{}">'.format(i, i % 90, i, i % 3))
+        else:
+            lines.append(u'<node lon="{}" id="{}" user="Zoë" lat="1e-{}">'.format(i * 0.25, i, i % 7))
+        if i % 3 == 0:
+            lines.append(u'<tag k="name" v="Straße {}"/><tag k="addr:housenumber" v="{}"/>'.format(i, i))
+        if i % 5 == 0:
+            lines.append(u'<tag k="version" v="tagged"/>')
+        lines.append(u'</node>')
+    for i in xrange(50):
+        lines.append(u'<way id="{}">{}<tag k="highway" v="residential"/><tag k="name" v="東京"/></way>'.format(
+            5000 + i, u''.join([u'<nd ref="{}"/>'.format(j) for j in xrange(i + 1, i + 6)])))
+    for i in xrange(10):
+        lines.append(u'<relation id="{}"><member type="way" ref="{}" role="outer"/>'
+                     u'<member type="node" ref="1" role="admin_centre"/><tag k="type" v="boundary"/></relation>'.format(
+                         9000 + i, 5000 + i))
+    lines.append(u'</osm>')
+    return u'\n'.join(lines).encode('utf-8')
+
+
+class TestOSMCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.filename = os.path.join(self.temp_dir, 'test.osm')
+        self.write_file(self.filename, osm_xml())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, filename, data):
+        f = open(filename, 'w')
+        f.write(data)
+        f.close()
+
+    def records(self, filename, compact=False, **kw):
+        records = list(parse_osm(filename, compact=compact, **kw))
+        if compact:
+            return [(e.type, e.id, e.tags, e.deps, e.roles) for e in records]
+        return [(key, attrs.items(), deps) for key, attrs, deps in records]
+
+    def test_same_records(self):
+        filters = [{}, {'attributes': LAT_LON_ATTRIBUTES}, {'attributes': ('lon', 'version'), 'tag_keys': ('name',)},
+                   {'attributes': (), 'tag_prefixes': ('addr',)}, {'tag_regex': re.compile('^(type|highway)$')}]
+        for allowed_types in (ALL_OSM_TAGS, set(['node']), set(['way', 'relation'])):
+            for dependencies in (False, True):
+                for kw in filters:
+                    for compact in (False, True):
+                        expected = self.records(self.filename, allowed_types=allowed_types,
+                                                dependencies=dependencies, compact=compact, **kw)
+                        records = self.records(self.filename, allowed_types=allowed_types,
+                                               dependencies=dependencies, compact=compact,
+                                               cache_dir=self.cache_dir, **kw)
+                        self.assertTrue(expected)
+                        self.assertEqual(records, expected)
+
+        # Coordinates are the strings from the file
+        records = dict([(key, attrs) for key, attrs, deps in
+                        self.records(self.filename, allowed_types=set(['node']), cache_dir=self.cache_dir)])
+        self.assertEqual(records[1][:2], [('lat', '1.0'), ('lon', '-0.10')])
+        self.assertEqual(records[2], [('lon', '0.5'), ('user', u'Zoë'), ('lat', '1e-2')])
+
+    def test_cache_read(self):
+        expected = self.records(self.filename, dependencies=True)
+        self.assertEqual(self.records(self.filename, dependencies=True, cache_dir=self.cache_dir), expected)
+
+        path = osm_cache.osm_cache_path(self.filename, self.cache_dir)
+        self.assertTrue(os.path.exists(path))
+        mtime = os.path.getmtime(path)
+
+        def osm_file_elements(*args, **kw):
+            raise AssertionError('Parsed a cached file')
+
+        parse = osm_cache.osm_file_elements
+        osm_cache.osm_file_elements = osm_file_elements
+        try:
+            self.assertEqual(self.records(self.filename, dependencies=True, cache_dir=self.cache_dir), expected)
+        finally:
+            osm_cache.osm_file_elements = parse
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_rebuilt_when_changed(self):
+        self.records(self.filename, cache_dir=self.cache_dir)
+        self.write_file(self.filename, osm_xml(num_nodes=100))
+        self.assertEqual(self.records(self.filename, cache_dir=self.cache_dir), self.records(self.filename))
+        self.assertEqual([f for f in os.listdir(self.cache_dir) if f.startswith('tmp')], [])
+
+    def test_same_name(self):
+        other_dir = os.path.join(self.temp_dir, 'other')
+        os.mkdir(other_dir)
+        other_filename = os.path.join(other_dir, os.path.basename(self.filename))
+        self.write_file(other_filename, osm_xml(num_nodes=100))
+
+        self.assertNotEqual(osm_cache.osm_cache_path(self.filename, self.cache_dir),
+                            osm_cache.osm_cache_path(other_filename, self.cache_dir))
+        for filename in (self.filename, other_filename, self.filename):
+            self.assertEqual(self.records(filename, cache_dir=self.cache_dir), self.records(filename))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_unicode_filename(self):
+        filename = os.path.join(self.temp_dir.decode('utf-8'), u'東京.osm')
+        # Same cache as the UTF-8 encoded path
+        self.assertEqual(osm_cache.osm_cache_path(filename, self.cache_dir),
+                         osm_cache.osm_cache_path(filename.encode('utf-8'), self.cache_dir).decode('utf-8'))
+
+    def test_parallel_build(self):
+        other_cache_dir = os.path.join(self.temp_dir, 'parallel_cache')
+        kw = dict(dependencies=True, tag_prefixes=('name',))
+        records = list(parse_osm_parallel(self.filename, num_workers=2, chunk_size=1000,
+                                          cache_dir=other_cache_dir, **kw))
+        self.assertEqual(records, list(parse_osm(self.filename, **kw)))
+
+        # Same cache as a serial build
+        self.records(self.filename, cache_dir=self.cache_dir)
+        serial_cache = open(osm_cache.osm_cache_path(self.filename, self.cache_dir), 'rb').read()
+        parallel_cache = open(osm_cache.osm_cache_path(self.filename, other_cache_dir), 'rb').read()
+        self.assertEqual(parallel_cache, serial_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
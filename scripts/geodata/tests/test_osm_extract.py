@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+
+from cStringIO import StringIO
+from xml.sax.saxutils import quoteattr
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(this_dir, os.pardir, os.pardir)))
+
+from geodata.osm.extract import (parse_osm, parse_osm_parallel, iterparse_osm, osm_chunks, osm_records,
+                                 ALL_OSM_TAGS, WAY_OFFSET, RELATION_OFFSET)
+
+
+# Minimal protocol buffer encoder for writing .osm.pbf files
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint_field(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def bytes_field(field, data):
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+
+def packed_field(field, values):
+    return bytes_field(field, ''.join([varint(v) for v in values]))
+
+
+def delta_encode(values):
+    prev = 0
+    out = []
+    for v in values:
+        out.append(zigzag(v - prev))
+        prev = v
+    return out
+
+
+class StringTable(object):
+    def __init__(self):
+        self.strings = [u'']
+        self.ids = {u'': 0}
+
+    def __getitem__(self, s):
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+    def encode(self):
+        return bytes_field(1, ''.join([bytes_field(1, s.encode('utf-8')) for s in self.strings]))
+
+
+def pbf_blob(blob_type, data, compress=True):
+    if compress:
+        blob = varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+    else:
+        blob = bytes_field(1, data)
+    header = bytes_field(1, blob_type) + varint_field(3, len(blob))
+    return struct.pack('!I', len(header)) + header + blob
+
+
+MEMBER_TYPES = {'node': 0, 'way': 1, 'relation': 2}
+
+GRANULARITY = 100
+LAT_OFFSET = 1000
+LON_OFFSET = -2000
+
+
+def coordinate(offset, value, granularity=GRANULARITY):
+    return '{:.7f}'.format(1e-9 * (offset + granularity * value))
+
+
+def tags_xml(tags):
+    return u''.join([u'<tag k={} v={}/>'.format(quoteattr(k), quoteattr(v)) for k, v in tags])
+
+
+class TestPBF(unittest.TestCase):
+    '''
+    The same elements written as .osm.pbf and as .osm XML are read as the
+    same records
+    '''
+
+    names = [u'Main St', u'Straße', u'東京', u'"<x>"']
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        rand = random.Random(3)
+
+        # Dense nodes, including ids in the --all-to-nodes way and relation ranges
+        self.dense_nodes = []
+        for i in xrange(1, 300):
+            node_id = i
+            if i % 50 == 0:
+                node_id += WAY_OFFSET
+            elif i % 77 == 0:
+                node_id += RELATION_OFFSET
+            tags = [(u'name', rand.choice(self.names)), (u'amenity', u'cafe')] if i % 3 == 0 else []
+            self.dense_nodes.append((node_id, rand.randint(-9000000, 9000000), rand.randint(-18000000, 18000000), tags))
+
+        # Regular nodes, in a block with the default granularity and offsets
+        self.nodes = [(100000 + i, rand.randint(-9000000, 9000000), rand.randint(-9000000, 9000000),
+                       [(u'name', rand.choice(self.names))] if i % 2 else [])
+                      for i in xrange(10)]
+
+        self.ways = [(5000 + i, [(u'highway', u'residential'), (u'name', rand.choice(self.names))],
+                      [rand.randint(1, 300) for j in xrange(5)])
+                     for i in xrange(20)]
+
+        self.relations = [(9000 + i, [(u'type', u'boundary'), (u'name', rand.choice(self.names))],
+                           [('way', 5000 + i, u'outer'), ('way', 5001 + i, u'inner'), ('node', 3, u'admin_centre'),
+                            ('relation', 9000, u'outer'), ('way', 5002, u'')])
+                          for i in xrange(5)]
+
+        self.pbf_filename = os.path.join(self.temp_dir, 'test.osm.pbf')
+        self.xml_filename = os.path.join(self.temp_dir, 'test.osm')
+        self.write_pbf()
+        self.write_xml()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_pbf(self):
+        strings = StringTable()
+        node_tags = []
+        for node_id, lat, lon, tags in self.dense_nodes:
+            for k, v in tags:
+                node_tags.extend([strings[k], strings[v]])
+            node_tags.append(0)
+        dense = bytes_field(2, packed_field(1, delta_encode([n[0] for n in self.dense_nodes])) +
+                            packed_field(8, delta_encode([n[1] for n in self.dense_nodes])) +
+                            packed_field(9, delta_encode([n[2] for n in self.dense_nodes])) +
+                            packed_field(10, node_tags))
+
+        ways = ''.join([bytes_field(3, varint_field(1, way_id) +
+                                    packed_field(2, [strings[k] for k, v in tags]) +
+                                    packed_field(3, [strings[v] for k, v in tags]) +
+                                    packed_field(8, delta_encode(refs)))
+                        for way_id, tags, refs in self.ways])
+
+        relations = ''.join([bytes_field(4, varint_field(1, relation_id) +
+                                         packed_field(2, [strings[k] for k, v in tags]) +
+                                         packed_field(3, [strings[v] for k, v in tags]) +
+                                         packed_field(8, [strings[role] for member_type, ref, role in members]) +
+                                         packed_field(9, delta_encode([ref for member_type, ref, role in members])) +
+                                         packed_field(10, [MEMBER_TYPES[member_type] for member_type, ref, role in members]))
+                             for relation_id, tags, members in self.relations])
+
+        block = (strings.encode() + bytes_field(2, dense) + bytes_field(2, ways) + bytes_field(2, relations) +
+                 varint_field(17, GRANULARITY) + varint_field(19, LAT_OFFSET) + varint_field(20, LON_OFFSET))
+
+        node_strings = StringTable()
+        nodes = ''.join([bytes_field(1, varint_field(1, zigzag(node_id)) +
+                                     packed_field(2, [node_strings[k] for k, v in tags]) +
+                                     packed_field(3, [node_strings[v] for k, v in tags]) +
+                                     varint_field(8, zigzag(lat)) + varint_field(9, zigzag(lon)))
+                         for node_id, lat, lon, tags in self.nodes])
+        nodes_block = node_strings.encode() + bytes_field(2, nodes)
+
+        header = bytes_field(4, 'OsmSchema-V0.6') + bytes_field(4, 'DenseNodes')
+
+        f = open(self.pbf_filename, 'wb')
+        f.write(pbf_blob('OSMHeader', header))
+        f.write(pbf_blob('OSMData', block))
+        f.write(pbf_blob('OSMData', nodes_block, compress=False))
+        f.close()
+
+    def write_xml(self):
+        lines = [u'<?xml version="1.0" encoding="UTF-8"?>', u'<osm version="0.6">']
+        for node_id, lat, lon, tags in self.dense_nodes:
+            lines.append(u'<node id="{}" lat="{}" lon="{}">{}</node>'.format(
+                node_id, coordinate(LAT_OFFSET, lat), coordinate(LON_OFFSET, lon), tags_xml(tags)))
+        for way_id, tags, refs in self.ways:
+            lines.append(u'<way id="{}">{}{}</way>'.format(
+                way_id, u''.join([u'<nd ref="{}"/>'.format(ref) for ref in refs]), tags_xml(tags)))
+        for relation_id, tags, members in self.relations:
+            lines.append(u'<relation id="{}">{}{}</relation>'.format(
+                relation_id, u''.join([u'<member type="{}" ref="{}" role="{}"/>'.format(*m) for m in members]),
+                tags_xml(tags)))
+        for node_id, lat, lon, tags in self.nodes:
+            lines.append(u'<node id="{}" lat="{}" lon="{}">{}</node>'.format(
+                node_id, coordinate(0, lat), coordinate(0, lon), tags_xml(tags)))
+        lines.append(u'</osm>')
+
+        f = open(self.xml_filename, 'w')
+        f.write(u'\n'.join(lines).encode('utf-8'))
+        f.close()
+
+    def check_same_records(self, **kw):
+        expected = list(parse_osm(self.xml_filename, **kw))
+        records = list(parse_osm(self.pbf_filename, **kw))
+        if kw.get('compact'):
+            expected = [(e.type, e.id, e.tags, e.deps, e.roles) for e in expected]
+            records = [(e.type, e.id, e.tags, e.deps, e.roles) for e in records]
+        self.assertTrue(expected)
+        self.assertEqual(records, expected)
+        if not kw.get('compact'):
+            for (key, attrs, deps), (expected_key, expected_attrs, expected_deps) in zip(records, expected):
+                self.assertEqual(type(key), type(expected_key))
+                self.assertEqual(attrs.items(), expected_attrs.items())
+                self.assertEqual([type(v) for v in attrs.values()], [type(v) for v in expected_attrs.values()])
+
+    def test_same_records(self):
+        for allowed_types in (ALL_OSM_TAGS, set(['node']), set(['way']), set(['relation']), set(['way', 'relation'])):
+            for dependencies in (False, True):
+                self.check_same_records(allowed_types=allowed_types, dependencies=dependencies)
+
+    def test_offset_ids(self):
+        records = set([key for key, attrs, deps in parse_osm(self.pbf_filename, allowed_types=set(['way', 'relation']))])
+        self.assertIn('way:50', records)
+        self.assertIn('relation:77', records)
+        self.assertIn('way:5000', records)
+
+    def test_dependencies(self):
+        records = dict((key, deps) for key, attrs, deps in parse_osm(self.pbf_filename, dependencies=True))
+        way_id, tags, refs = self.ways[0]
+        self.assertEqual(records['way:{}'.format(way_id)], refs)
+        # Only way and relation members with inner/outer roles
+        relation_id, tags, members = self.relations[0]
+        self.assertEqual(records['relation:{}'.format(relation_id)],
+                         [(5000, u'outer'), (5001, u'inner'), (9000, u'outer')])
+
+    def test_filters(self):
+        self.check_same_records(tag_keys=('name',))
+        self.check_same_records(tag_prefixes=('am', 'high'))
+        self.check_same_records(attributes=('lat',), tag_keys=('type',), dependencies=True)
+        self.check_same_records(attributes=())
+
+    def test_compact(self):
+        for dependencies in (False, True):
+            self.check_same_records(compact=True, dependencies=dependencies)
+
+
+class TestOSMElement(unittest.TestCase):
+    def test_same_values(self):
+        f = StringIO('<osm><node id="1" lat="1.5" lon="2.0" version="3"><tag k="name" v="x"/>'
+                     '<tag k="version" v="tagged"/></node></osm>')
+        elements = list(iterparse_osm(f))
+        key, attrs, deps = list(osm_records(elements))[0]
+        element = list(osm_records(elements, compact=True))[0]
+
+        self.assertEqual(element.key, key)
+        for k in attrs:
+            self.assertIn(k, element)
+            self.assertEqual(element[k], attrs[k])
+            self.assertEqual(element.get(k), attrs.get(k))
+        # The tag wins over the attribute, as in the OrderedDict
+        self.assertEqual(element['version'], 'tagged')
+        self.assertEqual(dict(element.iteritems()), dict(attrs))
+
+        self.assertNotIn('missing', element)
+        self.assertEqual(element.get('missing', 0), 0)
+        self.assertRaises(KeyError, element.__getitem__, 'missing')
+
+
+class TestParallelParse(unittest.TestCase):
+    '''
+    Parsing an .osm file split into chunks in worker processes gives the
+    same records as parsing it serially, wherever the chunks are split
+    '''
+
+    names = [u'Main St', u'Straße <x>', u'東京', u'a"b', u'<node id="1">']
+
+    chunk_sizes = (1, 37, 4096, 10 ** 9)
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        rand = random.Random(7)
+
+        lines = [u'<?xml version="1.0" encoding="UTF-8"?>', u'<osm version="0.6" generator="test">',
+                 u'\t<bounds minlat="1" minlon="2" maxlat="3" maxlon="4"/>']
+        for i in xrange(1, 1000):
+            node_id = i if i % 100 else WAY_OFFSET + i
+            lat, lon = rand.uniform(-90, 90), rand.uniform(-180, 180)
+            if i % 3 == 0:
+                tags = u'\n\t\t<tag k="name" v={}/>'.format(quoteattr(rand.choice(self.names)))
+                lines.append(u'\t<node id="{}" lat="{:.7f}" lon="{:.7f}">{}\n\t</node>'.format(node_id, lat, lon, tags))
+            else:
+                lines.append(u'\t<node id="{}" lat="{:.7f}" lon="{:.7f}"/>'.format(node_id, lat, lon))
+        for i in xrange(150):
+            refs = u''.join([u'\n\t\t<nd ref="{}"/>'.format(rand.randint(1, 1000)) for j in xrange(rand.randint(1, 100))])
+            tags = tags_xml([(u'highway', u'residential'), (u'name', rand.choice(self.names))])
+            lines.append(u'\t<way id="{}">{}\n\t\t{}\n\t</way>'.format(5000 + i, refs, tags))
+        for i in xrange(30):
+            lines.append(u'\t<relation id="{}">\n\t\t<member type="way" ref="{}" role="outer"/>{}\n\t</relation>'.format(
+                9000 + i, 5000 + i, tags_xml([(u'type', u'boundary')])))
+        lines.append(u'</osm>\n')
+
+        self.filename = os.path.join(self.temp_dir, 'test.osm')
+        f = open(self.filename, 'w')
+        f.write(u'\n'.join(lines).encode('utf-8'))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_chunks(self):
+        for chunk_size in self.chunk_sizes:
+            chunks = list(osm_chunks(self.filename, chunk_size=chunk_size))
+            self.assertTrue(chunks)
+            self.assertTrue(all([start < end for start, end in chunks]))
+            for (start, end), (next_start, next_end) in zip(chunks, chunks[1:]):
+                self.assertEqual(end, next_start)
+        self.assertEqual(len(list(osm_chunks(self.filename, chunk_size=10 ** 9))), 1)
+
+    def test_same_records(self):
+        for chunk_size in self.chunk_sizes:
+            for allowed_types in (ALL_OSM_TAGS, set(['way'])):
+                for dependencies in (False, True):
+                    expected = list(parse_osm(self.filename, allowed_types=allowed_types, dependencies=dependencies))
+                    records = list(parse_osm_parallel(self.filename, allowed_types=allowed_types,
+                                                      dependencies=dependencies, num_workers=3,
+                                                      chunk_size=chunk_size))
+                    self.assertEqual(records, expected)
+
+                    records = list(parse_osm_parallel(self.filename, allowed_types=allowed_types,
+                                                      dependencies=dependencies, num_workers=3, ordered=False,
+                                                      chunk_size=chunk_size))
+                    self.assertEqual(sorted(records), sorted(expected))
+
+    def test_filters(self):
+        expected = list(parse_osm(self.filename, tag_keys=('name',), attributes=('lat',)))
+        records = list(parse_osm_parallel(self.filename, tag_keys=('name',), attributes=('lat',),
+                                          num_workers=2, chunk_size=4096))
+        self.assertEqual(records, expected)
+
+    def test_serial(self):
+        self.assertEqual(list(parse_osm_parallel(self.filename, num_workers=1)), list(parse_osm(self.filename)))
+
+
+if __name__ == '__main__':
+    unittest.main()
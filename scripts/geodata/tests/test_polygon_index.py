@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import ujson as json
+
+from shapely.geometry import MultiPolygon, Point, box
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(this_dir, os.pardir, os.pardir)))
+
+from geodata.polygons.geohash_cover import geohash_key, point_bits, point_key
+from geodata.polygons.hierarchy import PolygonHierarchy
+from geodata.polygons.index import RTreePolygonIndex, GeohashPolygonIndex, GEOJSON_POLYS_FILENAME
+
+
+class LevelPolygonIndex(RTreePolygonIndex):
+    def polygon_priority(self, properties):
+        # Unique, so the order doesn't depend on the order of the R-tree's results
+        return properties['level'] * 1000 + properties['id']
+
+
+def random_polygons(n, seed=0):
+    '''Overlapping circles and two-part MultiPolygons around (0, 0)'''
+    rand = random.Random(seed)
+    polys = []
+    for j in xrange(n):
+        poly = Point(rand.uniform(-5, 5), rand.uniform(-5, 5)).buffer(rand.uniform(0.1, 2.5), 8)
+        if j % 5 == 0:
+            poly = MultiPolygon([poly, Point(poly.centroid.x + 3, poly.centroid.y).buffer(0.5, 4)])
+        polys.append((poly, {'id': j, 'level': rand.randint(0, 3)}))
+    return polys
+
+
+def random_points(n, seed=0):
+    rand = numpy.random.RandomState(seed)
+    return rand.uniform(-8, 8, n), rand.uniform(-8, 10, n)
+
+
+class PolygonIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_index(self, cls, polys, load=True, load_kw=None, **save_kw):
+        save_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        index = cls(save_dir=save_dir)
+        for poly, props in polys:
+            index.index_polygon(poly)
+            index.add_polygon(poly, props)
+        if not load:
+            return index
+        index.save(**save_kw)
+        return cls.load(save_dir, **(load_kw or {}))
+
+    def single_ids(self, index, lats, lons, return_all=False):
+        results = [index.point_in_poly(lat, lon, return_all=return_all) for lat, lon in zip(lats, lons)]
+        if return_all:
+            return [[props['id'] for props in r] for r in results]
+        return [r['id'] if r is not None else None for r in results]
+
+
+class TestBulkLookups(PolygonIndexTestCase):
+    index_classes = (RTreePolygonIndex, LevelPolygonIndex, GeohashPolygonIndex)
+
+    def bulk_ids(self, index, lats, lons, return_all=False):
+        if not return_all:
+            return [index.polygons[i][0]['id'] if i >= 0 else None
+                    for i in index.points_in_polys(lats, lons)]
+        point_indices, poly_indices = index.points_in_polys(lats, lons, return_all=True)
+        results = [[] for j in xrange(len(lats))]
+        for j, i in zip(point_indices, poly_indices):
+            results[j].append(index.polygons[i][0]['id'])
+        return results
+
+    def test_points_in_polys(self):
+        lats, lons = random_points(2000)
+        for cls in self.index_classes:
+            for load in (False, True):
+                index = self.create_index(cls, random_polygons(120), load=load)
+                for return_all in (False, True):
+                    self.assertEqual(self.bulk_ids(index, lats, lons, return_all=return_all),
+                                     self.single_ids(index, lats, lons, return_all=return_all),
+                                     '{} load={} return_all={}'.format(cls.__name__, load, return_all))
+
+    def test_point_in_poly_batch(self):
+        lats, lons = random_points(1000, seed=1)
+        for cls in self.index_classes:
+            index = self.create_index(cls, random_polygons(80, seed=1))
+            for return_all in (False, True):
+                batch = index.point_in_poly_batch(lats, lons, return_all=return_all)
+                if return_all:
+                    batch = [[props['id'] for props in r] for r in batch]
+                else:
+                    batch = [r['id'] if r is not None else None for r in batch]
+                self.assertEqual(batch, self.single_ids(index, lats, lons, return_all=return_all))
+
+    def test_read_only(self):
+        polys = random_polygons(20)
+        lats, lons = random_points(200)
+        for cls in self.index_classes:
+            index = self.create_index(cls, polys)
+            expected = self.single_ids(index, lats, lons, return_all=True)
+            num_parts = len(index.part_features) if getattr(index, 'part_features', None) is not None else None
+
+            for poly, props in random_polygons(3, seed=1):
+                self.assertRaises(ValueError, index.index_polygon, poly)
+                self.assertRaises(ValueError, index.add_polygon, poly, props)
+
+            # Nothing was changed before the errors
+            self.assertEqual(len(index.polygons), len(polys))
+            if num_parts is not None:
+                self.assertEqual(len(index.part_features), num_parts)
+                self.assertEqual(len(index.parts_match), len(polys))
+            self.assertEqual(self.single_ids(index, lats, lons, return_all=True), expected)
+
+    def test_empty(self):
+        index = self.create_index(RTreePolygonIndex, [])
+        self.assertEqual(list(index.points_in_polys([1.0, 2.0], [1.0, 2.0])), [-1, -1])
+        point_indices, poly_indices = index.points_in_polys([], [], return_all=True)
+        self.assertEqual(len(point_indices), 0)
+
+
+class TestStats(PolygonIndexTestCase):
+    def test_bulk_stats(self):
+        lats, lons = random_points(500, seed=3)
+        for cls in (RTreePolygonIndex, GeohashPolygonIndex):
+            index = self.create_index(cls, random_polygons(50, seed=3))
+            index.enable_stats()
+            self.single_ids(index, lats, lons)
+            single = index.stats_snapshot()
+
+            index.enable_stats()
+            index.points_in_polys(lats, lons)
+            bulk = index.stats_snapshot()
+
+            # Same queries, hits and candidates whichever way the points are looked up
+            for key in ('queries', 'hits', 'candidate_lookups', 'candidates_per_lookup'):
+                self.assertEqual(bulk[key], single[key], '{} {}'.format(cls.__name__, key))
+            self.assertEqual(bulk['queries'], len(lats))
+            self.assertEqual(sum(bulk['latency_histogram_us'].values()), len(lats))
+            self.assertTrue(bulk['exact_tests'] > 0)
+
+
+class TestPrecomputedLookups(PolygonIndexTestCase):
+    '''
+    Lookups using the structures precomputed when saving an index give
+    the same results as testing every polygon with shapely
+    '''
+
+    def setUp(self):
+        super(TestPrecomputedLookups, self).setUp()
+        self.polys = random_polygons(60, seed=2)
+        lats, lons = random_points(600, seed=2)
+
+        # Hierarchy lookups can differ within its tolerance of a boundary,
+        # other lookups on the boundary itself
+        boundaries = [poly.boundary for poly, props in self.polys]
+        points = [(lat, lon) for lat, lon in zip(lats, lons)
+                  if min(b.distance(Point(lon, lat)) for b in boundaries) > 0.01]
+        self.lats = numpy.array([lat for lat, lon in points])
+        self.lons = numpy.array([lon for lat, lon in points])
+
+        self.expected = []
+        for lat, lon in points:
+            pt = Point(lon, lat)
+            containing = [props for poly, props in self.polys if poly.contains(pt)]
+            containing.sort(key=lambda props: (props['level'], props['id']))
+            self.expected.append([props['id'] for props in containing])
+
+    def check_lookups(self, index):
+        self.assertEqual(self.single_ids(index, self.lats, self.lons, return_all=True), self.expected)
+        self.assertEqual(self.single_ids(index, self.lats, self.lons),
+                         [ids[0] if ids else None for ids in self.expected])
+
+        point_indices, poly_indices = index.points_in_polys(self.lats, self.lons, return_all=True)
+        results = [[] for j in xrange(len(self.lats))]
+        for j, i in zip(point_indices, poly_indices):
+            results[j].append(index.polygons[i][0]['id'])
+        self.assertEqual(results, self.expected)
+
+        batch = index.point_in_poly_batch(self.lats, self.lons, return_all=True)
+        self.assertEqual([[props['id'] for props in r] for r in batch], self.expected)
+
+    def test_exhaustive(self):
+        self.check_lookups(self.create_index(LevelPolygonIndex, self.polys))
+
+    def test_coverage(self):
+        index = self.create_index(LevelPolygonIndex, self.polys, build_coverage=True)
+        self.assertIsNotNone(index.coverage)
+        self.check_lookups(index)
+
+    def test_hierarchy(self):
+        index = self.create_index(LevelPolygonIndex, self.polys, build_hierarchy=True,
+                                  load_kw={'hierarchical': True})
+        # Some of the circles are inside coarser ones
+        self.assertTrue((index.hierarchy.parents >= 0).any())
+        self.check_lookups(index)
+
+    def test_raster(self):
+        index = self.create_index(LevelPolygonIndex, self.polys, build_raster=True)
+        self.assertIsNotNone(index.raster)
+        self.check_lookups(index)
+
+    def test_raster_without_priority(self):
+        # Regions list polygons in index order, the R-tree its own order
+        index = self.create_index(RTreePolygonIndex, self.polys)
+        raster_index = self.create_index(RTreePolygonIndex, self.polys, build_raster=True)
+        self.assertIsNotNone(raster_index.raster)
+        for return_all in (False, True):
+            self.assertEqual(self.single_ids(raster_index, self.lats, self.lons, return_all=return_all),
+                             self.single_ids(index, self.lats, self.lons, return_all=return_all))
+            self.assertEqual([props['id'] if props is not None else None for props in
+                              raster_index.point_in_poly_batch(self.lats, self.lons)],
+                             self.single_ids(index, self.lats, self.lons))
+
+    def test_resolutions(self):
+        index = self.create_index(LevelPolygonIndex, self.polys, build_resolutions=True)
+        self.assertIsNotNone(index.resolutions)
+        self.check_lookups(index)
+
+    def test_everything(self):
+        index = self.create_index(LevelPolygonIndex, self.polys, build_coverage=True, build_hierarchy=True,
+                                  build_raster=True, build_resolutions=True,
+                                  load_kw={'hierarchical': True, 'lazy': True})
+        self.check_lookups(index)
+
+
+class TestPolygonHierarchy(unittest.TestCase):
+    def test_first_match(self):
+        # 0 and 5 are countries, 1 and 2 states of 0, 3 and 4 counties in 1 and 2
+        hierarchy = PolygonHierarchy(numpy.array([-1, 0, 0, 1, 2, -1]))
+        candidates = [(3, None), (4, None), (1, None), (2, None), (0, None), (5, None)]
+
+        for containing in (set([0, 2, 4]), set([0, 2]), set([0, 1, 4]), set([5]), set()):
+            def contains(i, parts):
+                tested.append(i)
+                return i in containing
+
+            tested = []
+            matches = hierarchy.matches(candidates, contains)
+            all_tested = tested
+
+            tested = []
+            first = hierarchy.first_match(candidates, contains)
+            self.assertEqual(first, matches[0] if matches else None)
+            # Each polygon tested at most once, and only if matches tests it too
+            self.assertEqual(len(tested), len(set(tested)))
+            self.assertTrue(set(tested) <= set(all_tested))
+
+        # Stops at county 4 without testing the other country
+        containing = set([0, 2, 4, 5])
+        tested = []
+        self.assertEqual(hierarchy.first_match(candidates, contains), 4)
+        self.assertEqual(sorted(tested), [0, 1, 2, 4])
+
+
+class TestGeohashPolygonIndex(PolygonIndexTestCase):
+    def test_geohash_key(self):
+        # Geohash of 57.64911, 10.40744 is u4pruydqqvj
+        bits = point_bits(57.64911, 10.40744)
+        for level in xrange(1, 8):
+            self.assertEqual(geohash_key('u4pruydqqvj'[:level]), point_key(bits, level))
+
+    def test_legacy_index(self):
+        save_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        polys = [(box(10.3, 57.6, 10.5, 57.7), {'id': 0}),
+                 (box(10.0, 57.0, 11.0, 58.0), {'id': 1}),
+                 (box(-0.2, 51.4, 0.1, 51.6), {'id': 2})]
+        with open(os.path.join(save_dir, GEOJSON_POLYS_FILENAME), 'w') as f:
+            for poly, props in polys:
+                f.write(json.dumps({'type': 'Feature', 'properties': props,
+                                    'geometry': {'type': 'Polygon', 'coordinates': [list(poly.exterior.coords)]}}) + '\n')
+        with open(os.path.join(save_dir, GeohashPolygonIndex.LEGACY_INDEX_FILENAME), 'w') as f:
+            json.dump({'u4pru': [0], 'u4': [1], 'gcpuv': [2]}, f)
+
+        index = GeohashPolygonIndex.load(save_dir)
+        self.assertEqual(self.single_ids(index, [57.64911, 57.1, 51.5, 0.0], [10.40744, 10.1, -0.1, 0.0],
+                                         return_all=True), [[1, 0], [1], [2], []])
+
+        # Saving writes the new format
+        index.save()
+        self.assertTrue(os.path.exists(os.path.join(save_dir, GeohashPolygonIndex.INDEX_FILENAME)))
+        self.assertEqual(self.single_ids(GeohashPolygonIndex.load(save_dir), [57.64911], [10.40744]), [1])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
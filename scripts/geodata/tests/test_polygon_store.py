@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+from shapely.geometry import MultiPolygon, Point, Polygon, box
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(this_dir, os.pardir, os.pardir)))
+
+from geodata.mmap_arrays import write_arrays
+from geodata.polygons.index import RTreePolygonIndex
+from geodata.polygons.store import (PolygonStore, PolygonStoreWriter, PreparedGeometryCache,
+                                    LazyPreparedPolygon, PREPARED_BYTES_PER_COORD, POLYGON_STORE_MAGIC,
+                                    POLYGON_STORE_VERSION)
+
+
+test_polygons = [
+    (box(0, 0, 1, 1), {u'name': u'Square', u'admin_level': u'2'}),
+    (Polygon([(0, 0), (10, 0), (10, 10), (0, 10)], [[(2, 2), (4, 2), (4, 4), (2, 4)], [(6, 6), (8, 6), (8, 8)]]),
+     {u'name': u'Donut', u'name:ja': u'ドーナツ', u'population': 1234, u'ratio': 0.5}),
+    (MultiPolygon([box(20, 20, 21, 21), Point(30, 30).buffer(2, 16)]),
+     {u'name': u'Islands', u'tags': [u'a', u'b'], u'extra': {u'k': None}}),
+    (box(-180, -90, 180, 90), {}),
+]
+
+
+def num_coords(poly):
+    parts = poly.geoms if poly.geom_type == 'MultiPolygon' else [poly]
+    return sum(len(p.exterior.coords) + sum(len(r.coords) for r in p.interiors) for p in parts)
+
+
+class TestPolygonStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'polygons.bin')
+        writer = PolygonStoreWriter()
+        for poly, props in test_polygons:
+            writer.add(poly, props)
+        writer.save(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        for lazy in (False, True):
+            store = PolygonStore(self.filename, lazy=lazy)
+            self.assertEqual(len(store), len(test_polygons))
+            for i, (poly, props) in enumerate(test_polygons):
+                stored_props, stored_poly = store[i]
+                self.assertEqual(dict(stored_props), props)
+                self.assertEqual(dict(store.properties(i)), props)
+                self.assertTrue(stored_poly.context.equals_exact(poly, 0.0))
+                self.assertEqual(stored_poly.context.geom_type, poly.geom_type)
+                self.assertEqual(store.num_coords(i), num_coords(poly))
+
+            self.assertEqual(dict(store[-1][0]), test_polygons[-1][1])
+            self.assertRaises(IndexError, store.__getitem__, len(test_polygons))
+
+    def test_contains(self):
+        points = [Point(0.5, 0.5), Point(3, 3), Point(5, 5), Point(7.5, 6.5), Point(30, 31), Point(25, 25)]
+        for lazy in (False, True):
+            store = PolygonStore(self.filename, lazy=lazy)
+            for i, (poly, props) in enumerate(test_polygons):
+                stored_poly = store[i][1]
+                self.assertEqual(isinstance(stored_poly, LazyPreparedPolygon), lazy)
+                for pt in points:
+                    self.assertEqual(stored_poly.contains(pt), poly.contains(pt))
+
+    def test_lazy_cache_size(self):
+        # Room for the largest polygon only
+        cache_size = max(PolygonStore(self.filename).num_coords(i) for i in xrange(len(test_polygons)))
+        store = PolygonStore(self.filename, lazy=True, cache_size=cache_size * PREPARED_BYTES_PER_COORD)
+        for i in xrange(len(test_polygons)):
+            store[i][1].contains(Point(0.5, 0.5))
+            self.assertTrue(store.prepared_cache.size <= store.prepared_cache.max_size)
+            self.assertIn(i, store.prepared_cache)
+        self.assertEqual(store.cache, {})
+
+    def test_property_view(self):
+        store = PolygonStore(self.filename, lazy=True)
+        props = store.properties(2)
+        self.assertEqual(props[u'name'], u'Islands')
+        self.assertEqual(props.get(u'population'), None)
+        self.assertIn(u'tags', props)
+        self.assertEqual(len(props), 3)
+        self.assertRaises(KeyError, props.__getitem__, u'population')
+        self.assertEqual(props, test_polygons[2][1])
+
+        # Usable as any other mapping
+        self.assertEqual(dict(props), test_polygons[2][1])
+        self.assertEqual(sorted(props.keys()), sorted(test_polygons[2][1].keys()))
+        self.assertEqual(sorted(props.values()), sorted(test_polygons[2][1].values()))
+        self.assertEqual(sorted(props.items()), sorted(test_polygons[2][1].items()))
+        self.assertEqual(sorted(props.iteritems()), sorted(test_polygons[2][1].items()))
+
+        props_copy = props.copy()
+        self.assertIs(type(props_copy), dict)
+        props_copy[u'name'] = u'Changed'
+        self.assertEqual(props[u'name'], u'Islands')
+
+        self.assertEqual(pickle.loads(pickle.dumps(props)), test_polygons[2][1])
+        self.assertIs(type(pickle.loads(pickle.dumps(props))), dict)
+
+    def test_unknown_version(self):
+        filename = os.path.join(self.temp_dir, 'other.bin')
+        for metadata in ({}, {'version': POLYGON_STORE_VERSION + 1}):
+            write_arrays(filename, POLYGON_STORE_MAGIC, [], metadata=metadata)
+            self.assertRaises(ValueError, PolygonStore, filename)
+
+    def test_prepared_geometry_cache(self):
+        cache = PreparedGeometryCache(max_size=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 4)
+        # b was the least recently used
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.size, 8)
+        cache.put('d', 4, 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get('d'), 4)
+
+    def test_index_lazy_and_eager(self):
+        save_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        index = RTreePolygonIndex(save_dir=save_dir)
+        for poly, props in test_polygons:
+            index.index_polygon(poly)
+            index.add_polygon(poly, props)
+
+        # Saving closes the R-tree
+        points = [(0.5, 0.5), (3, 3), (5, 5), (30, 31), (-45, 100)]
+        expected = [[p.get(u'name') for p in index.point_in_poly(lat, lon, return_all=True)]
+                    for lon, lat in points]
+        index.save()
+        for lazy in (False, True):
+            loaded = RTreePolygonIndex.load(save_dir, lazy=lazy, cache_size=1000)
+            self.assertEqual([[p.get(u'name') for p in loaded.point_in_poly(lat, lon, return_all=True)]
+                              for lon, lat in points], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
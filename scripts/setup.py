@@ -15,11 +15,12 @@ def main():
             'fiona',
             'lxml',
             'marisa_trie',
+            'numpy',
             'pycountry',
             'pyproj',
             'python-Levenshtein',
             'requests',
-            'rtree',
+            'rtree>=0.8',
             'shapely',
             'six',
             'ujson',